@@ -0,0 +1,80 @@
+"""
+Microbenchmark of BGERerankerManager.rerank_documents, per-query latency of the previous
+one-pair-per-call loop against the batched, length-bucketed scoring.
+
+    python benchmark_rerank.py
+    python benchmark_rerank.py --candidates 10 20 50 --batch_size 16 --iters 5
+"""
+
+import argparse
+import os
+import random
+import time
+
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")  # CPU latency, set it to a GPU id to compare
+
+from config.settings import get_settings
+from utils.knowledge import BGERerankerManager
+
+
+SENTENCES = [
+    "光合作用是植物利用光能把二氧化碳和水合成有机物并释放氧气的过程。",
+    "牛顿第二定律指出物体的加速度与所受合力成正比，与质量成反比。",
+    "二分查找要求序列有序，每次比较后把查找区间缩小一半。",
+    "细胞膜主要由磷脂双分子层和蛋白质构成，具有选择透过性。",
+    "数据库事务具有原子性、一致性、隔离性和持久性。",
+    "函数的导数描述了函数值随自变量变化的瞬时变化率。",
+]
+
+
+def make_documents(n: int, rng: random.Random):
+    # chunks of very different lengths, like the retrieved candidates of a real query
+    return [
+        "".join(rng.choice(SENTENCES) for _ in range(rng.randint(1, 12)))
+        for _ in range(n)
+    ]
+
+
+def legacy_rerank(manager: BGERerankerManager, query: str, documents):
+    # the previous implementation: one forward pass per candidate
+    scores = [(manager.compute_score(query, doc), doc) for doc in documents]
+    scores.sort(key=lambda x: x[0], reverse=True)
+    return scores
+
+
+def timeit(fn, iters: int) -> float:
+    fn()  # warm-up
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def main():
+    settings = get_settings()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default=str(settings.BGE_RERANKER_MODEL_PATH))
+    parser.add_argument("--candidates", type=int, nargs="+", default=[10, 20, 50])
+    parser.add_argument("--batch_size", type=int, default=settings.RERANK_BATCH_SIZE)
+    parser.add_argument("--max_length", type=int, default=settings.RERANK_MAX_LENGTH)
+    parser.add_argument("--iters", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    manager = BGERerankerManager(args.model, args.batch_size, args.max_length)
+    rng = random.Random(args.seed)
+    query = "什么是光合作用？"
+
+    print(f"model={args.model} batch_size={args.batch_size} max_length={args.max_length}")
+    for n in args.candidates:
+        documents = make_documents(n, rng)
+        before_ms = timeit(lambda: legacy_rerank(manager, query, documents), args.iters)
+        after_ms = timeit(lambda: manager.rerank_documents(query, documents), args.iters)
+        print(
+            f"{n:>4} candidates: before {before_ms:.1f} ms/query, "
+            f"after {after_ms:.1f} ms/query, {before_ms / after_ms:.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
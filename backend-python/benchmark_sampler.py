@@ -0,0 +1,115 @@
+"""
+Microbenchmark of PIPELINE.sample_logits, per-token cost before / after the top-k sampler.
+
+    python benchmark_sampler.py --device cpu
+    python benchmark_sampler.py --device cuda --batch 8
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+from rwkv_pip.utils import PIPELINE
+
+
+def legacy_sample_logits(logits, temperature=1.0, top_p=0.85, top_k=0):
+    # the previous implementation: full-vocab argsort on every token
+    if type(logits) == list:
+        logits = np.array(logits)
+    np_logits = type(logits) == np.ndarray
+    if np_logits:
+        logits = logits - logits.max(axis=-1, keepdims=True)
+        e = np.exp(logits)
+        probs = e / e.sum(axis=-1, keepdims=True)
+    else:
+        probs = F.softmax(logits.float(), dim=-1)
+    top_k = int(top_k)
+    if np_logits or probs.device.type in ["cpu", "privateuseone"]:
+        if not np_logits:
+            probs = probs.cpu().numpy()
+        sorted_ids = np.argsort(probs)
+        sorted_probs = probs[sorted_ids][::-1]
+        cumulative_probs = np.cumsum(sorted_probs)
+        cutoff = float(sorted_probs[np.argmax(cumulative_probs >= top_p)])
+        probs[probs < cutoff] = 0
+        if top_k < len(probs) and top_k > 0:
+            probs[sorted_ids[:-top_k]] = 0
+        if temperature != 1.0:
+            probs = probs ** (1.0 / temperature)
+        probs = probs / np.sum(probs)
+        out = np.random.choice(a=len(probs), p=probs)
+        return int(out)
+    else:
+        sorted_ids = torch.argsort(probs)
+        sorted_probs = probs[sorted_ids]
+        sorted_probs = torch.flip(sorted_probs, dims=(0,))
+        cumulative_probs = torch.cumsum(sorted_probs, dim=-1).cpu().numpy()
+        cutoff = float(sorted_probs[np.argmax(cumulative_probs >= top_p)])
+        probs[probs < cutoff] = 0
+        if top_k < len(probs) and top_k > 0:
+            probs[sorted_ids[:-top_k]] = 0
+        if temperature != 1.0:
+            probs = probs ** (1.0 / temperature)
+        out = torch.multinomial(probs, num_samples=1)[0]
+        return int(out)
+
+
+def timeit(fn, iters: int) -> float:
+    fn()  # warm-up
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab", type=int, default=65536)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--iters", type=int, default=200)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top_p", type=float, default=0.3)
+    parser.add_argument("--top_k", type=int, default=0)
+    args = parser.parse_args()
+
+    pipeline = PIPELINE(None, "abc_tokenizer")  # the tokenizer is not used here
+    logits = torch.randn(args.batch, args.vocab, device=args.device) * 4
+    kwargs = dict(temperature=args.temperature, top_p=args.top_p, top_k=args.top_k)
+
+    cases = [
+        (
+            "torch",
+            lambda: [legacy_sample_logits(row.clone(), **kwargs) for row in logits],
+            lambda: pipeline.sample_logits(logits.clone(), **kwargs),
+        ),
+        (
+            "numpy",
+            lambda: [
+                legacy_sample_logits(row.cpu().numpy(), **kwargs) for row in logits
+            ],
+            lambda: pipeline.sample_logits(logits.cpu().numpy(), **kwargs),
+        ),
+    ]
+    print(
+        f"vocab={args.vocab} batch={args.batch} device={args.device} "
+        f"top_p={args.top_p} top_k={args.top_k}"
+    )
+    for name, before, after in cases:
+        before_ms = timeit(before, args.iters) / args.batch
+        after_ms = timeit(after, args.iters) / args.batch
+        print(
+            f"{name:>6}: before {before_ms:.3f} ms/token, after {after_ms:.3f} ms/token, "
+            f"{before_ms / after_ms:.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
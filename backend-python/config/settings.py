@@ -19,9 +19,58 @@ class Settings:
         self.DEFAULT_STRATEGY = os.environ.get('ITAP_DEFAULT_STRATEGY', 'cuda fp16')
         self.EMBEDDING_MODEL = os.environ.get('ITAP_EMBEDDING_MODEL', 'm3e-base')
         
+        # 推理调度配置：同时解码的最大请求数
+        self.RWKV_MAX_BATCH_SIZE = int(os.environ.get('ITAP_RWKV_MAX_BATCH_SIZE', '8'))
+        # 推理排队配置：最大排队数、排队超时（秒）、队列满时建议的重试间隔（秒）
+        self.RWKV_MAX_QUEUE_SIZE = int(os.environ.get('ITAP_RWKV_MAX_QUEUE_SIZE', '32'))
+        self.RWKV_QUEUE_TIMEOUT = int(os.environ.get('ITAP_RWKV_QUEUE_TIMEOUT', '120'))
+        self.RWKV_BATCH_QUEUE_TIMEOUT = int(os.environ.get('ITAP_RWKV_BATCH_QUEUE_TIMEOUT', '600'))
+        self.RWKV_RETRY_AFTER = int(os.environ.get('ITAP_RWKV_RETRY_AFTER', '10'))
+        # 长任务（习题/大纲）每生成多少token可被抢占一次，让排队的对话/问答先执行，0为不抢占
+        self.RWKV_PREEMPT_INTERVAL = int(os.environ.get('ITAP_RWKV_PREEMPT_INTERVAL', '64'))
+        # 长提示词分段预填充，每个解码步之间最多预填充多少token，避免阻塞正在生成的请求，0为一次预填充完
+        self.RWKV_PREFILL_CHUNK = int(os.environ.get('ITAP_RWKV_PREFILL_CHUNK', '512'))
+        # 前缀状态缓存：内存预算（MB）和淘汰策略（lru：最近最少使用；cost：命中次数×节省的预填充token数最小者先淘汰）
+        self.RWKV_STATE_CACHE_BUDGET_MB = int(os.environ.get('ITAP_RWKV_STATE_CACHE_BUDGET_MB', '4096'))
+        self.RWKV_STATE_CACHE_EVICTION = os.environ.get('ITAP_RWKV_STATE_CACHE_EVICTION', 'lru')
+        # 前缀状态缓存分层：显存层预算（MB，0为不使用）、命中多少次升入显存层、磁盘层预算（MB，0为不使用）、
+        # 内存/磁盘层att_kv矩阵的存储精度（fp32、fp16、bf16）、磁盘层是否压缩、最大条目数
+        self.RWKV_STATE_CACHE_DEVICE_BUDGET_MB = int(os.environ.get('ITAP_RWKV_STATE_CACHE_DEVICE_BUDGET_MB', '0'))
+        self.RWKV_STATE_CACHE_PROMOTE_HITS = int(os.environ.get('ITAP_RWKV_STATE_CACHE_PROMOTE_HITS', '3'))
+        self.RWKV_STATE_CACHE_DISK_BUDGET_MB = int(os.environ.get('ITAP_RWKV_STATE_CACHE_DISK_BUDGET_MB', '0'))
+        self.RWKV_STATE_CACHE_KV_DTYPE = os.environ.get('ITAP_RWKV_STATE_CACHE_KV_DTYPE', 'fp32')
+        self.RWKV_STATE_CACHE_DISK_COMPRESS = os.environ.get('ITAP_RWKV_STATE_CACHE_DISK_COMPRESS', 'True').lower() == 'true'
+        self.RWKV_STATE_CACHE_MAX_ENTRIES = int(os.environ.get('ITAP_RWKV_STATE_CACHE_MAX_ENTRIES', '300'))
+        # 前缀状态缓存持久化：切换模型和退出时写入快照，重启后按需加载；目录为空时使用BASE_PATH/state_cache
+        self.RWKV_STATE_CACHE_PERSIST = os.environ.get('ITAP_RWKV_STATE_CACHE_PERSIST', 'True').lower() == 'true'
+        self.RWKV_STATE_CACHE_DIR = os.environ.get('ITAP_RWKV_STATE_CACHE_DIR', '')
+        # 跨进程共享前缀状态缓存：同一节点的多个worker共用一块共享内存（MB，0为不使用），目录为空时使用/dev/shm
+        self.RWKV_SHARED_STATE_CACHE_MB = int(os.environ.get('ITAP_RWKV_SHARED_STATE_CACHE_MB', '0'))
+        self.RWKV_SHARED_STATE_CACHE_DIR = os.environ.get('ITAP_RWKV_SHARED_STATE_CACHE_DIR', '')
+        # 会话状态缓存：每个会话保存上一轮回复后的RNN状态，内存预算（MB）；溢出目录为空时不写磁盘
+        self.RWKV_SESSION_STATE_BUDGET_MB = int(os.environ.get('ITAP_RWKV_SESSION_STATE_BUDGET_MB', '1024'))
+        self.RWKV_SESSION_STATE_SPILL_DIR = os.environ.get('ITAP_RWKV_SESSION_STATE_SPILL_DIR', '')
+        self.RWKV_SESSION_STATE_DISK_BUDGET_MB = int(os.environ.get('ITAP_RWKV_SESSION_STATE_DISK_BUDGET_MB', '8192'))
+        # 课时状态：上传课时后预填充课时内容，问答和整体出题从该状态开始，只预填充问题或出题要求；
+        # 内存预算（MB）、磁盘预算（MB）、课时内容最大字符数（超过时问答改用检索片段，0为不使用）
+        self.RWKV_LESSON_STATE_BUDGET_MB = int(os.environ.get('ITAP_RWKV_LESSON_STATE_BUDGET_MB', '2048'))
+        self.RWKV_LESSON_STATE_DISK_BUDGET_MB = int(os.environ.get('ITAP_RWKV_LESSON_STATE_DISK_BUDGET_MB', '8192'))
+        self.RWKV_LESSON_STATE_MAX_CHARS = int(os.environ.get('ITAP_RWKV_LESSON_STATE_MAX_CHARS', '12000'))
+        # 常驻显存的state微调文件数量：请求可各自指定state文件，超出时按LRU卸载；前缀状态缓存按state文件分开
+        self.RWKV_STATE_PRESET_MAX = int(os.environ.get('ITAP_RWKV_STATE_PRESET_MAX', '4'))
+        
         # BGEM3和Reranker模型配置
         self.BGEM3_MODEL = os.environ.get('ITAP_BGEM3_MODEL', 'bge-m3')
         self.BGE_RERANKER_MODEL = os.environ.get('ITAP_BGE_RERANKER_MODEL', 'bge-reranker-v2-m3')
+        # 启动时在后台加载并预热BGEM3和Reranker，首个问题不再等待模型加载
+        self.RETRIEVAL_WARMUP = os.environ.get('ITAP_RETRIEVAL_WARMUP', 'True').lower() == 'true'
+        # Reranker批处理：所有候选一次打分，按长度分成子批次；子批次最大条数、查询+文档最大token数
+        self.RERANK_BATCH_SIZE = int(os.environ.get('ITAP_RERANK_BATCH_SIZE', '32'))
+        self.RERANK_MAX_LENGTH = int(os.environ.get('ITAP_RERANK_MAX_LENGTH', '512'))
+        # 文本块向量缓存：按模型名、max_length和文本哈希保存BGEM3向量（float16，SQLite），
+        # 相同文本不再重复向量化；磁盘预算（MB，0为不使用），目录为空时使用BASE_PATH/embedding_cache
+        self.EMBEDDING_CACHE_BUDGET_MB = int(os.environ.get('ITAP_EMBEDDING_CACHE_BUDGET_MB', '2048'))
+        self.EMBEDDING_CACHE_DIR = os.environ.get('ITAP_EMBEDDING_CACHE_DIR', '')
         
         # ChromaDB配置
         self.CHROMADB_HOST = os.environ.get('ITAP_CHROMADB_HOST', 'localhost')
@@ -48,6 +97,10 @@ class Settings:
         # 向量数据库配置
         self.VECTOR_DB_CHUNK_SIZE = int(os.environ.get('ITAP_VECTOR_DB_CHUNK_SIZE', '768'))
         self.VECTOR_DB_CHUNK_OVERLAP = int(os.environ.get('ITAP_VECTOR_DB_CHUNK_OVERLAP', '256'))
+        # 流式入库：向量化微批次大小、每次写入ChromaDB的文本块数、阶段之间队列最多积压的批次数
+        self.VECTOR_DB_EMBED_BATCH_SIZE = int(os.environ.get('ITAP_VECTOR_DB_EMBED_BATCH_SIZE', '32'))
+        self.VECTOR_DB_UPSERT_BATCH_SIZE = int(os.environ.get('ITAP_VECTOR_DB_UPSERT_BATCH_SIZE', '256'))
+        self.VECTOR_DB_QUEUE_SIZE = int(os.environ.get('ITAP_VECTOR_DB_QUEUE_SIZE', '4'))
         
         # 会话配置
         self.SESSION_TIMEOUT = int(os.environ.get('ITAP_SESSION_TIMEOUT', '3600'))  # 秒
@@ -81,10 +134,13 @@ class Settings:
         self.LOGS_DIR = base_path / "logs"
         self.TEMP_DIR = base_path / "temp"
         self.UPLOADS_DIR = base_path / "uploads"
+        self.STATE_CACHE_DIR = Path(self.RWKV_STATE_CACHE_DIR) if self.RWKV_STATE_CACHE_DIR else base_path / "state_cache"
+        self.EMBEDDING_CACHE_PATH = Path(self.EMBEDDING_CACHE_DIR) if self.EMBEDDING_CACHE_DIR else base_path / "embedding_cache"
         
         # 确保目录存在
         for path in [self.MODEL_DIR, self.KNOWLEDGE_BASE_DIR, self.TEACHERS_DIR, 
-                    self.STUDENTS_DIR, self.LOGS_DIR, self.TEMP_DIR, self.UPLOADS_DIR]:
+                    self.STUDENTS_DIR, self.LOGS_DIR, self.TEMP_DIR, self.UPLOADS_DIR,
+                    self.STATE_CACHE_DIR, self.EMBEDDING_CACHE_PATH]:
             path.mkdir(parents=True, exist_ok=True)
     
     def get_model_config(self) -> Dict[str, Any]:
@@ -133,8 +189,38 @@ class Settings:
             "DEFAULT_MODEL": self.DEFAULT_MODEL,
             "DEFAULT_STRATEGY": self.DEFAULT_STRATEGY,
             "EMBEDDING_MODEL": self.EMBEDDING_MODEL,
+            "RWKV_MAX_BATCH_SIZE": self.RWKV_MAX_BATCH_SIZE,
+            "RWKV_MAX_QUEUE_SIZE": self.RWKV_MAX_QUEUE_SIZE,
+            "RWKV_QUEUE_TIMEOUT": self.RWKV_QUEUE_TIMEOUT,
+            "RWKV_BATCH_QUEUE_TIMEOUT": self.RWKV_BATCH_QUEUE_TIMEOUT,
+            "RWKV_RETRY_AFTER": self.RWKV_RETRY_AFTER,
+            "RWKV_PREEMPT_INTERVAL": self.RWKV_PREEMPT_INTERVAL,
+            "RWKV_PREFILL_CHUNK": self.RWKV_PREFILL_CHUNK,
+            "RWKV_STATE_CACHE_BUDGET_MB": self.RWKV_STATE_CACHE_BUDGET_MB,
+            "RWKV_STATE_CACHE_EVICTION": self.RWKV_STATE_CACHE_EVICTION,
+            "RWKV_STATE_CACHE_DEVICE_BUDGET_MB": self.RWKV_STATE_CACHE_DEVICE_BUDGET_MB,
+            "RWKV_STATE_CACHE_PROMOTE_HITS": self.RWKV_STATE_CACHE_PROMOTE_HITS,
+            "RWKV_STATE_CACHE_DISK_BUDGET_MB": self.RWKV_STATE_CACHE_DISK_BUDGET_MB,
+            "RWKV_STATE_CACHE_KV_DTYPE": self.RWKV_STATE_CACHE_KV_DTYPE,
+            "RWKV_STATE_CACHE_DISK_COMPRESS": self.RWKV_STATE_CACHE_DISK_COMPRESS,
+            "RWKV_STATE_CACHE_MAX_ENTRIES": self.RWKV_STATE_CACHE_MAX_ENTRIES,
+            "RWKV_STATE_CACHE_PERSIST": self.RWKV_STATE_CACHE_PERSIST,
+            "RWKV_SHARED_STATE_CACHE_MB": self.RWKV_SHARED_STATE_CACHE_MB,
+            "RWKV_SHARED_STATE_CACHE_DIR": self.RWKV_SHARED_STATE_CACHE_DIR,
+            "RWKV_SESSION_STATE_BUDGET_MB": self.RWKV_SESSION_STATE_BUDGET_MB,
+            "RWKV_SESSION_STATE_SPILL_DIR": self.RWKV_SESSION_STATE_SPILL_DIR,
+            "RWKV_SESSION_STATE_DISK_BUDGET_MB": self.RWKV_SESSION_STATE_DISK_BUDGET_MB,
+            "RWKV_LESSON_STATE_BUDGET_MB": self.RWKV_LESSON_STATE_BUDGET_MB,
+            "RWKV_LESSON_STATE_DISK_BUDGET_MB": self.RWKV_LESSON_STATE_DISK_BUDGET_MB,
+            "RWKV_LESSON_STATE_MAX_CHARS": self.RWKV_LESSON_STATE_MAX_CHARS,
+            "RWKV_STATE_PRESET_MAX": self.RWKV_STATE_PRESET_MAX,
             "BGEM3_MODEL": self.BGEM3_MODEL,
             "BGE_RERANKER_MODEL": self.BGE_RERANKER_MODEL,
+            "RETRIEVAL_WARMUP": self.RETRIEVAL_WARMUP,
+            "RERANK_BATCH_SIZE": self.RERANK_BATCH_SIZE,
+            "RERANK_MAX_LENGTH": self.RERANK_MAX_LENGTH,
+            "EMBEDDING_CACHE_BUDGET_MB": self.EMBEDDING_CACHE_BUDGET_MB,
+            "EMBEDDING_CACHE_DIR": self.EMBEDDING_CACHE_DIR,
             "CHROMADB_HOST": self.CHROMADB_HOST,
             "CHROMADB_PORT": self.CHROMADB_PORT,
             "DATABASE_CONFIG": self.DATABASE_CONFIG,
@@ -144,6 +230,9 @@ class Settings:
             "LOG_FILE": self.LOG_FILE,
             "VECTOR_DB_CHUNK_SIZE": self.VECTOR_DB_CHUNK_SIZE,
             "VECTOR_DB_CHUNK_OVERLAP": self.VECTOR_DB_CHUNK_OVERLAP,
+            "VECTOR_DB_EMBED_BATCH_SIZE": self.VECTOR_DB_EMBED_BATCH_SIZE,
+            "VECTOR_DB_UPSERT_BATCH_SIZE": self.VECTOR_DB_UPSERT_BATCH_SIZE,
+            "VECTOR_DB_QUEUE_SIZE": self.VECTOR_DB_QUEUE_SIZE,
             "SESSION_TIMEOUT": self.SESSION_TIMEOUT,
             "DEBUG": self.DEBUG,
             "DEPLOY_MODE": self.DEPLOY_MODE,
@@ -154,6 +243,8 @@ class Settings:
             "LOGS_DIR": str(self.LOGS_DIR),
             "TEMP_DIR": str(self.TEMP_DIR),
             "UPLOADS_DIR": str(self.UPLOADS_DIR),
+            "STATE_CACHE_DIR": str(self.STATE_CACHE_DIR),
+            "EMBEDDING_CACHE_PATH": str(self.EMBEDDING_CACHE_PATH),
             "BGEM3_MODEL_PATH": str(self.BGEM3_MODEL_PATH),
             "BGE_RERANKER_MODEL_PATH": str(self.BGE_RERANKER_MODEL_PATH)
         }
@@ -65,6 +65,7 @@ from utils.ngrok import *
 from utils.log import log_middleware
 from routes import completion, config, state_cache, upload, qa, create, exercise, download, session_routes, knowledge
 import global_var
+from utils.knowledge import model_registry
 from config.settings import get_settings
 
 
@@ -72,6 +73,8 @@ from config.settings import get_settings
 async def lifespan(app: FastAPI):
     init()
     yield
+    # 退出时保存前缀状态缓存，重启后直接命中
+    state_cache.persist_state(global_var.get(global_var.Model))
 
 
 app = FastAPI(lifespan=lifespan, dependencies=[Depends(log_middleware)])
@@ -137,6 +140,12 @@ def init():
 
     set_torch()
 
+    if get_settings().RETRIEVAL_WARMUP:
+        # 后台加载检索模型，不阻塞服务启动；未就绪时请求会在第一次使用时等待加载
+        threading.Thread(
+            target=model_registry.warm_up, name="retrieval-warmup", daemon=True
+        ).start()
+
     if os.environ.get("ngrok_token") is not None:
         ngrok_connect()
 
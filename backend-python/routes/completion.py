@@ -1,7 +1,6 @@
 import asyncio
 import json
 import os
-from threading import Lock
 from typing import List, Union, Literal, Optional, Dict, Any
 from enum import Enum
 import base64
@@ -21,8 +20,10 @@ from routes.schema import (
     ChatCompletionNamedToolChoiceParam,
 )
 from utils.rwkv import *
+from utils.scheduler import scheduler, GenerationTask, PRIORITY_INTERACTIVE
 from utils.log import quick_log
 from utils.session_manager import session_manager
+from utils.session_state import session_state
 import global_var
 
 
@@ -81,6 +82,12 @@ class ChatCompletionBody(ModelConfigBody):
     is_teacher: bool = Field(
         False, description="Whether the user is a teacher (true) or student (false)"
     )
+    n: int = Field(
+        1,
+        description="Number of completions, the prompt is prefilled once and forked",
+        ge=1,
+        le=8,
+    )
 
     model_config = {
         "json_schema_extra": {
@@ -103,16 +110,119 @@ class ChatCompletionBody(ModelConfigBody):
                 "user_id": "user123",  # 用户ID
                 "session_id": "session456",  # 会话ID
                 "is_teacher": False,  # 用户类型
+                "n": 1,  # 候选回复数量
             }
         }
     }
 
 
-completion_lock = Lock()
-
 requests_num = 0
 
 
+def submit_completion(
+    model: AbstractRWKV,
+    body: ModelConfigBody,
+    prompt: str,
+    stop: Union[str, List[str], None],
+    session: Union[SessionPrompt, None] = None,
+) -> GenerationTask:
+    """
+    提交生成任务，队列已满时抛出429；流式请求在创建EventSourceResponse之前调用，
+    这样客户端能收到真正的状态码和Retry-After
+    """
+    set_rwkv_config(model, global_var.get(global_var.Model_Config))
+    set_rwkv_config(model, body)
+    print(get_rwkv_config(model))
+    # the generation runs on the scheduler thread, batched with the other in-flight requests
+    # 会话状态命中时只预填充新消息；n>1时预填充一次，复制状态后分别采样
+    return scheduler.submit(
+        model,
+        prompt,
+        stop,
+        PRIORITY_INTERACTIVE,
+        session=session,
+        n=getattr(body, "n", 1) or 1,
+    )
+
+
+def stream_error_event(e: Exception):
+    """流已经开始后出错（排队超时、被挤出队列、生成失败），推送SSE error事件，带状态码和retry_after"""
+    if isinstance(e, HTTPException):
+        retry_after = (e.headers or {}).get("Retry-After")
+        error = {
+            "message": e.detail,
+            "type": "queue_error",
+            "status": e.status_code,
+            "retry_after": int(retry_after) if retry_after is not None else None,
+        }
+    else:
+        error = {
+            "message": f"Generation error: {str(e)}",
+            "type": "generation_error",
+            "status": status.HTTP_500_INTERNAL_SERVER_ERROR,
+            "retry_after": None,
+        }
+    return {"event": "error", "data": json.dumps({"error": error}, ensure_ascii=False)}
+
+
+async def queue_position_events(task: GenerationTask, request: Request):
+    """流式请求排队时，推送当前排队位置（SSE事件名为queue）"""
+    position = None
+    while not task.started.is_set():
+        current = scheduler.position(task)
+        if current >= 0 and current != position:
+            position = current
+            yield {
+                "event": "queue",
+                "data": json.dumps(
+                    {"object": "queue.position", "position": position},
+                    ensure_ascii=False,
+                ),
+            }
+        if await task.wait_started(1):
+            break
+        if await request.is_disconnected():
+            task.cancel()
+            break
+
+
+async def iterate_choices(tasks: List[GenerationTask]):
+    """
+    同时读取各候选的输出，按到达顺序产出(index, 输出)
+    """
+    if len(tasks) == 1:
+        async for output in tasks[0]:
+            yield 0, output
+        return
+
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    async def consume(index: int, task: GenerationTask):
+        try:
+            async for output in task:
+                await queue.put((index, output))
+        except Exception as e:
+            await queue.put((index, e))
+        finally:
+            await queue.put((index, done))
+
+    consumers = [asyncio.create_task(consume(i, task)) for i, task in enumerate(tasks)]
+    remaining = len(tasks)
+    try:
+        while remaining > 0:
+            index, item = await queue.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield index, item
+    finally:
+        for consumer in consumers:
+            consumer.cancel()
+
+
 async def eval_rwkv(
     model: AbstractRWKV,
     request: Request,
@@ -121,125 +231,127 @@ async def eval_rwkv(
     stream: bool,
     stop: Union[str, List[str], None],
     chat_mode: bool,
+    task: Union[GenerationTask, None] = None,
 ):
+    """task: 流式请求在路由中预先提交的任务，见submit_completion"""
     global requests_num
     requests_num = requests_num + 1
     quick_log(request, None, "Start Waiting. RequestsNum: " + str(requests_num))
-    while completion_lock.locked():
-        if await request.is_disconnected():
-            requests_num = requests_num - 1
-            print(f"{request.client} Stop Waiting (Lock)")
-            quick_log(
-                request,
-                None,
-                "Stop Waiting (Lock). RequestsNum: " + str(requests_num),
-            )
-            return
-        await asyncio.sleep(0.1)
-    else:
-        with completion_lock:
-            if await request.is_disconnected():
-                requests_num = requests_num - 1
-                print(f"{request.client} Stop Waiting (Lock)")
-                quick_log(
-                    request,
-                    None,
-                    "Stop Waiting (Lock). RequestsNum: " + str(requests_num),
-                )
+    if await request.is_disconnected():
+        if task is not None:
+            task.cancel()
+        requests_num = requests_num - 1
+        print(f"{request.client} Stop Waiting")
+        quick_log(
+            request,
+            None,
+            "Stop Waiting. RequestsNum: " + str(requests_num),
+        )
+        return
+
+    response, prompt_tokens, completion_tokens = "", 0, 0
+    completion_start_time = None
+    try:
+        if task is None:
+            task = submit_completion(model, body, prompt, stop)
+        if stream:
+            async for event in queue_position_events(task, request):
+                yield event
+            if task.cancelled:
                 return
-            set_rwkv_config(model, global_var.get(global_var.Model_Config))
-            set_rwkv_config(model, body)
-            print(get_rwkv_config(model))
-
-            response, prompt_tokens, completion_tokens = "", 0, 0
-            completion_start_time = None
-            try:
-                for response, delta, prompt_tokens, completion_tokens in model.generate(
-                    prompt,
-                    stop=stop,
-                ):
-                    if not completion_start_time:
-                        completion_start_time = time.time()
-                    if await request.is_disconnected():
-                        break
-                    if stream:
-                        yield json.dumps(
+        async for response, delta, prompt_tokens, completion_tokens in task:
+            if not completion_start_time:
+                completion_start_time = time.time()
+            if await request.is_disconnected():
+                break
+            if stream:
+                yield json.dumps(
+                    {
+                        "object": (
+                            "chat.completion.chunk"
+                            if chat_mode
+                            else "text_completion"
+                        ),
+                        "model": model.name,
+                        "choices": [
+                            (
+                                {
+                                    "delta": {"content": delta},
+                                    "finish_reason": None,
+                                    "index": 0,
+                                }
+                                if chat_mode
+                                else {
+                                    "text": delta,
+                                    "finish_reason": None,
+                                    "index": 0,
+                                }
+                            )
+                        ],
+                    },
+                    ensure_ascii=False
+                ) + "\n"
+            else:
+                response += delta
+        if not stream:
+            yield json.dumps(
+                {
+                    "object": (
+                        "chat.completion" if chat_mode else "text_completion"
+                    ),
+                    "model": model.name,
+                    "choices": [
+                        (
                             {
-                                "object": (
-                                    "chat.completion.chunk"
-                                    if chat_mode
-                                    else "text_completion"
-                                ),
-                                "model": model.name,
-                                "choices": [
-                                    (
-                                        {
-                                            "delta": {"content": delta},
-                                            "finish_reason": None,
-                                            "index": 0,
-                                        }
-                                        if chat_mode
-                                        else {
-                                            "text": delta,
-                                            "finish_reason": None,
-                                            "index": 0,
-                                        }
-                                    )
-                                ],
-                            },
-                            ensure_ascii=False
-                        ) + "\n"
-                    else:
-                        response += delta
-                if not stream:
-                    yield json.dumps(
-                        {
-                            "object": (
-                                "chat.completion" if chat_mode else "text_completion"
-                            ),
-                            "model": model.name,
-                            "choices": [
-                                (
-                                    {
-                                        "message": {"role": "assistant", "content": response},
-                                        "finish_reason": "stop",
-                                        "index": 0,
-                                    }
-                                    if chat_mode
-                                    else {
-                                        "text": response,
-                                        "finish_reason": "stop",
-                                        "index": 0,
-                                    }
-                                )
-                            ],
-                            "usage": {
-                                "prompt_tokens": prompt_tokens,
-                                "completion_tokens": completion_tokens,
-                                "total_tokens": prompt_tokens + completion_tokens,
-                            },
-                        },
-                        ensure_ascii=False
-                    )
-            except Exception as e:
-                print(f"Generation error: {e}")
-                if not stream:
-                    yield json.dumps(
-                        {
-                            "error": {
-                                "message": f"Generation error: {str(e)}",
-                                "type": "generation_error",
+                                "message": {"role": "assistant", "content": response},
+                                "finish_reason": "stop",
+                                "index": 0,
                             }
-                        },
-                        ensure_ascii=False
-                    )
-            finally:
-                requests_num = requests_num - 1
-                quick_log(
-                    request,
-                    None,
-                    "Generation Complete. RequestsNum: " + str(requests_num),
-                )
+                            if chat_mode
+                            else {
+                                "text": response,
+                                "finish_reason": "stop",
+                                "index": 0,
+                            }
+                        )
+                    ],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    },
+                },
+                ensure_ascii=False
+            )
+    except HTTPException as e:
+        # 排队已满/超时：非流式请求直接返回对应的状态码和Retry-After，流式请求推送error事件
+        if not stream:
+            raise
+        print(f"Generation error: {e.detail}")
+        yield stream_error_event(e)
+    except Exception as e:
+        print(f"Generation error: {e}")
+        if stream:
+            yield stream_error_event(e)
+        else:
+            yield json.dumps(
+                {
+                    "error": {
+                        "message": f"Generation error: {str(e)}",
+                        "type": "generation_error",
+                    }
+                },
+                ensure_ascii=False
+            )
+    finally:
+        if task is not None:
+            task.cancel()
+        requests_num = requests_num - 1
+        quick_log(
+            request,
+            None,
+            "Generation Complete. RequestsNum: " + str(requests_num),
+        )
 
 
 async def eval_rwkv_with_context(
@@ -253,160 +365,193 @@ async def eval_rwkv_with_context(
     user_id: str,
     session_id: str,
     current_messages: List[ChatCompletionMessageParam],
+    session: Union[SessionPrompt, None] = None,
+    task: Union[GenerationTask, None] = None,
 ):
-    """带上下文管理的RWKV评估函数"""
+    """带上下文管理的RWKV评估函数，task: 流式请求在路由中预先提交的任务，见submit_completion"""
     global requests_num
     requests_num = requests_num + 1
     quick_log(request, None, "Start Waiting. RequestsNum: " + str(requests_num))
-    
-    while completion_lock.locked():
-        if await request.is_disconnected():
-            requests_num = requests_num - 1
-            print(f"{request.client} Stop Waiting (Lock)")
-            quick_log(
-                request,
-                None,
-                "Stop Waiting (Lock). RequestsNum: " + str(requests_num),
-            )
-            return
-        await asyncio.sleep(0.1)
-    else:
-        with completion_lock:
-            if await request.is_disconnected():
-                requests_num = requests_num - 1
-                print(f"{request.client} Stop Waiting (Lock)")
-                quick_log(
-                    request,
-                    None,
-                    "Stop Waiting (Lock). RequestsNum: " + str(requests_num),
-                )
+    if await request.is_disconnected():
+        if task is not None:
+            for t in [task] + task.forks:
+                t.cancel()
+        requests_num = requests_num - 1
+        print(f"{request.client} Stop Waiting")
+        quick_log(
+            request,
+            None,
+            "Stop Waiting. RequestsNum: " + str(requests_num),
+        )
+        return
+
+    response, prompt_tokens, completion_tokens = "", 0, 0
+    completion_start_time = None
+    tasks: List[GenerationTask] = []
+    n = getattr(body, "n", 1) or 1
+    responses = [""] * n
+    choice_completion_tokens = [0] * n
+    try:
+        if task is None:
+            task = submit_completion(model, body, prompt, stop, session)
+        tasks = [task] + task.forks
+        if stream:
+            async for event in queue_position_events(task, request):
+                yield event
+            if task.cancelled:
                 return
-            set_rwkv_config(model, global_var.get(global_var.Model_Config))
-            set_rwkv_config(model, body)
-            print(get_rwkv_config(model))
-
-            response, prompt_tokens, completion_tokens = "", 0, 0
-            completion_start_time = None
+        async for index, (choice, delta, choice_prompt_tokens, choice_tokens) in iterate_choices(tasks):
+            prompt_tokens = max(prompt_tokens, choice_prompt_tokens)
+            choice_completion_tokens[index] = choice_tokens
+            if not completion_start_time:
+                completion_start_time = time.time()
+            if await request.is_disconnected():
+                break
+            if stream:
+                yield json.dumps(
+                    {
+                        "object": (
+                            "chat.completion.chunk"
+                            if chat_mode
+                            else "text_completion"
+                        ),
+                        "model": model.name,
+                        "choices": [
+                            (
+                                {
+                                    "delta": {"content": delta},
+                                    "finish_reason": None,
+                                    "index": index,
+                                }
+                                if chat_mode
+                                else {
+                                    "text": delta,
+                                    "finish_reason": None,
+                                    "index": index,
+                                }
+                            )
+                        ],
+                    },
+                    ensure_ascii=False
+                ) + "\n"
+            else:
+                # 已在停止词处截断的完整回复
+                responses[index] = choice
+        # 保存第一个候选作为本轮回复，与会话状态缓存一致
+        response = responses[0]
+        completion_tokens = sum(choice_completion_tokens)
+        
+        # 保存对话记录（只在非流式模式下）
+        if not stream and response:
             try:
-                for response, delta, prompt_tokens, completion_tokens in model.generate(
-                    prompt,
-                    stop=stop,
-                ):
-                    if not completion_start_time:
-                        completion_start_time = time.time()
-                    if await request.is_disconnected():
-                        break
-                    if stream:
-                        yield json.dumps(
-                            {
-                                "object": (
-                                    "chat.completion.chunk"
-                                    if chat_mode
-                                    else "text_completion"
-                                ),
-                                "model": model.name,
-                                "choices": [
-                                    (
-                                        {
-                                            "delta": {"content": delta},
-                                            "finish_reason": None,
-                                            "index": 0,
-                                        }
-                                        if chat_mode
-                                        else {
-                                            "text": delta,
-                                            "finish_reason": None,
-                                            "index": 0,
-                                        }
-                                    )
-                                ],
-                            },
-                            ensure_ascii=False
-                        ) + "\n"
-                    else:
-                        response += delta
+                # 转换消息格式为字典，包含完整的对话
+                messages_dict = []
                 
-                # 保存对话记录（只在非流式模式下）
-                if not stream and response:
-                    try:
-                        # 转换消息格式为字典，包含完整的对话
-                        messages_dict = []
-                        
-                        # 添加用户消息
-                        for msg in current_messages:
-                            messages_dict.append({
-                                "role": msg.role,
-                                "content": msg.content,
-                                "raw": getattr(msg, 'raw', False)
-                            })
-                        
-                        # 添加助手回复
-                        messages_dict.append({
-                            "role": "assistant",
-                            "content": response,
-                            "raw": False
-                        })
-                        
-                        # 保存完整的对话记录
-                        session_manager.save_dialogue(user_id, session_id, messages_dict, response, body.is_teacher)
-                        print(f"保存完整对话记录: 用户消息 {len(current_messages)} 条 + 助手回复 1 条")
-                    except Exception as e:
-                        print(f"Error saving dialogue: {e}")
+                # 添加用户消息
+                for msg in current_messages:
+                    messages_dict.append({
+                        "role": msg.role,
+                        "content": msg.content,
+                        "raw": getattr(msg, 'raw', False)
+                    })
                 
-                if not stream:
-                    yield json.dumps(
-                        {
-                            "object": (
-                                "chat.completion" if chat_mode else "text_completion"
-                            ),
-                            "model": model.name,
-                            "choices": [
-                                (
-                                    {
-                                        "message": {"role": "assistant", "content": response},
-                                        "finish_reason": "stop",
-                                        "index": 0,
-                                    }
-                                    if chat_mode
-                                    else {
-                                        "text": response,
-                                        "finish_reason": "stop",
-                                        "index": 0,
-                                    }
-                                )
-                            ],
-                            "usage": {
-                                "prompt_tokens": prompt_tokens,
-                                "completion_tokens": completion_tokens,
-                                "total_tokens": prompt_tokens + completion_tokens,
-                            },
-                        },
-                        ensure_ascii=False
-                    )
+                # 添加助手回复
+                messages_dict.append({
+                    "role": "assistant",
+                    "content": response,
+                    "raw": False
+                })
+                
+                # 保存完整的对话记录
+                session_manager.save_dialogue(user_id, session_id, messages_dict, response, body.is_teacher)
+                print(f"保存完整对话记录: 用户消息 {len(current_messages)} 条 + 助手回复 1 条")
             except Exception as e:
-                print(f"Generation error: {e}")
-                if not stream:
-                    yield json.dumps(
-                        {
-                            "error": {
-                                "message": f"Generation error: {str(e)}",
-                                "type": "generation_error",
+                print(f"Error saving dialogue: {e}")
+        
+        if not stream:
+            yield json.dumps(
+                {
+                    "object": (
+                        "chat.completion" if chat_mode else "text_completion"
+                    ),
+                    "model": model.name,
+                    "choices": [
+                        (
+                            {
+                                "message": {"role": "assistant", "content": choice},
+                                "finish_reason": "stop",
+                                "index": index,
                             }
-                        },
-                        ensure_ascii=False
-                    )
-            finally:
-                requests_num = requests_num - 1
-                quick_log(
-                    request,
-                    None,
-                    "Generation Complete. RequestsNum: " + str(requests_num),
-                )
+                            if chat_mode
+                            else {
+                                "text": choice,
+                                "finish_reason": "stop",
+                                "index": index,
+                            }
+                        )
+                        for index, choice in enumerate(responses)
+                    ],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    },
+                },
+                ensure_ascii=False
+            )
+    except HTTPException as e:
+        # 排队已满/超时：非流式请求直接返回对应的状态码和Retry-After，流式请求推送error事件
+        if not stream:
+            raise
+        print(f"Generation error: {e.detail}")
+        yield stream_error_event(e)
+    except Exception as e:
+        print(f"Generation error: {e}")
+        if stream:
+            yield stream_error_event(e)
+        else:
+            yield json.dumps(
+                {
+                    "error": {
+                        "message": f"Generation error: {str(e)}",
+                        "type": "generation_error",
+                    }
+                },
+                ensure_ascii=False
+            )
+    finally:
+        for t in tasks:
+            t.cancel()
+        requests_num = requests_num - 1
+        quick_log(
+            request,
+            None,
+            "Generation Complete. RequestsNum: " + str(requests_num),
+        )
 
 
 def chat_template(
     model: TextRWKV, body: ChatCompletionBody, interface: str, user: str, bot: str
 ):
+    prompt = chat_history_template(body, interface, user, bot)
+
+    if body.messages:
+        prompt += chat_message_template(body, body.messages[-1], user, bot, True)
+    
+    # 添加回答提示
+    if len(body.messages) > 1:
+        prompt += f"请基于上述对话历史回答当前问题：\n{body.assistant_name or bot}: "
+    else:
+        prompt += f"{body.assistant_name or bot}: "
+    return prompt
+
+
+def chat_history_template(
+    body: ChatCompletionBody, interface: str, user: str, bot: str
+) -> str:
+    """
+    prompt中当前消息之前的部分，下一轮对话的prompt以同样的文本开头
+    """
     prompt = ""
     if body.presystem:
         prompt += f"{interface}\n\n"
@@ -416,28 +561,44 @@ def chat_template(
         prompt += "以下是我们的对话历史，如果有需要的话，请基于历史对话来回答当前问题：\n\n"
     
     if body.messages:
-        for i, message in enumerate(body.messages):
-            if message.role == "system":
-                prompt += f"{body.system_name or 'System'}: {message.content}\n\n"
-            elif message.role == "user":
-                # 为当前用户消息添加特殊标记
-                if i == len(body.messages) - 1:
-                    prompt += f"【当前问题】{body.user_name or user}: {message.content}\n\n"
-                else:
-                    prompt += f"{body.user_name or user}: {message.content}\n\n"
-            elif message.role == "assistant":
-                prompt += f"{body.assistant_name or bot}: {message.content}\n\n"
-            elif message.role == "tool":
-                prompt += f"Observation: {message.content}\n\n"
-    
-    # 添加回答提示
-    if len(body.messages) > 1:
-        prompt += f"请基于上述对话历史回答当前问题：\n{body.assistant_name or bot}: "
-    else:
-        prompt += f"{body.assistant_name or bot}: "
+        for message in body.messages[:-1]:
+            prompt += chat_message_template(body, message, user, bot, False)
     return prompt
 
 
+def chat_message_template(
+    body: ChatCompletionBody, message, user: str, bot: str, current: bool
+) -> str:
+    if message.role == "system":
+        return f"{body.system_name or 'System'}: {message.content}\n\n"
+    elif message.role == "user":
+        # 为当前用户消息添加特殊标记
+        if current:
+            return f"【当前问题】{body.user_name or user}: {message.content}\n\n"
+        return f"{body.user_name or user}: {message.content}\n\n"
+    elif message.role == "assistant":
+        return f"{body.assistant_name or bot}: {message.content}\n\n"
+    elif message.role == "tool":
+        return f"Observation: {message.content}\n\n"
+    return ""
+
+
+def chat_session_template(
+    body: ChatCompletionBody, interface: str, user: str, bot: str
+) -> Union[SessionPrompt, None]:
+    """
+    会话状态：预填充时保存对话历史（chat_history_template）结束处的状态，
+    下一轮的prompt以同样的历史开头，命中时只预填充之后的消息，
+    命中与否由token前缀判断，预填充的token与完整prompt完全一致。
+    """
+    if not body.messages or len(body.messages) <= 1:
+        return None
+    return SessionPrompt(
+        session_state.session_key(body.user_id, body.session_id, body.is_teacher),
+        chat_history_template(body, interface, user, bot),
+    )
+
+
 @router.post("/v1/chat/completions", tags=["Completions"])
 async def chat_completions(body: ChatCompletionBody, request: Request):
     model: TextRWKV = global_var.get(global_var.Model)
@@ -512,6 +673,7 @@ async def chat_completions(body: ChatCompletionBody, request: Request):
         "user_id": body.user_id,
         "session_id": body.session_id,
         "is_teacher": body.is_teacher,
+        "n": body.n,
     }
     
     # 只在有值时才添加配置参数
@@ -529,11 +691,18 @@ async def chat_completions(body: ChatCompletionBody, request: Request):
     context_body = ChatCompletionBody(**context_body_data)
 
     prompt = chat_template(model, context_body, interface, user, bot)
+    # 上一轮回复后的会话状态仍在缓存中时，只需预填充本轮新消息
+    session = chat_session_template(context_body, interface, user, bot)
     
     print(f"生成的prompt长度: {len(prompt)}")
     print(f"Prompt预览: {prompt[:200]}...")
 
+    # 队列已满时直接返回429和Retry-After
+    scheduler.check_admission(PRIORITY_INTERACTIVE)
+
     if body.stream:
+        # 先入队再创建流，入队失败时客户端收到429和Retry-After而不是空的事件流
+        task = submit_completion(model, context_body, prompt, body.stop, session)
         return EventSourceResponse(
             eval_rwkv_with_context(
                 model,
@@ -546,6 +715,8 @@ async def chat_completions(body: ChatCompletionBody, request: Request):
                 body.user_id,
                 body.session_id,
                 body.messages,  # 只保存当前消息，不包含历史
+                session,
+                task,
             )
         )
     else:
@@ -560,6 +731,7 @@ async def chat_completions(body: ChatCompletionBody, request: Request):
             body.user_id,
             body.session_id,
             body.messages,  # 只保存当前消息，不包含历史
+            session,
         ):
             return response
 
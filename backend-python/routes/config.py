@@ -5,6 +5,11 @@ from fastapi import APIRouter, HTTPException, Request, Response, status as Statu
 from pydantic import BaseModel
 from utils.rwkv import *
 from utils.torch import *
+from utils.scheduler import scheduler
+from utils.session_state import session_state
+from utils.lesson_state import lesson_state
+from utils.state_preset import state_presets
+from utils.knowledge import model_registry
 import global_var
 import torch
 
@@ -44,7 +49,12 @@ def switch_model(body: SwitchModelBody, response: Response, request: Request):
         return
 
     global_var.set(global_var.Model_Status, global_var.ModelStatus.Offline)
+    # 保存当前模型的前缀状态缓存，下次加载同一模型时直接命中
+    state_cache.persist_state(global_var.get(global_var.Model))
     global_var.set(global_var.Model, None)
+    session_state.clear()
+    lesson_state.clear()
+    state_presets.clear()
     torch_gc()
 
     if body.model == "":
@@ -85,6 +95,8 @@ def switch_model(body: SwitchModelBody, response: Response, request: Request):
             Status.HTTP_500_INTERNAL_SERVER_ERROR, f"failed to load: {e}"
         )
 
+    state_cache.restore_state(global_var.get(global_var.Model))
+
     if body.deploy:
         global_var.set(global_var.Deploy_Mode, True)
 
@@ -146,6 +158,11 @@ def status():
         "status": global_var.get(global_var.Model_Status),
         "pid": os.getpid(),
         "device_name": device_name,
-        "model_path": model_path  # 返回模型路径
+        "model_path": model_path,  # 返回模型路径
+        "inference_queue": scheduler.stats(),  # 推理队列深度
+        "session_state": session_state.stats(),  # 会话状态缓存占用
+        "lesson_state": lesson_state.stats(),  # 课时状态缓存占用
+        "state_presets": state_presets.stats(),  # 常驻的state微调文件
+        "retrieval_models": model_registry.stats(),  # 检索模型是否已加载预热
     }
 
@@ -5,22 +5,19 @@ from fastapi import APIRouter, HTTPException, status, Request
 from pydantic import BaseModel, Field
 from typing import Union, Optional, List, Dict, Any
 import asyncio
-from threading import Lock
 from datetime import datetime
 from docx import Document
 from docx.shared import Inches
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 
 from utils.rwkv import *
+from utils.scheduler import scheduler, PRIORITY_BATCH
 from utils.knowledge import load_vector_db, search_knowledge_db, ChromaDBManager
 import global_var
 from config.settings import get_settings
 
 router = APIRouter()
 
-# 全局锁，用于控制并发请求
-create_lock = Lock()
-
 
 class CreateOutlineBody(BaseModel):
     user_id: Union[str, int] = Field(..., description="用户ID，用于确定存储路径")
@@ -83,7 +80,7 @@ def get_lesson_content_from_chromadb(user_id: str, course_id: str, lesson_num: s
         
         # 获取collection中的所有文档
         try:
-            collection = chroma_manager.client.get_collection(collection_name)
+            collection = chroma_manager.get_collection(collection_name)
             
             # 获取所有文档
             results = collection.get(include=['documents'])
@@ -293,14 +290,9 @@ async def generate_outline_with_rwkv(prompt: str, request: Request, max_words: i
         if model is None:
             raise Exception("RWKV模型未初始化")
         
-        # 设置生成参数
-        model.temperature = 0.7
-        model.top_p = 0.9
-        
-        # 重要：临时增加max_tokens_per_generation以支持更长的生成
-        original_max_tokens = model.max_tokens_per_generation
+        # 生成参数只对本次请求生效，不修改共享的模型配置
         max_tokens = 3000  # 设置最大token数
-        model.max_tokens_per_generation = max_tokens
+        sampling = {"temperature": 0.7, "top_p": 0.9, "max_tokens": max_tokens}
         
         # 生成大纲内容
         outline_content = ""
@@ -312,40 +304,41 @@ async def generate_outline_with_rwkv(prompt: str, request: Request, max_words: i
         print(f"最大token数: {max_tokens}")
         print(f"目标字数: {max_words}")
         print(f"最小字数: {min_words}")
-        print(f"模型原始max_tokens_per_generation: {original_max_tokens}")
-        print(f"临时设置为: {model.max_tokens_per_generation}")
         
         # 设置停止条件
         stop_sequences = ["###", "---", "问题", "题目", "结束", "完毕"]
         
         print("开始生成循环...")
-        for response, delta, _, _ in model.generate(prompt, stop=stop_sequences):
-            outline_content += delta
-            token_count += 1
-            
-                        # 每100个token打印一次进度
-            if token_count % 100 == 0:
-                current_words = len([c for c in outline_content if '\u4e00' <= c <= '\u9fff'])
-                print(f"已生成 {token_count} tokens, 当前内容长度: {len(outline_content)} 字符, 字数: {current_words}")
+        current_words = 0
+        # 在推理线程上生成，断开连接时取消任务
+        task = scheduler.submit(model, prompt, stop_sequences, PRIORITY_BATCH, sampling=sampling)
+        try:
+            async for response, delta, _, _ in task:
+                outline_content += delta
+                token_count += 1
+                # 只统计新增内容的字数，避免每个token重新扫描全文
+                current_words += len([c for c in delta if '\u4e00' <= c <= '\u9fff'])
             
-            # 检查请求是否断开
-            if await request.is_disconnected():
-                print("请求已断开")
-                break
+                            # 每100个token打印一次进度
+                if token_count % 100 == 0:
+                    print(f"已生成 {token_count} tokens, 当前内容长度: {len(outline_content)} 字符, 字数: {current_words}")
             
-            # 检查是否达到最大token数
-            if token_count >= max_tokens:
-                print(f"达到最大token数: {max_tokens}")
-                break
+                # 检查请求是否断开
+                if await request.is_disconnected():
+                    print("请求已断开")
+                    break
             
-            # 检查字数限制
-            current_words = len([c for c in outline_content if '\u4e00' <= c <= '\u9fff'])
-            if current_words >= max_words * 1.2:  # 允许超出20%的字数
-                print(f"达到字数限制 {current_words} >= {max_words * 1.2}")
-                break
+                # 检查是否达到最大token数
+                if token_count >= max_tokens:
+                    print(f"达到最大token数: {max_tokens}")
+                    break
             
-        # 恢复原始设置
-        model.max_tokens_per_generation = original_max_tokens
+                # 检查字数限制
+                if current_words >= max_words * 1.2:  # 允许超出20%的字数
+                    print(f"达到字数限制 {current_words} >= {max_words * 1.2}")
+                    break
+        finally:
+            task.cancel()
         
         # 确保句子完整性
         outline_content = ensure_sentence_completeness(outline_content)
@@ -366,13 +359,6 @@ async def generate_outline_with_rwkv(prompt: str, request: Request, max_words: i
         
     except Exception as e:
         print(f"RWKV生成大纲时出错: {e}")
-        # 确保在出错时也恢复原始设置
-        try:
-            model = global_var.get(global_var.Model)
-            if model:
-                model.max_tokens_per_generation = original_max_tokens
-        except:
-            pass
         raise e
 
 
@@ -383,9 +369,8 @@ async def generate_outline_with_rwkv_retry(prompt: str, request: Request, max_wo
     try:
         print("开始重试生成教学大纲...")
         
-        # 临时设置max_tokens_per_generation
-        original_max_tokens = model.max_tokens_per_generation
-        model.max_tokens_per_generation = max_tokens
+        # 生成参数只对本次请求生效
+        sampling = {"temperature": 0.7, "top_p": 0.9, "max_tokens": max_tokens}
         
         outline_content = ""
         token_count = 0
@@ -393,30 +378,33 @@ async def generate_outline_with_rwkv_retry(prompt: str, request: Request, max_wo
         # 设置停止条件
         stop_sequences = ["###", "---", "问题", "题目", "结束", "完毕"]
         
-        for response, delta, _, _ in model.generate(prompt, stop=stop_sequences):
-            outline_content += delta
-            token_count += 1
+        current_words = 0
+        # 在推理线程上生成，断开连接时取消任务
+        task = scheduler.submit(model, prompt, stop_sequences, PRIORITY_BATCH, sampling=sampling)
+        try:
+            async for response, delta, _, _ in task:
+                outline_content += delta
+                token_count += 1
             
-            # 计算当前字数（中文字符）
-            current_words = len([c for c in outline_content if '\u4e00' <= c <= '\u9fff'])
+                # 计算当前字数（中文字符），只统计新增内容
+                current_words += len([c for c in delta if '\u4e00' <= c <= '\u9fff'])
             
-            # 检查token数量限制
-            if token_count >= max_tokens:
-                print(f"重试达到最大token限制 {max_tokens}")
-                break
+                # 检查token数量限制
+                if token_count >= max_tokens:
+                    print(f"重试达到最大token限制 {max_tokens}")
+                    break
             
-            # 检查字数限制
-            if current_words >= max_words * 1.5:  # 重试时允许更多字数
-                print(f"重试达到字数限制 {current_words} >= {max_words * 1.5}")
-                break
+                # 检查字数限制
+                if current_words >= max_words * 1.5:  # 重试时允许更多字数
+                    print(f"重试达到字数限制 {current_words} >= {max_words * 1.5}")
+                    break
             
-            # 检查请求是否断开
-            if await request.is_disconnected():
-                print("请求已断开")
-                break
-        
-        # 恢复原始设置
-        model.max_tokens_per_generation = original_max_tokens
+                # 检查请求是否断开
+                if await request.is_disconnected():
+                    print("请求已断开")
+                    break
+        finally:
+            task.cancel()
         
         # 确保句子完整性
         outline_content = ensure_sentence_completeness(outline_content)
@@ -428,11 +416,6 @@ async def generate_outline_with_rwkv_retry(prompt: str, request: Request, max_wo
         
     except Exception as e:
         print(f"重试生成大纲时出错: {e}")
-        # 确保在出错时也恢复原始设置
-        try:
-            model.max_tokens_per_generation = original_max_tokens
-        except:
-            pass
         raise e
 
 
@@ -483,53 +466,48 @@ async def create_outline(body: CreateOutlineBody, request: Request):
             detail="模型未加载"
         )
     
-    # 检查是否已有生成任务在进行
-    if create_lock.locked():
-        raise HTTPException(
-            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-            detail="已有大纲生成任务在进行中，请稍后再试"
-        )
+    # 推理队列已满时直接返回429和Retry-After
+    scheduler.check_admission(PRIORITY_BATCH)
     
     try:
-        with create_lock:
-            print(f"开始为课时 {body.lesson_num} 生成教学大纲")
-            
-            # 获取课时内容
-            content = get_file_content(body.user_id, body.course_id, body.lesson_num, body.is_teacher)
-            if not content:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail=f"未找到课时 {body.lesson_num} 的内容，请先上传相关文件"
-                )
-            
-            # 生成大纲提示词
-            prompt = generate_outline_prompt(content, body.max_words)
-            
-            # 使用RWKV模型生成大纲
-            outline_content = await generate_outline_with_rwkv(prompt, request, body.max_words)
-            
-            # 保存大纲到文件
-            save_result = save_outline_to_file(body.user_id, body.course_id, body.lesson_num, outline_content, body.is_teacher)
+        print(f"开始为课时 {body.lesson_num} 生成教学大纲")
+        
+        # 获取课时内容
+        content = get_file_content(body.user_id, body.course_id, body.lesson_num, body.is_teacher)
+        if not content:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"未找到课时 {body.lesson_num} 的内容，请先上传相关文件"
+            )
+        
+        # 生成大纲提示词
+        prompt = generate_outline_prompt(content, body.max_words)
+        
+        # 使用RWKV模型生成大纲
+        outline_content = await generate_outline_with_rwkv(prompt, request, body.max_words)
+        
+        # 保存大纲到文件
+        save_result = save_outline_to_file(body.user_id, body.course_id, body.lesson_num, outline_content, body.is_teacher)
+        
+        if save_result["success"]:
+            return {
+                "success": True,
+                "message": "教学大纲生成成功",
+                "user_id": body.user_id,
+                "session_id": body.session_id,
+                "course_id": body.course_id,
+                "lesson_num": body.lesson_num,
+                "is_teacher": body.is_teacher,
+                "outline_content": outline_content[:500] + "..." if len(outline_content) > 500 else outline_content,
+                "download_url": save_result["download_url"],
+                "filename": save_result["filename"]
+            }
+        else:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"保存大纲文件失败: {save_result['error']}"
+            )
             
-            if save_result["success"]:
-                return {
-                    "success": True,
-                    "message": "教学大纲生成成功",
-                    "user_id": body.user_id,
-                    "session_id": body.session_id,
-                    "course_id": body.course_id,
-                    "lesson_num": body.lesson_num,
-                    "is_teacher": body.is_teacher,
-                    "outline_content": outline_content[:500] + "..." if len(outline_content) > 500 else outline_content,
-                    "download_url": save_result["download_url"],
-                    "filename": save_result["filename"]
-                }
-            else:
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail=f"保存大纲文件失败: {save_result['error']}"
-                )
-                
     except HTTPException:
         raise
     except Exception as e:
@@ -5,22 +5,21 @@ from fastapi import APIRouter, HTTPException, status, Request, Response
 from pydantic import BaseModel, Field
 from typing import Union, Optional, List, Dict, Any
 import asyncio
-from threading import Lock
 from datetime import datetime
 import random
 from docx import Document
 from docx.shared import Inches
 
 from utils.rwkv import *
+from utils.scheduler import scheduler, GenerationTask, PRIORITY_BATCH
 from utils.knowledge import load_vector_db, search_knowledge_db, ChromaDBManager
+from utils.lesson_state import LessonPrompt, lesson_prompt
+from utils.lesson_content import get_user_path, get_lesson_content, get_lesson_content_whole, get_lesson_collection_name
 import global_var
 from config.settings import get_settings
 
 router = APIRouter()
 
-# 全局锁，用于控制并发请求
-exercise_lock = Lock()
-
 
 class ExerciseBody(BaseModel):
     user_id: Union[str, int] = Field(..., description="用户ID，用于确定存储路径")
@@ -33,6 +32,7 @@ class ExerciseBody(BaseModel):
     max_tokens: int = Field(2000, description="生成回答的最大token数", ge=500, le=4000)
     temperature: float = Field(0.7, description="生成温度", ge=0.1, le=1.0)
     generation_mode: str = Field("block", description="生成模式：block(按文本块生成)、whole(整体内容生成)")
+    questions_per_block: int = Field(1, description="文本块生成模式下每个文本块生成的题目数，同一块的题目共用一次预填充", ge=1, le=5)
 
     model_config = {
         "json_schema_extra": {
@@ -46,7 +46,8 @@ class ExerciseBody(BaseModel):
                 "difficulty": "medium",
                 "max_tokens": 2000,
                 "temperature": 0.7,
-                "generation_mode": "block"
+                "generation_mode": "block",
+                "questions_per_block": 1
             }
         }
     }
@@ -76,204 +77,6 @@ class ExerciseResponse(BaseModel):
     generation_time: float = Field(0.0, description="生成耗时(秒)")
 
 
-def get_user_path(user_id: str, is_teacher: bool) -> str:
-    """根据userID和isTeacher确定用户路径"""
-    settings = get_settings()
-    if is_teacher:
-        base_dir = settings.TEACHERS_DIR
-    else:
-        base_dir = settings.STUDENTS_DIR
-    return os.path.join(str(base_dir), user_id)
-
-
-def get_lesson_content_from_chromadb(user_id: str, course_id: str, lesson_num: str, is_teacher: bool) -> List[str]:
-    """
-    从ChromaDB知识库获取课时内容，返回文本块列表
-    """
-    print(f"正在从ChromaDB获取课时内容: userID={user_id}, courseId={course_id}, lessonNum={lesson_num}, isTeacher={is_teacher}")
-    
-    try:
-        # 加载向量数据库
-        chroma_manager = load_vector_db(
-            userId=user_id,
-            isTeacher=is_teacher,
-            courseID=course_id,
-            lessonNum=lesson_num,
-            isAsk=False      # 不是ask文件
-        )
-        
-        if not chroma_manager:
-            print("ChromaDB知识库不存在")
-            return None
-        
-        # 生成collection名称
-        collection_name = f"kb_{user_id}_{course_id}_{lesson_num}"
-        
-        # 获取collection中的所有文档
-        try:
-            collection = chroma_manager.client.get_collection(collection_name)
-            
-            # 获取所有文档（这里我们需要获取所有文档，所以使用一个通用的查询）
-            # 由于ChromaDB没有直接获取所有文档的API，我们使用一个技巧
-            # 先获取一个文档的embedding，然后用它来查询所有文档
-            results = collection.get(include=['documents'])
-            
-            if results and results['documents']:
-                text_blocks = results['documents']
-                print(f"成功从ChromaDB获取 {len(text_blocks)} 个文本块")
-                return text_blocks
-            else:
-                print("ChromaDB中没有找到文档")
-                return None
-                
-        except Exception as e:
-            print(f"从ChromaDB获取文档失败: {e}")
-            return None
-            
-    except Exception as e:
-        print(f"加载ChromaDB知识库失败: {e}")
-        return None
-
-
-def get_lesson_content_whole_from_chromadb(user_id: str, course_id: str, lesson_num: str, is_teacher: bool) -> str:
-    """
-    从ChromaDB知识库获取课时内容，返回合并的文本内容
-    """
-    print(f"正在从ChromaDB获取课时内容: userID={user_id}, courseId={course_id}, lessonNum={lesson_num}, isTeacher={is_teacher}")
-    
-    text_blocks = get_lesson_content_from_chromadb(user_id, course_id, lesson_num, is_teacher)
-    
-    if text_blocks:
-        # 合并文本块
-        combined_content = "\n\n".join(text_blocks)
-        print(f"成功从ChromaDB获取课时内容，总长度: {len(combined_content)} 字符")
-        return combined_content
-    
-    print("无法从ChromaDB获取课时内容")
-    return None
-
-
-def get_lesson_content_fallback(user_id: str, course_id: str, lesson_num: str, is_teacher: bool) -> List[str]:
-    """
-    备用方案：从文件系统获取课时内容
-    """
-    print(f"使用备用方案从文件系统获取课时内容: userID={user_id}, courseId={course_id}, lessonNum={lesson_num}, isTeacher={is_teacher}")
-    
-    # 获取用户路径
-    user_path = get_user_path(user_id, is_teacher)
-    
-    # 构建文件路径
-    lesson_path = os.path.join(user_path, course_id, lesson_num)
-    if not os.path.exists(lesson_path):
-        print(f"课时路径不存在: {lesson_path}")
-        return None
-    
-    # 读取课时文件夹中的所有文件
-    text_blocks = read_files_as_blocks(lesson_path)
-    if text_blocks:
-        print("成功从文件系统获取课时内容")
-        return text_blocks
-    
-    print("无法从文件系统获取课时内容")
-    return None
-
-
-def get_lesson_content_whole_fallback(user_id: str, course_id: str, lesson_num: str, is_teacher: bool) -> str:
-    """
-    备用方案：从文件系统获取课时内容，返回合并的文本
-    """
-    text_blocks = get_lesson_content_fallback(user_id, course_id, lesson_num, is_teacher)
-    
-    if text_blocks:
-        # 合并文本块
-        combined_content = "\n\n".join(text_blocks)
-        print(f"成功从文件系统获取课时内容，总长度: {len(combined_content)} 字符")
-        return combined_content
-    
-    return None
-
-
-def get_lesson_content(user_id: str, course_id: str, lesson_num: str, is_teacher: bool) -> List[str]:
-    """
-    获取课时内容，优先从ChromaDB获取，失败则从文件系统获取
-    返回文本块列表
-    """
-    # 首先尝试从ChromaDB获取
-    text_blocks = get_lesson_content_from_chromadb(user_id, course_id, lesson_num, is_teacher)
-    if text_blocks:
-        return text_blocks
-    
-    # 如果ChromaDB获取失败，使用备用方案
-    return get_lesson_content_fallback(user_id, course_id, lesson_num, is_teacher)
-
-
-def get_lesson_content_whole(user_id: str, course_id: str, lesson_num: str, is_teacher: bool) -> str:
-    """
-    获取课时内容，优先从ChromaDB获取，失败则从文件系统获取
-    返回合并的文本内容
-    """
-    # 首先尝试从ChromaDB获取
-    combined_content = get_lesson_content_whole_from_chromadb(user_id, course_id, lesson_num, is_teacher)
-    if combined_content:
-        return combined_content
-    
-    # 如果ChromaDB获取失败，使用备用方案
-    return get_lesson_content_whole_fallback(user_id, course_id, lesson_num, is_teacher)
-
-
-def read_files_as_blocks(folder_path: str) -> List[str]:
-    """
-    读取文件夹中的所有文本文件内容，返回文本块列表
-    """
-    print(f"正在读取文件夹内容: {folder_path}")
-    
-    if not os.path.exists(folder_path):
-        print(f"文件夹不存在: {folder_path}")
-        return None
-    
-    text_blocks = []
-    supported_extensions = ['.txt', '.md', '.docx', '.pdf']
-    
-    try:
-        for filename in os.listdir(folder_path):
-            file_path = os.path.join(folder_path, filename)
-            
-            # 跳过目录和隐藏文件
-            if os.path.isdir(file_path) or filename.startswith('.'):
-                continue
-            
-            # 检查文件扩展名
-            file_ext = os.path.splitext(filename)[1].lower()
-            if file_ext not in supported_extensions:
-                continue
-            
-            try:
-                if file_ext == '.txt' or file_ext == '.md':
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                        if content.strip():
-                            # 按段落分割文本块
-                            paragraphs = [p.strip() for p in content.split('\n\n') if p.strip()]
-                            text_blocks.extend(paragraphs)
-                            print(f"成功读取文件: {filename}，分割为 {len(paragraphs)} 个文本块")
-                # 对于其他格式的文件，可以添加相应的处理逻辑
-                
-            except Exception as e:
-                print(f"读取文件 {filename} 时出错: {e}")
-                continue
-        
-        if text_blocks:
-            print(f"成功读取 {len(text_blocks)} 个文本块")
-            return text_blocks
-        else:
-            print("未找到可读取的文本文件")
-            return None
-            
-    except Exception as e:
-        print(f"读取文件夹时出错: {e}")
-        return None
-
-
 def generate_exercise_prompt_for_block(content: str, block_index: int, difficulty: str) -> str:
     """
     为单个文本块生成习题的提示词
@@ -305,15 +108,21 @@ D. [选项D]
     return prompt
 
 
-async def generate_exercises_for_blocks(text_blocks: List[str], request: Request, max_tokens: int, temperature: float, difficulty: str) -> List[str]:
+async def generate_exercises_for_blocks(text_blocks: List[str], request: Request, max_tokens: int, temperature: float, difficulty: str, question_count: int = None, questions_per_block: int = 1) -> List[str]:
     """
-    为每个文本块生成一道习题
+    为每个文本块生成习题，每块questions_per_block道：同一块的多道题共用一次预填充，分别采样
     """
     print(f"开始为 {len(text_blocks)} 个文本块生成习题...")
     
     exercises = []
+    if question_count is None:
+        question_count = len(text_blocks) * questions_per_block
     
     for i, block in enumerate(text_blocks):
+        # 最后一块只生成剩余的题目数
+        n = min(questions_per_block, question_count - len(exercises))
+        if n <= 0:
+            break
         print(f"正在为文本块 {i+1}/{len(text_blocks)} 生成习题...")
         print(f"文本块长度: {len(block)} 字符")
         print(f"文本块预览: {block[:200]}...")
@@ -324,27 +133,30 @@ async def generate_exercises_for_blocks(text_blocks: List[str], request: Request
             print(f"生成的提示词长度: {len(prompt)} 字符")
             
             # 生成习题
-            exercise = await generate_exercises_with_rwkv(
+            candidates = await generate_exercise_candidates_with_rwkv(
                 prompt, 
                 request, 
                 max_tokens, 
-                temperature
+                temperature,
+                n
             )
             
-            # 验证生成的习题
-            if not exercise or len(exercise.strip()) == 0:
-                print(f"⚠️ 警告：文本块 {i+1} 生成的习题为空")
-                exercise = f"题目{i+1}生成失败: 生成的内容为空"
-            
-            exercises.append(exercise)
-            print(f"文本块 {i+1} 习题生成完成，长度: {len(exercise)} 字符")
+            for exercise in candidates:
+                # 验证生成的习题
+                if not exercise or len(exercise.strip()) == 0:
+                    print(f"⚠️ 警告：文本块 {i+1} 生成的习题为空")
+                    exercise = f"题目{len(exercises)+1}生成失败: 生成的内容为空"
+                
+                exercises.append(exercise)
+            print(f"文本块 {i+1} 习题生成完成，共 {len(candidates)} 道")
             
         except Exception as e:
             print(f"为文本块 {i+1} 生成习题时出错: {e}")
             import traceback
             traceback.print_exc()
             # 如果某个文本块生成失败，添加错误信息
-            exercises.append(f"题目{i+1}生成失败: {str(e)}")
+            for _ in range(n):
+                exercises.append(f"题目{len(exercises)+1}生成失败: {str(e)}")
     
     # 验证生成的习题列表
     if not exercises or len(exercises) == 0:
@@ -355,23 +167,11 @@ async def generate_exercises_for_blocks(text_blocks: List[str], request: Request
     return exercises
 
 
-def generate_exercise_prompt(content: str, question_count: int, difficulty: str) -> str:
+def generate_exercise_format(question_count: int) -> str:
     """
-    生成习题的提示词
+    整体出题的格式要求
     """
-    difficulty_map = {
-        "easy": "简单",
-        "medium": "中等", 
-        "hard": "困难"
-    }
-    
-    difficulty_text = difficulty_map.get(difficulty, "中等")
-    
-    prompt = f"""基于以下内容生成{question_count}道{difficulty_text}难度的单选题：
-
-{content}
-
-严格按照以下格式生成，不要添加任何其他内容：
+    return f"""严格按照以下格式生成，不要添加任何其他内容：
 
 题目1：
 题干：[题干内容]
@@ -395,9 +195,66 @@ D. [选项D]
 
 [继续生成剩余题目，必须生成{question_count}道题目，每道题都要完整包含题干、选项、正确答案、解析和知识点]"""
 
+
+def generate_exercise_prompt(content: str, question_count: int, difficulty: str) -> str:
+    """
+    生成习题的提示词
+    """
+    difficulty_map = {
+        "easy": "简单",
+        "medium": "中等", 
+        "hard": "困难"
+    }
+    
+    difficulty_text = difficulty_map.get(difficulty, "中等")
+    
+    prompt = f"""基于以下内容生成{question_count}道{difficulty_text}难度的单选题：
+
+{content}
+
+{generate_exercise_format(question_count)}"""
+
     return prompt
 
 
+def generate_exercise_instructions(question_count: int, difficulty: str) -> str:
+    """
+    整体出题的要求部分，接在课时内容之后，课时内容的预填充状态可以复用
+    """
+    difficulty_map = {
+        "easy": "简单",
+        "medium": "中等", 
+        "hard": "困难"
+    }
+    
+    difficulty_text = difficulty_map.get(difficulty, "中等")
+    
+    return f"""请基于上述课时内容生成{question_count}道{difficulty_text}难度的单选题。
+
+{generate_exercise_format(question_count)}"""
+
+
+def warm_lesson_state(user_id: str, course_id: str, lesson_num: str, is_teacher: bool) -> bool:
+    """
+    上传课时文件后预填充课时内容，之后的问答和整体出题直接从该状态开始
+    """
+    model = global_var.get(global_var.Model)
+    if model is None:
+        return False
+    content = get_lesson_content_whole(user_id, course_id, lesson_num, is_teacher)
+    lesson = lesson_prompt(get_lesson_collection_name(user_id, course_id, lesson_num), content, "")
+    if lesson is None:
+        return False
+    try:
+        # 只预填充不生成，按批量任务排队，不影响正在进行的对话
+        scheduler.submit(model, lesson.prompt, None, PRIORITY_BATCH, lesson=lesson, prefill_only=True)
+    except HTTPException as e:
+        print(f"课时状态预填充未排队: {e.detail}")
+        return False
+    print(f"课时状态预填充已排队: {lesson.key}")
+    return True
+
+
 def save_exercises_to_file(user_id: str, course_id: str, lesson_num: str, exercises: List[Dict], is_teacher: bool) -> dict:
     """
     将生成的习题保存到文件
@@ -606,9 +463,17 @@ def save_exercises_to_docx(user_id: str, course_id: str, lesson_num: str, exerci
         }
 
 
-async def generate_exercises_with_rwkv(prompt: str, request: Request, max_tokens: int, temperature: float):
+async def generate_exercises_with_rwkv(prompt: str, request: Request, max_tokens: int, temperature: float, lesson: Union[LessonPrompt, None] = None):
+    """
+    使用RWKV模型生成习题，lesson不为空时从课时状态开始，只预填充出题要求
     """
-    使用RWKV模型生成习题
+    candidates = await generate_exercise_candidates_with_rwkv(prompt, request, max_tokens, temperature, 1, lesson)
+    return candidates[0]
+
+
+async def generate_exercise_candidates_with_rwkv(prompt: str, request: Request, max_tokens: int, temperature: float, n: int = 1, lesson: Union[LessonPrompt, None] = None) -> List[str]:
+    """
+    使用RWKV模型生成n份习题：提示词只预填充一次，之后复制状态分别采样
     """
     print("开始使用RWKV模型生成习题...")
     print(f"提示词长度: {len(prompt)} 字符")
@@ -620,23 +485,13 @@ async def generate_exercises_with_rwkv(prompt: str, request: Request, max_tokens
         if model is None:
             raise Exception("RWKV模型未初始化")
         
-        # 设置生成参数
-        model.temperature = temperature
-        model.top_p = 0.9
-        
-        # 重要：临时增加max_tokens_per_generation以支持更长的生成
-        original_max_tokens = model.max_tokens_per_generation
-        model.max_tokens_per_generation = max_tokens
-        
-        # 生成回答内容
-        answer_content = ""
-        token_count = 0
+        # 生成参数只对本次请求生效，不修改共享的模型配置
+        sampling = {"temperature": temperature, "top_p": 0.9, "max_tokens": max_tokens}
         
         print("开始生成习题...")
         print(f"最大token数: {max_tokens}")
         print(f"温度参数: {temperature}")
-        print(f"模型原始max_tokens_per_generation: {original_max_tokens}")
-        print(f"临时设置为: {model.max_tokens_per_generation}")
+        print(f"候选数量: {n}")
         
         # 移除所有停止条件，让模型完整生成
         stop_sequences = []
@@ -644,95 +499,124 @@ async def generate_exercises_with_rwkv(prompt: str, request: Request, max_tokens
         print("开始生成循环...")
         generation_start_time = datetime.now()
         
-        for response, delta, _, _ in model.generate(prompt, stop=stop_sequences):
-            answer_content += delta
-            token_count += 1
-            
-            # 每100个token打印一次进度
-            if token_count % 100 == 0:
-                print(f"已生成 {token_count} tokens, 当前内容长度: {len(answer_content)} 字符")
-            
-            # 检查请求是否断开
-            if await request.is_disconnected():
-                print("请求已断开")
-                break
-            
-            # 检查是否达到最大token数
-            if token_count >= max_tokens:
-                print(f"达到最大token数: {max_tokens}")
-                break
-        
-        # 恢复原始设置
-        model.max_tokens_per_generation = original_max_tokens
+        # 在推理线程上生成，断开连接时取消任务；n>1时各候选共用一次预填充，
+        # 一次最多复制到批处理上限，超出的部分分组提交
+        max_n = scheduler.max_completions(PRIORITY_BATCH)
+        tasks = []
+        try:
+            for start in range(0, n, max_n):
+                task = scheduler.submit(model, prompt, stop_sequences, PRIORITY_BATCH, lesson=lesson, n=min(max_n, n - start), sampling=sampling)
+                tasks += [task] + task.forks
+            outputs = await asyncio.gather(
+                *[collect_exercise_output(t, request, max_tokens) for t in tasks]
+            )
+        finally:
+            for t in tasks:
+                t.cancel()
         
         generation_end_time = datetime.now()
         generation_duration = (generation_end_time - generation_start_time).total_seconds()
-        
-        print(f"习题生成完成，生成长度: {len(answer_content)} 字符")
-        print(f"实际生成token数: {token_count}")
         print(f"生成耗时: {generation_duration:.2f}秒")
-        print(f"内容预览: {answer_content[:500]}...")
-        
-        # 检查生成的内容是否为空
-        if not answer_content or len(answer_content.strip()) == 0:
-            print("⚠️ 错误：RWKV模型生成的内容为空")
-            raise Exception("模型生成的内容为空，请检查模型状态和参数设置")
-        
-        # 检查生成的内容是否太短
-        if len(answer_content.strip()) < 50:
-            print("⚠️ 警告：生成的内容过短，可能存在问题")
-            print(f"内容长度: {len(answer_content)} 字符")
-            print(f"内容: {answer_content}")
-            
-            # 如果内容太短，尝试重新生成
-            if token_count < max_tokens * 0.5:  # 如果只用了不到一半的token
-                print("尝试继续生成更多内容...")
-                # 这里可以添加重试逻辑，但为了简单起见，我们继续使用当前内容
-        
-        # 清理生成的内容（可选，如果清理后内容为空则使用原始内容）
-        try:
-            cleaned_content = clean_generated_content(answer_content)
-            
-            # 检查清理后的内容
-            if not cleaned_content or len(cleaned_content.strip()) == 0:
-                print("⚠️ 警告：清理后内容为空，使用原始内容")
-                cleaned_content = answer_content.strip()
-            
-            # 如果清理后的内容太短，使用原始内容
-            if len(cleaned_content.strip()) < 30:  # 降低阈值
-                print("⚠️ 警告：清理后内容过短，使用原始内容")
-                cleaned_content = answer_content.strip()
-                
-        except Exception as e:
-            print(f"清理内容时出错: {e}")
-            print("使用原始内容")
-            cleaned_content = answer_content.strip()
-        
-        # 最终验证：确保返回的内容不为空
-        if not cleaned_content or len(cleaned_content.strip()) == 0:
-            print("⚠️ 错误：最终内容为空，使用原始内容")
-            cleaned_content = answer_content.strip()
-        
-        print(f"最终返回内容长度: {len(cleaned_content)} 字符")
-        print(f"最终内容预览: {cleaned_content[:300]}...")
         
-        return cleaned_content
+        candidates = []
+        for answer_content, token_count in outputs:
+            try:
+                candidates.append(finalize_exercise_content(answer_content, token_count, max_tokens))
+            except Exception as e:
+                # 多个候选时，一个候选为空不影响其他候选
+                if n == 1:
+                    raise
+                print(f"⚠️ 候选习题无效: {e}")
+                candidates.append("")
+        return candidates
         
     except Exception as e:
         print(f"RWKV生成习题时出错: {e}")
         import traceback
         traceback.print_exc()
-        
-        # 确保在出错时也恢复原始设置
-        try:
-            model = global_var.get(global_var.Model)
-            if model:
-                model.max_tokens_per_generation = original_max_tokens
-        except:
-            pass
         raise e
 
 
+async def collect_exercise_output(task: GenerationTask, request: Request, max_tokens: int):
+    """
+    读取一个生成任务的全部输出，返回(内容, token数)
+    """
+    answer_content = ""
+    token_count = 0
+    async for response, delta, _, _ in task:
+        answer_content += delta
+        token_count += 1
+    
+        # 每100个token打印一次进度
+        if token_count % 100 == 0:
+            print(f"已生成 {token_count} tokens, 当前内容长度: {len(answer_content)} 字符")
+    
+        # 检查请求是否断开
+        if await request.is_disconnected():
+            print("请求已断开")
+            break
+    
+        # 检查是否达到最大token数
+        if token_count >= max_tokens:
+            print(f"达到最大token数: {max_tokens}")
+            break
+    return answer_content, token_count
+
+
+def finalize_exercise_content(answer_content: str, token_count: int, max_tokens: int) -> str:
+    """
+    检查并清理一份生成的习题内容
+    """
+    print(f"习题生成完成，生成长度: {len(answer_content)} 字符")
+    print(f"实际生成token数: {token_count}")
+    print(f"内容预览: {answer_content[:500]}...")
+    
+    # 检查生成的内容是否为空
+    if not answer_content or len(answer_content.strip()) == 0:
+        print("⚠️ 错误：RWKV模型生成的内容为空")
+        raise Exception("模型生成的内容为空，请检查模型状态和参数设置")
+    
+    # 检查生成的内容是否太短
+    if len(answer_content.strip()) < 50:
+        print("⚠️ 警告：生成的内容过短，可能存在问题")
+        print(f"内容长度: {len(answer_content)} 字符")
+        print(f"内容: {answer_content}")
+        
+        # 如果内容太短，尝试重新生成
+        if token_count < max_tokens * 0.5:  # 如果只用了不到一半的token
+            print("尝试继续生成更多内容...")
+            # 这里可以添加重试逻辑，但为了简单起见，我们继续使用当前内容
+    
+    # 清理生成的内容（可选，如果清理后内容为空则使用原始内容）
+    try:
+        cleaned_content = clean_generated_content(answer_content)
+        
+        # 检查清理后的内容
+        if not cleaned_content or len(cleaned_content.strip()) == 0:
+            print("⚠️ 警告：清理后内容为空，使用原始内容")
+            cleaned_content = answer_content.strip()
+        
+        # 如果清理后的内容太短，使用原始内容
+        if len(cleaned_content.strip()) < 30:  # 降低阈值
+            print("⚠️ 警告：清理后内容过短，使用原始内容")
+            cleaned_content = answer_content.strip()
+            
+    except Exception as e:
+        print(f"清理内容时出错: {e}")
+        print("使用原始内容")
+        cleaned_content = answer_content.strip()
+    
+    # 最终验证：确保返回的内容不为空
+    if not cleaned_content or len(cleaned_content.strip()) == 0:
+        print("⚠️ 错误：最终内容为空，使用原始内容")
+        cleaned_content = answer_content.strip()
+    
+    print(f"最终返回内容长度: {len(cleaned_content)} 字符")
+    print(f"最终内容预览: {cleaned_content[:300]}...")
+    
+    return cleaned_content
+
+
 def clean_generated_content(content: str) -> str:
     """
     清理生成的内容，移除不相关的部分
@@ -817,13 +701,12 @@ async def generate_with_rwkv_retry(prompt: str, request: Request, max_tokens: in
         try:
             print(f"RWKV生成尝试 {retry_count + 1}/{max_retries}")
             
-            # 设置模型参数
-            model.temperature = generation_config.get("temperature", 0.7)
-            model.top_p = generation_config.get("top_p", 0.9)
-            
-            # 重要：临时增加max_tokens_per_generation以支持更长的生成
-            original_max_tokens = model.max_tokens_per_generation
-            model.max_tokens_per_generation = max_tokens
+            # 生成参数只对本次请求生效，不修改共享的模型配置
+            sampling = {
+                "temperature": generation_config.get("temperature", 0.7),
+                "top_p": generation_config.get("top_p", 0.9),
+                "max_tokens": max_tokens
+            }
             
             # 生成回答内容
             answer_content = ""
@@ -832,22 +715,24 @@ async def generate_with_rwkv_retry(prompt: str, request: Request, max_tokens: in
             # 停止条件
             stop_sequences = generation_config.get("stop", ["\n\n", "```", "---"])
             
-            for response, delta, _, _ in model.generate(prompt, stop=stop_sequences):
-                answer_content += delta
-                token_count += 1
+            # 在推理线程上生成，断开连接时取消任务
+            task = scheduler.submit(model, prompt, stop_sequences, PRIORITY_BATCH, sampling=sampling)
+            try:
+                async for response, delta, _, _ in task:
+                    answer_content += delta
+                    token_count += 1
                 
-                # 检查请求是否断开
-                if await request.is_disconnected():
-                    print("请求已断开")
-                    break
+                    # 检查请求是否断开
+                    if await request.is_disconnected():
+                        print("请求已断开")
+                        break
                 
-                # 检查是否达到最大token数
-                if token_count >= max_tokens:
-                    print(f"达到最大token数: {max_tokens}")
-                    break
-            
-            # 恢复原始设置
-            model.max_tokens_per_generation = original_max_tokens
+                    # 检查是否达到最大token数
+                    if token_count >= max_tokens:
+                        print(f"达到最大token数: {max_tokens}")
+                        break
+            finally:
+                task.cancel()
             
             # 尝试解析JSON
             try:
@@ -996,186 +881,193 @@ async def generate_exercises(body: ExerciseBody, request: Request):
     print(f"开始生成习题: userID={body.user_id}, courseId={body.course_id}, lessonNum={body.lesson_num}")
     print(f"参数: questionCount={body.question_count}, difficulty={body.difficulty}, generationMode={body.generation_mode}")
     
-    # 检查并发锁
-    if exercise_lock.locked():
-        raise HTTPException(
-            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-            detail="系统繁忙，请稍后重试"
-        )
+    # 推理队列已满时直接返回429和Retry-After
+    scheduler.check_admission(PRIORITY_BATCH)
     
     try:
-        with exercise_lock:
-            if body.generation_mode == "whole":
-                # 整体内容生成模式
-                print("使用整体内容生成模式")
-                
-                # 1. 获取合并的课时内容
-                print("步骤1: 获取课时内容")
-                lesson_content = get_lesson_content_whole(
-                    body.user_id, 
-                    body.course_id, 
-                    body.lesson_num, 
-                    body.is_teacher
+        if body.generation_mode == "whole":
+            # 整体内容生成模式
+            print("使用整体内容生成模式")
+            
+            # 1. 获取合并的课时内容
+            print("步骤1: 获取课时内容")
+            lesson_content = get_lesson_content_whole(
+                body.user_id, 
+                body.course_id, 
+                body.lesson_num, 
+                body.is_teacher
+            )
+            
+            if not lesson_content:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="无法获取课时内容，请确保课时已上传并处理完成"
                 )
-                
-                if not lesson_content:
-                    raise HTTPException(
-                        status_code=status.HTTP_404_NOT_FOUND,
-                        detail="无法获取课时内容，请确保课时已上传并处理完成"
-                    )
-                
-                print(f"课时内容长度: {len(lesson_content)} 字符")
-                
-                # 2. 生成提示词
-                print("步骤2: 生成提示词")
+            
+            print(f"课时内容长度: {len(lesson_content)} 字符")
+            
+            # 2. 生成提示词，课时内容在前，可复用课时状态
+            print("步骤2: 生成提示词")
+            lesson = lesson_prompt(
+                get_lesson_collection_name(body.user_id, body.course_id, body.lesson_num),
+                lesson_content,
+                generate_exercise_instructions(body.question_count, body.difficulty)
+            )
+            if lesson is not None:
+                prompt = lesson.prompt
+            else:
                 prompt = generate_exercise_prompt(
                     lesson_content, 
                     body.question_count, 
                     body.difficulty
                 )
-                
-                # 3. 使用RWKV生成习题
-                print("步骤3: 使用RWKV生成习题")
-                response_text = await generate_exercises_with_rwkv(
-                    prompt, 
-                    request, 
-                    body.max_tokens, 
-                    body.temperature
-                )
-                
-                # 验证生成的内容
-                if not response_text or len(response_text.strip()) == 0:
-                    raise HTTPException(
-                        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                        detail="习题生成失败：生成的内容为空"
-                    )
-                
-                print(f"生成的内容长度: {len(response_text)} 字符")
-                print(f"生成的内容预览: {response_text[:300]}...")
-                
-                # 4. 保存习题到docx文件
-                print("步骤4: 保存习题到docx文件")
-                save_result = save_exercises_to_docx(
-                    body.user_id,
-                    body.course_id,
-                    body.lesson_num,
-                    response_text,
-                    body.is_teacher
-                )
-                
-                if save_result["success"]:
-                    print(f"✅ {save_result['message']}")
-                    print(f"文件大小: {save_result.get('file_size', 'unknown')} 字节")
-                else:
-                    print(f"⚠️ 保存docx文件失败: {save_result['error']}")
-                    # 即使保存失败，也返回生成的内容
-                    print("继续返回生成的内容...")
-                
-                # 5. 返回结果
-                end_time = datetime.now()
-                generation_time = (end_time - start_time).total_seconds()
-                
-                response = ExerciseResponse(
-                    success=True,
-                    message=f"习题生成完成，共生成 {body.question_count} 道题目",
-                    data=response_text,
-                    total_count=body.question_count,
-                    generation_time=generation_time
+            
+            # 3. 使用RWKV生成习题
+            print("步骤3: 使用RWKV生成习题")
+            response_text = await generate_exercises_with_rwkv(
+                prompt, 
+                request, 
+                body.max_tokens, 
+                body.temperature,
+                lesson
+            )
+            
+            # 验证生成的内容
+            if not response_text or len(response_text.strip()) == 0:
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail="习题生成失败：生成的内容为空"
                 )
-                print(f"习题生成完成，耗时: {generation_time:.2f}秒")
-                return response
-                
+            
+            print(f"生成的内容长度: {len(response_text)} 字符")
+            print(f"生成的内容预览: {response_text[:300]}...")
+            
+            # 4. 保存习题到docx文件
+            print("步骤4: 保存习题到docx文件")
+            save_result = save_exercises_to_docx(
+                body.user_id,
+                body.course_id,
+                body.lesson_num,
+                response_text,
+                body.is_teacher
+            )
+            
+            if save_result["success"]:
+                print(f"✅ {save_result['message']}")
+                print(f"文件大小: {save_result.get('file_size', 'unknown')} 字节")
             else:
-                # 文本块生成模式（默认）
-                print("使用文本块生成模式")
-                
-                # 1. 获取课时内容（文本块列表）
-                print("步骤1: 获取课时内容")
-                text_blocks = get_lesson_content(
-                    body.user_id, 
-                    body.course_id, 
-                    body.lesson_num, 
-                    body.is_teacher
-                )
-                
-                if not text_blocks:
-                    raise HTTPException(
-                        status_code=status.HTTP_404_NOT_FOUND,
-                        detail="无法获取课时内容，请确保课时已上传并处理完成"
-                    )
-                
-                print(f"获取到 {len(text_blocks)} 个文本块")
-                
-                # 2. 限制文本块数量，避免生成过多题目
-                max_blocks = min(body.question_count, len(text_blocks))
-                selected_blocks = text_blocks[:max_blocks]
-                
-                print(f"将使用前 {max_blocks} 个文本块生成习题")
-                
-                # 3. 为每个文本块生成一道习题
-                print("步骤2: 为每个文本块生成习题")
-                exercises = await generate_exercises_for_blocks(
-                    selected_blocks,
-                    request,
-                    body.max_tokens,
-                    body.temperature,
-                    body.difficulty
+                print(f"⚠️ 保存docx文件失败: {save_result['error']}")
+                # 即使保存失败，也返回生成的内容
+                print("继续返回生成的内容...")
+            
+            # 5. 返回结果
+            end_time = datetime.now()
+            generation_time = (end_time - start_time).total_seconds()
+            
+            response = ExerciseResponse(
+                success=True,
+                message=f"习题生成完成，共生成 {body.question_count} 道题目",
+                data=response_text,
+                total_count=body.question_count,
+                generation_time=generation_time
+            )
+            print(f"习题生成完成，耗时: {generation_time:.2f}秒")
+            return response
+            
+        else:
+            # 文本块生成模式（默认）
+            print("使用文本块生成模式")
+            
+            # 1. 获取课时内容（文本块列表）
+            print("步骤1: 获取课时内容")
+            text_blocks = get_lesson_content(
+                body.user_id, 
+                body.course_id, 
+                body.lesson_num, 
+                body.is_teacher
+            )
+            
+            if not text_blocks:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="无法获取课时内容，请确保课时已上传并处理完成"
                 )
-                
-                # 验证生成的习题
-                if not exercises or len(exercises) == 0:
-                    raise HTTPException(
-                        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                        detail="习题生成失败：没有生成任何习题"
-                    )
-                
-                print(f"成功生成 {len(exercises)} 道习题")
-                
-                # 4. 合并所有习题
-                combined_exercises = "\n\n" + "="*50 + "\n\n".join(exercises)
-                
-                # 验证合并后的内容
-                if not combined_exercises or len(combined_exercises.strip()) == 0:
-                    raise HTTPException(
-                        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                        detail="习题生成失败：合并后的内容为空"
-                    )
-                
-                print(f"合并后内容长度: {len(combined_exercises)} 字符")
-                print(f"合并后内容预览: {combined_exercises[:300]}...")
-                
-                # 5. 保存习题到docx文件
-                print("步骤3: 保存习题到docx文件")
-                save_result = save_exercises_to_docx(
-                    body.user_id,
-                    body.course_id,
-                    body.lesson_num,
-                    combined_exercises,
-                    body.is_teacher
+            
+            print(f"获取到 {len(text_blocks)} 个文本块")
+            
+            # 2. 限制文本块数量，避免生成过多题目
+            blocks_needed = -(-body.question_count // body.questions_per_block)
+            max_blocks = min(blocks_needed, len(text_blocks))
+            selected_blocks = text_blocks[:max_blocks]
+            
+            print(f"将使用前 {max_blocks} 个文本块生成习题，每块 {body.questions_per_block} 道")
+            
+            # 3. 为每个文本块生成习题
+            print("步骤2: 为每个文本块生成习题")
+            exercises = await generate_exercises_for_blocks(
+                selected_blocks,
+                request,
+                body.max_tokens,
+                body.temperature,
+                body.difficulty,
+                body.question_count,
+                body.questions_per_block
+            )
+            
+            # 验证生成的习题
+            if not exercises or len(exercises) == 0:
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail="习题生成失败：没有生成任何习题"
                 )
-                
-                if save_result["success"]:
-                    print(f"✅ {save_result['message']}")
-                    print(f"文件大小: {save_result.get('file_size', 'unknown')} 字节")
-                else:
-                    print(f"⚠️ 保存docx文件失败: {save_result['error']}")
-                    # 即使保存失败，也返回生成的内容
-                    print("继续返回生成的内容...")
-                
-                # 6. 返回结果
-                end_time = datetime.now()
-                generation_time = (end_time - start_time).total_seconds()
-                
-                response = ExerciseResponse(
-                    success=True,
-                    message=f"习题生成完成，共生成 {len(exercises)} 道题目",
-                    data=combined_exercises,
-                    total_count=len(exercises),
-                    generation_time=generation_time
+            
+            print(f"成功生成 {len(exercises)} 道习题")
+            
+            # 4. 合并所有习题
+            combined_exercises = "\n\n" + "="*50 + "\n\n".join(exercises)
+            
+            # 验证合并后的内容
+            if not combined_exercises or len(combined_exercises.strip()) == 0:
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail="习题生成失败：合并后的内容为空"
                 )
-                print(f"习题生成完成，耗时: {generation_time:.2f}秒，生成 {len(exercises)} 道题目")
-                return response
             
+            print(f"合并后内容长度: {len(combined_exercises)} 字符")
+            print(f"合并后内容预览: {combined_exercises[:300]}...")
+            
+            # 5. 保存习题到docx文件
+            print("步骤3: 保存习题到docx文件")
+            save_result = save_exercises_to_docx(
+                body.user_id,
+                body.course_id,
+                body.lesson_num,
+                combined_exercises,
+                body.is_teacher
+            )
+            
+            if save_result["success"]:
+                print(f"✅ {save_result['message']}")
+                print(f"文件大小: {save_result.get('file_size', 'unknown')} 字节")
+            else:
+                print(f"⚠️ 保存docx文件失败: {save_result['error']}")
+                # 即使保存失败，也返回生成的内容
+                print("继续返回生成的内容...")
+            
+            # 6. 返回结果
+            end_time = datetime.now()
+            generation_time = (end_time - start_time).total_seconds()
+            
+            response = ExerciseResponse(
+                success=True,
+                message=f"习题生成完成，共生成 {len(exercises)} 道题目",
+                data=combined_exercises,
+                total_count=len(exercises),
+                generation_time=generation_time
+            )
+            print(f"习题生成完成，耗时: {generation_time:.2f}秒，生成 {len(exercises)} 道题目")
+            return response
+        
     except HTTPException:
         raise
     except Exception as e:
@@ -1,7 +1,8 @@
 from fastapi import APIRouter, HTTPException, Form, Query
 from typing import Optional, List
 from pydantic import BaseModel
-from utils.knowledge import load_vector_db, search_knowledge_db, ChromaDBManager
+from utils.knowledge import load_vector_db, search_knowledge_db, ChromaDBManager, model_registry, ingest_totals
+from utils.embedding_cache import embedding_cache
 from config.settings import get_settings
 
 router = APIRouter()
@@ -181,11 +182,17 @@ async def get_knowledge_status():
             },
             "models": {
                 "bgem3_path": str(settings.BGEM3_MODEL_PATH),
-                "reranker_path": str(settings.BGE_RERANKER_MODEL_PATH)
+                "reranker_path": str(settings.BGE_RERANKER_MODEL_PATH),
+                **model_registry.stats()
             },
+            "embedding_cache": embedding_cache.stats(),
+            "ingest": ingest_totals.to_dict(),
             "config": {
                 "chunk_size": settings.VECTOR_DB_CHUNK_SIZE,
-                "chunk_overlap": settings.VECTOR_DB_CHUNK_OVERLAP
+                "chunk_overlap": settings.VECTOR_DB_CHUNK_OVERLAP,
+                "embed_batch_size": settings.VECTOR_DB_EMBED_BATCH_SIZE,
+                "upsert_batch_size": settings.VECTOR_DB_UPSERT_BATCH_SIZE,
+                "queue_size": settings.VECTOR_DB_QUEUE_SIZE
             }
         }
         
@@ -4,19 +4,18 @@ from fastapi import APIRouter, HTTPException, status, Request
 from pydantic import BaseModel, Field
 from typing import Union, Optional, List, Dict, Any
 import asyncio
-from threading import Lock
 
 from utils.rwkv import *
+from utils.scheduler import scheduler, PRIORITY_INTERACTIVE
 from utils.knowledge import load_vector_db, search_knowledge_db, ChromaDBManager
 from utils.session_manager import session_manager
+from utils.lesson_state import LessonPrompt, lesson_prompt
+from utils.lesson_content import get_lesson_content_whole, get_lesson_collection_name
 import global_var
 from config.settings import get_settings
 
 router = APIRouter()
 
-# 全局锁，用于控制并发请求
-qa_lock = Lock()
-
 
 def get_user_path(user_id: str, is_teacher: bool) -> str:
     """根据userID和isTeacher确定用户路径"""
@@ -41,6 +40,7 @@ class QABody(BaseModel):
     max_tokens: int = Field(1000, description="生成回答的最大token数", ge=100, le=2000)
     temperature: float = Field(0.7, description="生成温度", ge=0.1, le=1.0)
     use_context: bool = Field(True, description="是否使用历史上下文")
+    use_lesson_state: bool = Field(False, description="已有文件查询模式下，课时不太长时以整个课时为上下文并复用课时状态，代替知识库检索")
 
     model_config = {
         "json_schema_extra": {
@@ -129,9 +129,9 @@ def search_knowledge_db(user_id, session_id, query, is_teacher=False, course_id=
         return f"搜索过程中出现错误: {str(e)}"
 
 
-async def generate_answer_with_rwkv(prompt: str, request: Request, temperature: float, max_tokens: int = 1000):
+async def generate_answer_with_rwkv(prompt: str, request: Request, temperature: float, max_tokens: int = 1000, lesson: Union[LessonPrompt, None] = None):
     """
-    使用RWKV模型生成回答
+    使用RWKV模型生成回答，lesson不为空时从课时状态开始，只预填充问题
     """
     print("开始使用RWKV模型生成回答...")
     
@@ -141,13 +141,8 @@ async def generate_answer_with_rwkv(prompt: str, request: Request, temperature:
         if model is None:
             raise Exception("RWKV模型未初始化")
         
-        # 设置生成参数
-        model.temperature = temperature
-        model.top_p = 0.9
-        
-        # 重要：临时增加max_tokens_per_generation以支持更长的生成
-        original_max_tokens = model.max_tokens_per_generation
-        model.max_tokens_per_generation = max_tokens
+        # 生成参数只对本次请求生效，不修改共享的模型配置
+        sampling = {"temperature": temperature, "top_p": 0.9, "max_tokens": max_tokens}
         
         # 生成回答内容
         answer_content = ""
@@ -157,8 +152,6 @@ async def generate_answer_with_rwkv(prompt: str, request: Request, temperature:
         print(f"提示词长度: {len(prompt)} 字符")
         print(f"最大token数: {max_tokens}")
         print(f"温度: {temperature}")
-        print(f"模型原始max_tokens_per_generation: {original_max_tokens}")
-        print(f"临时设置为: {model.max_tokens_per_generation}")
         
         # 设置停止条件
         stop_sequences = [
@@ -167,26 +160,28 @@ async def generate_answer_with_rwkv(prompt: str, request: Request, temperature:
         ]
         
         print("开始生成循环...")
-        for response, delta, _, _ in model.generate(prompt, stop=stop_sequences):
-            answer_content += delta
-            token_count += 1
+        # 在推理线程上生成，断开连接时取消任务
+        task = scheduler.submit(model, prompt, stop_sequences, PRIORITY_INTERACTIVE, lesson=lesson, sampling=sampling)
+        try:
+            async for response, delta, _, _ in task:
+                answer_content += delta
+                token_count += 1
             
-            # 每50个token打印一次进度
-            if token_count % 50 == 0:
-                print(f"已生成 {token_count} tokens, 当前内容长度: {len(answer_content)} 字符")
+                # 每50个token打印一次进度
+                if token_count % 50 == 0:
+                    print(f"已生成 {token_count} tokens, 当前内容长度: {len(answer_content)} 字符")
             
-            # 检查请求是否断开
-            if await request.is_disconnected():
-                print("请求已断开")
-                break
+                # 检查请求是否断开
+                if await request.is_disconnected():
+                    print("请求已断开")
+                    break
             
-            # 检查是否达到最大token数
-            if token_count >= max_tokens:
-                print(f"达到最大token数: {max_tokens}")
-                break
-        
-        # 恢复原始设置
-        model.max_tokens_per_generation = original_max_tokens
+                # 检查是否达到最大token数
+                if token_count >= max_tokens:
+                    print(f"达到最大token数: {max_tokens}")
+                    break
+        finally:
+            task.cancel()
         
         # 确保句子完整性
         answer_content = ensure_sentence_completeness(answer_content)
@@ -198,13 +193,6 @@ async def generate_answer_with_rwkv(prompt: str, request: Request, temperature:
         
     except Exception as e:
         print(f"RWKV生成回答时出错: {e}")
-        # 确保在出错时也恢复原始设置
-        try:
-            model = global_var.get(global_var.Model)
-            if model:
-                model.max_tokens_per_generation = original_max_tokens
-        except:
-            pass
         raise e
 
 
@@ -296,6 +284,31 @@ def build_qa_prompt(query: str, context: str, qa_history: List[Dict[str, Any]] =
     return prompt
 
 
+def build_qa_lesson_suffix(query: str, qa_history: List[Dict[str, Any]] = None) -> str:
+    """
+    课时问答提示词中课时内容之后的部分，课时内容的预填充状态可以复用
+    """
+    history_text = ""
+    if qa_history and len(qa_history) > 0:
+        history_text = "历史问答记录：\n"
+        for i, qa in enumerate(qa_history[-3:]):  # 只使用最近3个问答对
+            history_text += f"问题{i+1}: {qa['query']}\n"
+            history_text += f"回答{i+1}: {qa['answer'][:200]}...\n\n"
+    basis = "上述课时内容和历史问答记录" if history_text else "上述课时内容"
+    
+    return f"""你是一个专业的教学助手。请基于{basis}，准确、完整地回答用户的问题。
+
+{history_text}用户问题：{query}
+
+请基于{basis}，给出准确、完整、易于理解的回答。要求：
+1. 回答要条理清晰，重点突出
+2. 如果课时内容中没有相关信息，请明确说明
+3. 不要直接复制课时内容，要用自己的话重新组织
+4. 回答要简洁明了，避免冗余
+
+回答："""
+
+
 @router.post("/v1/qa", tags=["QA"])
 async def intelligent_qa(body: QABody, request: Request):
     """
@@ -315,12 +328,8 @@ async def intelligent_qa(body: QABody, request: Request):
             detail="模型未加载"
         )
     
-    # 检查是否已有问答任务在进行
-    if qa_lock.locked():
-        raise HTTPException(
-            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-            detail="已有问答任务在进行中，请稍后再试"
-        )
+    # 推理队列已满时直接返回429和Retry-After
+    scheduler.check_admission(PRIORITY_INTERACTIVE)
     
     # 验证搜索模式
     if body.search_mode not in ["existing", "uploaded"]:
@@ -344,29 +353,42 @@ async def intelligent_qa(body: QABody, request: Request):
             )
     
     try:
-        with qa_lock:
-            print(f"开始处理用户问题: {body.query}")
+        print(f"开始处理用户问题: {body.query}")
+        
+        # 获取历史问答记录（如果启用上下文）
+        qa_history = []
+        if body.use_context:
+            # 从会话管理器获取历史消息
+            context_messages = session_manager.get_context_messages(
+                body.user_id, body.session_id, max_messages=20, is_teacher=body.is_teacher
+            )
             
-            # 获取历史问答记录（如果启用上下文）
+            # 将历史消息转换为问答对格式
             qa_history = []
-            if body.use_context:
-                # 从会话管理器获取历史消息
-                context_messages = session_manager.get_context_messages(
-                    body.user_id, body.session_id, max_messages=20, is_teacher=body.is_teacher
-                )
-                
-                # 将历史消息转换为问答对格式
-                qa_history = []
-                for i in range(0, len(context_messages) - 1, 2):
-                    if i + 1 < len(context_messages):
-                        qa_history.append({
-                            "query": context_messages[i]["content"],
-                            "answer": context_messages[i + 1]["content"]
-                        })
-                
-                print(f"获取到 {len(qa_history)} 条历史问答记录")
+            for i in range(0, len(context_messages) - 1, 2):
+                if i + 1 < len(context_messages):
+                    qa_history.append({
+                        "query": context_messages[i]["content"],
+                        "answer": context_messages[i + 1]["content"]
+                    })
             
-            # 1. 从知识库搜索相关内容
+            print(f"获取到 {len(qa_history)} 条历史问答记录")
+        
+        # 1. 默认从知识库搜索相关内容；开启use_lesson_state且课时不太长时以整个课时为上下文，从课时状态开始只预填充问题
+        lesson = None
+        if body.use_lesson_state and body.search_mode == "existing":
+            lesson_content = get_lesson_content_whole(
+                body.user_id, body.course_id, body.lesson_num, body.is_teacher
+            )
+            lesson = lesson_prompt(
+                get_lesson_collection_name(body.user_id, body.course_id, body.lesson_num),
+                lesson_content,
+                build_qa_lesson_suffix(body.query, qa_history if body.use_context else None)
+            )
+        
+        if lesson is not None:
+            search_result = lesson_content
+        else:
             search_result = search_knowledge_db(
                 body.user_id,
                 body.session_id, 
@@ -377,52 +399,15 @@ async def intelligent_qa(body: QABody, request: Request):
                 body.top_k,
                 body.search_mode
             )
-            
-            if search_result is None:
-                raise HTTPException(
-                    status_code=404,
-                    detail="知识库不存在或搜索失败"
-                )
-            
-            if search_result == "未找到相关内容":
-                # 如果没有找到相关内容，返回提示信息
-                return {
-                    "success": True,
-                    "query": body.query,
-                    "user_id": body.user_id,
-                    "session_id": body.session_id,
-                    "is_teacher": body.is_teacher,
-                    "course_id": body.course_id,
-                    "lesson_num": body.lesson_num,
-                    "search_mode": body.search_mode,
-                    "answer": "抱歉，我在当前知识库中没有找到与您问题相关的信息。请尝试重新表述您的问题，或者检查是否选择了正确的课程和课时。",
-                    "context": "未找到相关内容",
-                    "has_context": False,
-                    "use_context": body.use_context,
-                    "history_count": len(qa_history)
-                }
-            
-            # 2. 构建问答提示词（包含历史上下文）
-            prompt = build_qa_prompt(body.query, search_result, qa_history if body.use_context else None)
-            
-            # 3. 使用RWKV模型生成回答
-            answer = await generate_answer_with_rwkv(prompt, request, body.temperature, body.max_tokens)
-            
-            # 4. 保存问答历史记录到会话管理器
-            messages = [
-                {"role": "user", "content": body.query},
-                {"role": "assistant", "content": answer}
-            ]
-            
-            # 保存当前对话
-            session_manager.save_dialogue(
-                body.user_id,
-                body.session_id,
-                messages,
-                answer,
-                body.is_teacher
+        
+        if search_result is None:
+            raise HTTPException(
+                status_code=404,
+                detail="知识库不存在或搜索失败"
             )
-            
+        
+        if search_result == "未找到相关内容":
+            # 如果没有找到相关内容，返回提示信息
             return {
                 "success": True,
                 "query": body.query,
@@ -432,13 +417,53 @@ async def intelligent_qa(body: QABody, request: Request):
                 "course_id": body.course_id,
                 "lesson_num": body.lesson_num,
                 "search_mode": body.search_mode,
-                "answer": answer,
-                "context": search_result,
-                "has_context": True,
+                "answer": "抱歉，我在当前知识库中没有找到与您问题相关的信息。请尝试重新表述您的问题，或者检查是否选择了正确的课程和课时。",
+                "context": "未找到相关内容",
+                "has_context": False,
                 "use_context": body.use_context,
                 "history_count": len(qa_history)
             }
-                
+        
+        # 2. 构建问答提示词（包含历史上下文）
+        if lesson is not None:
+            prompt = lesson.prompt
+        else:
+            prompt = build_qa_prompt(body.query, search_result, qa_history if body.use_context else None)
+        
+        # 3. 使用RWKV模型生成回答
+        answer = await generate_answer_with_rwkv(prompt, request, body.temperature, body.max_tokens, lesson)
+        
+        # 4. 保存问答历史记录到会话管理器
+        messages = [
+            {"role": "user", "content": body.query},
+            {"role": "assistant", "content": answer}
+        ]
+        
+        # 保存当前对话
+        session_manager.save_dialogue(
+            body.user_id,
+            body.session_id,
+            messages,
+            answer,
+            body.is_teacher
+        )
+        
+        return {
+            "success": True,
+            "query": body.query,
+            "user_id": body.user_id,
+            "session_id": body.session_id,
+            "is_teacher": body.is_teacher,
+            "course_id": body.course_id,
+            "lesson_num": body.lesson_num,
+            "search_mode": body.search_mode,
+            "answer": answer,
+            "context": search_result,
+            "has_context": True,
+            "use_context": body.use_context,
+            "history_count": len(qa_history)
+        }
+            
     except HTTPException:
         raise
     except Exception as e:
@@ -455,11 +480,14 @@ async def get_qa_status():
     获取问答服务状态
     """
     model: TextRWKV = global_var.get(global_var.Model)
+    stats = scheduler.stats()
+    busy = stats["running"] + stats["prefilling"] + stats["waiting"] > 0
     return {
         "service": "智能问答服务",
         "status": "运行中" if model is not None else "模型未加载",
         "model": model.name if model is not None else "无",
-        "lock_status": "忙碌中" if qa_lock.locked() else "空闲"
+        "lock_status": "忙碌中" if busy else "空闲",
+        "queue": stats
     }
 
 
@@ -1,47 +1,78 @@
+from collections import OrderedDict
 from typing import Any, Dict, List, Union
+import hashlib
+import json
+import mmap
+import os
+import struct
+import uuid
+import zlib
 from utils.log import quick_log
+from utils.packed_state import PackedState
+from utils.radix_tree import TokenRadixTree
+from utils.session_state import tensor_nbytes
+from utils.shared_state import shared_state
 from fastapi import APIRouter, HTTPException, Request, Response, status
 from pydantic import BaseModel
 import gc
-import copy
+import threading
 import global_var
+from config.settings import get_settings
 
 router = APIRouter()
 
-trie = None
+trie: Union[TokenRadixTree, None] = None  # token ids -> entry id
 dtrie: Dict = {}
-max_trie_len = 300
 loop_start_id = 1  # to prevent preloaded prompts from being deleted
-loop_del_trie_id = loop_start_id
+lru: "OrderedDict[int, None]" = OrderedDict()  # least recently used first
+cache_stats = {
+    "hits": 0,
+    "shared_hits": 0,
+    "misses": 0,
+    "evictions": 0,
+    "promotions": 0,
+    "demotions": 0,
+}
+lock = threading.RLock()
+
+settings = get_settings()
+max_trie_len = settings.RWKV_STATE_CACHE_MAX_ENTRIES
+eviction_policy = settings.RWKV_STATE_CACHE_EVICTION  # "lru" or "cost"
+snapshot_mm: Union[mmap.mmap, None] = None  # lazily loaded entries point into it
+snapshot_file: Union[str, None] = None  # the file behind snapshot_mm
+
+# hot entries stay on the model device, warm ones in (pinned) CPU memory, cold ones in files
+TIERS = ["device", "cpu", "disk"]
+tier_budget = {
+    "device": settings.RWKV_STATE_CACHE_DEVICE_BUDGET_MB * 1024 * 1024,
+    "cpu": settings.RWKV_STATE_CACHE_BUDGET_MB * 1024 * 1024,
+    "disk": settings.RWKV_STATE_CACHE_DISK_BUDGET_MB * 1024 * 1024,
+}
+tier_bytes = {"device": 0, "cpu": 0, "disk": 0}
+tier_dir = os.path.join(str(settings.STATE_CACHE_DIR), "tier")
+
+SNAPSHOT_MAGIC = b"ITAPSC03"
+SNAPSHOT_ALIGN = 64
 
 
 def init():
     global trie
-    try:
-        import cyac
 
-        # import mmap
-        # import os
-        #
-        # if os.path.exists("state_cache.trie"):
-        #     with open("state_cache.trie", "r") as bf:
-        #         buff_object = mmap.mmap(bf.fileno(), 0, access=mmap.ACCESS_READ)
-        #     trie = cyac.Trie.from_buff(buff_object, copy=False)
-        # else:
-        trie = cyac.Trie()
-    except ModuleNotFoundError:
-        print("cyac not found")
+    # the snapshot of the loaded model is restored by restore_state
+    trie = TokenRadixTree()
 
 
 @router.post("/disable-state-cache", tags=["State Cache"])
 def disable_state_cache():
-    global trie, dtrie
+    global trie
 
     if global_var.get(global_var.Deploy_Mode) is True:
         raise HTTPException(status.HTTP_403_FORBIDDEN)
 
-    trie = None
-    dtrie = {}
+    with lock:
+        trie = None
+        __clear_dtrie()
+    shared_state.detach()
     gc.collect()
 
     print("state cache disabled")
@@ -50,30 +81,36 @@ def disable_state_cache():
 
 @router.post("/enable-state-cache", tags=["State Cache"])
 def enable_state_cache():
-    global trie, dtrie
+    global trie
 
     if global_var.get(global_var.Deploy_Mode) is True:
         raise HTTPException(status.HTTP_403_FORBIDDEN)
 
-    try:
-        import cyac
-
-        trie = cyac.Trie()
-        dtrie = {}
-        gc.collect()
+    with lock:
+        trie = TokenRadixTree()
+        __clear_dtrie()
+    gc.collect()
 
-        print("state cache enabled")
-        return "success"
-    except ModuleNotFoundError:
-        print("state cache disabled")
-        raise HTTPException(status.HTTP_400_BAD_REQUEST, "cyac not found")
+    print("state cache enabled")
+    return "success"
 
 
 class AddStateBody(BaseModel):
-    prompt: str
-    tokens: List[Union[str, int]]
+    tokens: List[int]
     state: Any
     logits: Any
+    namespace: str = ""  # state-tuned file (and its mtime) the state starts from
+
+
+def __namespaced(tokens: List[int], namespace: str) -> List[int]:
+    """
+    Key of tokens in the trie: the states of a state-tuned preset live under a negative marker token,
+    so presets share one cache without ever matching each other's prefixes.
+    """
+    if not namespace:
+        return tokens
+    digest = hashlib.sha1(namespace.encode("utf-8")).hexdigest()
+    return [-1 - int(digest[:8], 16)] + tokens
 
 
 def copy_tensor_to_cpu(tensors):
@@ -103,65 +140,341 @@ def copy_tensor_to_cpu(tensors):
     return copied, devices
 
 
+def __clear_dtrie():
+    global dtrie, lru, snapshot_mm, snapshot_file
+
+    for v in dtrie.values():
+        __remove_blob_file(v)
+    dtrie = {}
+    lru = OrderedDict()
+    for tier in TIERS:
+        tier_bytes[tier] = 0
+    snapshot_mm = None
+    snapshot_file = None
+
+
+def __is_torch_state(state) -> bool:
+    if isinstance(state, PackedState):
+        return True
+    return type(state) == list and len(state) > 0 and hasattr(state[0], "device")
+
+
+def __kv_dtype():
+    import torch
+
+    return {"fp16": torch.float16, "bf16": torch.bfloat16}.get(
+        settings.RWKV_STATE_CACHE_KV_DTYPE
+    )
+
+
+def __set_tier(v, tier: str, nbytes: int):
+    if v.get("tier") is not None:
+        tier_bytes[v["tier"]] -= v["nbytes"]
+    v["tier"] = tier
+    v["nbytes"] = nbytes
+    tier_bytes[tier] += nbytes
+
+
+def __to_cpu(v):
+    """
+    device -> cpu: the att_kv matrices (v5/v6, 3 dims) may be stored in fp16/bf16.
+    The state is packed on its device first, so it crosses over in one copy per buffer.
+    disk -> cpu: the tensors are read back as they were written.
+    """
+    import torch
+
+    if v["tier"] == "disk":
+        state, logits = __read_blob(v["blob"])
+        __remove_blob_file(v)
+        v.pop("blob")
+    else:
+        kv_dtype = __kv_dtype()
+        state = v["state"]
+        logits = v["logits"]
+        if __is_torch_state(state):
+            tensors = state.tensors if isinstance(state, PackedState) else state
+            v["dtypes"] = [
+                str(tensor.dtype).replace("torch.", "") for tensor in tensors
+            ]
+            state = PackedState.pack(
+                tensors,
+                [
+                    (
+                        kv_dtype
+                        if kv_dtype is not None
+                        and tensor.dim() >= 3
+                        and tensor.dtype == torch.float32
+                        else None
+                    )
+                    for tensor in tensors
+                ],
+            )
+            logits = logits.to("cpu", copy=True)
+
+    if isinstance(state, PackedState):
+        # pinned pages make the copy back to the GPU faster
+        pin = any(device.type == "cuda" for device in v["devices"])
+        try:
+            state = state.to("cpu", pin_memory=pin)
+        except RuntimeError:
+            state = state.to("cpu")
+    v["state"] = state
+    v["logits"] = logits
+    __set_tier(v, "cpu", tensor_nbytes(state) + tensor_nbytes(logits))
+
+
+def __to_device(v):
+    state = __restore(v)
+    v["state"] = state
+    v["logits"] = v["logits"].to(v["logits_device"])
+    v["dtypes"] = None
+    __set_tier(v, "device", tensor_nbytes(state) + tensor_nbytes(v["logits"]))
+
+
+def __to_disk(v) -> bool:
+    state_format, buffers = __entry_buffers(v)
+    if buffers is None:
+        return False
+    os.makedirs(tier_dir, exist_ok=True)
+    path = os.path.join(tier_dir, f"{uuid.uuid4().hex}.bin")
+    specs = []
+    offset = 0
+    with open(path, "wb") as f:
+        for spec, buffer in buffers:
+            data = buffer
+            spec = dict(spec, offset=offset, nbytes=len(buffer))
+            if settings.RWKV_STATE_CACHE_DISK_COMPRESS:
+                data = zlib.compress(buffer, 1)
+                spec["zlib"] = len(data)
+            f.write(data)
+            offset += len(data)
+            specs.append(spec)
+    v["blob"] = {
+        "file": path,
+        **state_format,
+        "state": specs[:-1],
+        "logits": specs[-1],
+    }
+    v["state"] = None
+    v["logits"] = None
+    __set_tier(v, "disk", offset)
+    return True
+
+
+def __restore(v) -> PackedState:
+    """
+    Copy of the packed state on the devices and with the dtypes of the generation.
+    """
+    import torch
+
+    dtypes = v.get("dtypes")
+    return v["state"].restore(
+        v["devices"], [getattr(torch, dtype) for dtype in dtypes] if dtypes else None
+    )
+
+
+def __materialize(v):
+    """
+    Returns a state and logits for one generation, the cached tensors are left untouched.
+    """
+    import numpy as np
+
+    state = v["state"]
+    logits = v["logits"]
+    if __is_torch_state(state):
+        if v["tier"] == "device":
+            return state.clone().tensors, logits.clone()
+        return __restore(v).tensors, logits.to(v["logits_device"], copy=True)
+    elif type(state) == np.ndarray:  # rwkv.cpp
+        return np.copy(state), np.copy(logits)
+    else:  # WebGPU
+        return state, np.copy(logits)
+
+
+def __remove_blob_file(v):
+    blob = v.get("blob")
+    if blob is not None and "file" in blob:
+        try:
+            os.remove(blob["file"])
+        except OSError:
+            pass
+
+
+def __remove_entry(id: int):
+    v = dtrie.pop(id, None)
+    lru.pop(id, None)
+    if v is not None:
+        tier_bytes[v["tier"]] -= v["nbytes"]
+        __remove_blob_file(v)
+        trie.remove(id)
+
+
+def __eviction_candidate(
+    exclude: int, tier: Union[str, None] = None, pinned: bool = False
+) -> Union[int, None]:
+    candidates = [
+        id
+        for id in lru.keys()
+        if id != exclude
+        and (pinned or id >= loop_start_id)
+        and (tier is None or dtrie[id]["tier"] == tier)
+        # entries mapped from the snapshot do not use the disk budget
+        and (tier != "disk" or "file" in dtrie[id]["blob"])
+    ]
+    if len(candidates) == 0:
+        return None
+    if eviction_policy == "cost":
+        # the entry saving the least prefill work goes first, the least recently used among equals
+        return min(
+            candidates,
+            key=lambda id: (dtrie[id]["hits"] + 1) * dtrie[id]["length"],
+        )
+    return candidates[0]
+
+
+def __rebalance(exclude: int):
+    """
+    Demotes the victims of the full tiers one tier down, the last tier drops them.
+    """
+    for i, tier in enumerate(TIERS):
+        while tier_bytes[tier] > tier_budget[tier]:
+            # the preloaded prompt can be demoted, but not dropped
+            can_demote = tier == "device" or (tier == "cpu" and tier_budget["disk"] > 0)
+            victim = __eviction_candidate(exclude, tier, pinned=can_demote)
+            if victim is None:
+                break
+            v = dtrie[victim]
+            demoted = False
+            if tier == "device":
+                __to_cpu(v)
+                demoted = True
+            elif tier == "cpu" and tier_budget["disk"] > 0:
+                demoted = __to_disk(v)
+            if demoted:
+                cache_stats["demotions"] += 1
+            elif tier == "disk" or victim >= loop_start_id:
+                __remove_entry(victim)
+                cache_stats["evictions"] += 1
+            else:
+                break
+
+    while len(dtrie) > max_trie_len:
+        victim = __eviction_candidate(exclude)
+        if victim is None:
+            break
+        __remove_entry(victim)
+        cache_stats["evictions"] += 1
+
+
+def __promote(id: int, v):
+    """
+    Entries move up by access frequency: disk -> cpu on any hit, cpu -> device after a few hits.
+    """
+    if v["tier"] == "disk":
+        __to_cpu(v)
+        cache_stats["promotions"] += 1
+    if (
+        v["tier"] == "cpu"
+        and tier_budget["device"] > 0
+        and v["hits"] >= settings.RWKV_STATE_CACHE_PROMOTE_HITS
+        and __is_torch_state(v["state"])
+        and any(device.type != "cpu" for device in v["devices"])
+        and v["nbytes"] <= tier_budget["device"]
+    ):
+        __to_device(v)
+        cache_stats["promotions"] += 1
+    __rebalance(id)
+
+
 # @router.post("/add-state", tags=["State Cache"])
 def add_state(body: AddStateBody):
-    global trie, dtrie, loop_del_trie_id
+    global trie, dtrie
 
     # if global_var.get(global_var.Deploy_Mode) is True:
     #     raise HTTPException(status.HTTP_403_FORBIDDEN)
 
     if trie is None:
         raise HTTPException(status.HTTP_400_BAD_REQUEST, "trie not loaded")
+    if len(body.tokens) == 0:
+        return "empty"
 
     import torch
-    import numpy as np
 
     try:
-        devices: List[torch.device] = []
-        logits_device: Union[torch.device, None] = None
-        state: Union[Any, None] = None
-        logits: Union[Any, None] = None
-
-        if body.state is not None:
-            state, devices = copy_tensor_to_cpu(body.state)
-        if body.logits is not None:
-            logits, logits_devices = copy_tensor_to_cpu(body.logits)
-            if len(logits_devices) > 0:
-                logits_device = logits_devices[0]
-
-        id: int = trie.insert(body.prompt)
-        dtrie[id] = {
-            "tokens": body.tokens,
-            "state": state,
-            "logits": logits,
-            "devices": devices,
-            "logits_device": logits_device,
+        v = {
+            "length": len(body.tokens),
+            "hits": 0,
+            "tier": None,
+            "nbytes": 0,
+            "dtypes": None,
         }
-
-        if len(trie) >= max_trie_len:
-            del_prompt = trie[loop_del_trie_id]
-            trie.remove(del_prompt)
-            dtrie[loop_del_trie_id] = None
-            loop_del_trie_id = loop_del_trie_id + 1
-            if loop_del_trie_id >= max_trie_len:
-                loop_del_trie_id = loop_start_id
-
-        quick_log(
-            None,
-            None,
-            f"New Trie Id: {id}\nTrie Len: {len(trie)}\nTrie Buff Size: {trie.buff_size()}\nDtrie Buff Size Of Id: {__get_a_dtrie_buff_size(dtrie[id])}",
-        )
+        if __is_torch_state(body.state) and body.logits is not None:
+            v["state"] = body.state
+            v["logits"] = body.logits
+            v["devices"] = [tensor.device for tensor in body.state]
+            v["logits_device"] = body.logits.device
+        else:
+            devices: List[torch.device] = []
+            logits_device: Union[torch.device, None] = None
+            state: Union[Any, None] = None
+            logits: Union[Any, None] = None
+
+            if body.state is not None:
+                state, devices = copy_tensor_to_cpu(body.state)
+            if body.logits is not None:
+                logits, logits_devices = copy_tensor_to_cpu(body.logits)
+                if len(logits_devices) > 0:
+                    logits_device = logits_devices[0]
+            v["state"] = state
+            v["logits"] = logits
+            v["devices"] = devices
+            v["logits_device"] = logits_device
+
+        with lock:
+            # new entries start in the cpu tier, the live tensors of the context are copied
+            if __is_torch_state(v["state"]):
+                v["tier"] = "device"  # nbytes is 0, nothing is accounted to the device tier
+                __to_cpu(v)
+            else:
+                __set_tier(v, "cpu", __get_a_dtrie_buff_size(v))
+            if v["nbytes"] > tier_budget["cpu"]:
+                tier_bytes["cpu"] -= v["nbytes"]
+                return "too large"
+
+            key = __namespaced(body.tokens, body.namespace)
+            id: int = trie.insert(key)
+            old = dtrie.get(id)
+            if old is not None:
+                tier_bytes[old["tier"]] -= old["nbytes"]
+                __remove_blob_file(old)
+                v["hits"] = old["hits"]
+            dtrie[id] = v
+            lru[id] = None
+            lru.move_to_end(id)
+            shared = None
+            if shared_state.attached:
+                shared = __entry_buffers(v)
+            __rebalance(id)
+
+            quick_log(
+                None,
+                None,
+                f"New Trie Id: {id}\nTrie Len: {len(trie)}\nTrie Tokens: {trie.token_count}\nDtrie Buff Size Of Id: {v['nbytes']}\nDtrie Buff Size: {tier_bytes}",
+            )
+        # the other workers of the node can use it too, copied outside of the lock
+        if shared is not None and shared[1] is not None:
+            shared_state.publish(key, __shared_meta(v, shared[0]), shared[1])
         return "success"
     except Exception as e:
         print(e)  # should not happen
         raise HTTPException(
-            status.HTTP_400_BAD_REQUEST, f"insert failed, bad prompt.\n{e}"
+            status.HTTP_400_BAD_REQUEST, f"insert failed, bad tokens.\n{e}"
         )
 
 
 @router.post("/reset-state", tags=["State Cache"])
 def reset_state():
-    global trie, dtrie
+    global trie
 
     if global_var.get(global_var.Deploy_Mode) is True:
         raise HTTPException(status.HTTP_403_FORBIDDEN)
@@ -169,47 +482,63 @@ def reset_state():
     if trie is None:
         raise HTTPException(status.HTTP_400_BAD_REQUEST, "trie not loaded")
 
-    import cyac
-
-    trie = cyac.Trie()
-    dtrie = {}
+    with lock:
+        trie = TokenRadixTree()
+        __clear_dtrie()
     gc.collect()
 
     return "success"
 
 
 def force_reset_state():
-    global trie, dtrie
+    global trie
 
     if trie is None:
         return
 
-    import cyac
-
-    trie = cyac.Trie()
-    dtrie = {}
+    with lock:
+        trie = TokenRadixTree()
+        __clear_dtrie()
     gc.collect()
 
 
+@router.get("/state-cache-status", tags=["State Cache"])
+def state_cache_status():
+    """
+    Occupancy of the prefix state cache, per tier
+    """
+    with lock:
+        tiers = {}
+        for tier in TIERS:
+            tiers[tier] = {
+                "entries": len([v for v in dtrie.values() if v["tier"] == tier]),
+                "bytes": tier_bytes[tier],
+                "max_bytes": tier_budget[tier],
+            }
+        tiers["disk"]["mapped_entries"] = len(
+            [v for v in dtrie.values() if v["tier"] == "disk" and "mm" in v["blob"]]
+        )
+        return {
+            "enabled": trie is not None,
+            "entries": len(dtrie),
+            "max_entries": max_trie_len,
+            "tiers": tiers,
+            "trie_tokens": trie.token_count if trie is not None else 0,
+            "eviction_policy": eviction_policy,
+            "kv_dtype": settings.RWKV_STATE_CACHE_KV_DTYPE,
+            "shared": shared_state.stats(),
+            **cache_stats,
+        }
+
+
 class LongestPrefixStateBody(BaseModel):
-    prompt: str
+    tokens: List[int]
+    namespace: str = ""
 
 
 def __get_a_dtrie_buff_size(dtrie_v):
-    # print(sys.getsizeof(dtrie_v["tokens"][0]))  # str
-    # print(sys.getsizeof(dtrie_v["tokens"][0]) * len(dtrie_v["tokens"]))
-    # print(dtrie_v["state"][0][0].element_size())
-    # print(dtrie_v["state"][0].nelement())
-    # print(len(dtrie_v["state"]))
-    # print(
-    #     len(dtrie_v["state"])
-    #     * dtrie_v["state"][0].nelement()
-    #     * dtrie_v["state"][0][0].element_size()
-    # )
-    # print(dtrie_v["logits"][0].element_size())
-    # print(dtrie_v["logits"].nelement())
-    # print(dtrie_v["logits"][0].element_size() * dtrie_v["logits"].nelement())
-    return 54 * len(dtrie_v["tokens"]) + 491520 + 262144 + 28  # TODO
+    # the tokens live in the radix tree, shared with the other entries
+    return tensor_nbytes(dtrie_v["state"]) + tensor_nbytes(dtrie_v["logits"])
 
 
 # @router.post("/longest-prefix-state", tags=["State Cache"])
@@ -222,65 +551,441 @@ def longest_prefix_state(body: LongestPrefixStateBody, request: Request):
     if trie is None:
         raise HTTPException(status.HTTP_400_BAD_REQUEST, "trie not loaded")
 
+    key = __namespaced(body.tokens, body.namespace)
+    offset = len(key) - len(body.tokens)
+    with lock:
+        id, length = trie.longest_prefix(key)
+        if id == -1 or id not in dtrie:
+            length = 0
+    # another worker may have cached a longer prefix
+    shared = __shared_prefix_state(key, length)
+    if shared is not None:
+        length, state, logits = shared
+        length -= offset
+        quick_log(request, None, f"Hit (shared): {length} of {len(body.tokens)} tokens")
+        return {"tokens": body.tokens[:length], "state": state, "logits": logits}
+
+    with lock:
+        id, length = trie.longest_prefix(key)
+        if id == -1 or id not in dtrie:
+            cache_stats["misses"] += 1
+            return {"tokens": [], "state": None, "logits": None}
+
+        v = dtrie[id]
+        v["hits"] += 1
+        lru.move_to_end(id)
+        cache_stats["hits"] += 1
+        __promote(id, v)
+        state, logits = __materialize(v)
+        tier = v["tier"]
+    length -= offset
+    tokens: List[int] = body.tokens[:length]
+
+    quick_log(request, None, f"Hit ({tier}): {length} of {len(body.tokens)} tokens")
+    return {
+        "tokens": tokens,
+        "state": state,
+        "logits": logits,
+    }
+
+
+def branch_offset(tokens: List[int], namespace: str = "") -> int:
+    """
+    Length of the prefix tokens share with the cached paths when inserting them would branch off
+    there without a state (the node created by the split carries no entry), 0 otherwise.
+    The prefill stops at that offset to cache the state, later prompts sharing the prefix start from it.
+    """
+    if trie is None:
+        return 0
+    key = __namespaced(tokens, namespace)
+    offset = len(key) - len(tokens)
+    with lock:
+        length, id = trie.shared_prefix(key)
+    if length <= offset or length >= len(key) or (id is not None and id in dtrie):
+        return 0
+    return length - offset
+
+
+def __shared_meta(v, state_format: Dict) -> Dict:
+    return {
+        "devices": [str(device) for device in v["devices"]],
+        "logits_device": (
+            str(v["logits_device"]) if v["logits_device"] is not None else None
+        ),
+        "dtypes": v.get("dtypes"),
+        **state_format,
+    }
+
+
+def __shared_prefix_state(tokens: List[int], local_length: int):
+    """
+    Returns (length, state, logits) of a shared prefix longer than the local one, None if there is none.
+    The state is read from the shared memory views, the only copy is the one for this generation.
+    """
+    if not shared_state.attached:
+        return None
+    hit = shared_state.longest_prefix(tokens, local_length + 1)
+    if hit is None:
+        return None
+    epoch, length, meta, state, logits = hit
+
     import torch
-    import numpy as np
 
-    id = -1
+    v = {
+        "tier": "shared",
+        "state": __as_packed(state, meta.get("layout")),
+        "logits": logits,
+        "devices": [torch.device(device) for device in meta["devices"]],
+        "logits_device": (
+            torch.device(meta["logits_device"])
+            if meta["logits_device"] is not None
+            else None
+        ),
+        "dtypes": meta["dtypes"],
+    }
+    state, logits = __materialize(v)
+    # the writer may have started over the arena while we were copying
+    if not shared_state.valid(epoch):
+        return None
+    with lock:
+        cache_stats["shared_hits"] += 1
+    return length, state, logits
+
+
+@router.post("/save-state", tags=["State Cache"])
+def save_state():
+    global trie
+
+    if global_var.get(global_var.Deploy_Mode) is True:
+        raise HTTPException(status.HTTP_403_FORBIDDEN)
+
+    if trie is None:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "trie not loaded")
+
+    model = global_var.get(global_var.Model)
+    if model is None:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "model not loaded")
+
+    if persist_state(model) is None:
+        raise HTTPException(
+            status.HTTP_500_INTERNAL_SERVER_ERROR, "failed to save state cache"
+        )
+
+    return "success"
+
+
+def __snapshot_key(model) -> Dict[str, str]:
+    return {
+        "model_path": str(model.model_path),
+        "version": str(model.version),
+        "strategy": str(model.strategy),
+    }
+
+
+def __snapshot_name(key: Dict[str, str]) -> str:
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def __snapshot_pointer(key: Dict[str, str]) -> str:
+    return os.path.join(str(settings.STATE_CACHE_DIR), f"{__snapshot_name(key)}.current")
+
+
+def __snapshot_path(key: Dict[str, str]) -> Union[str, None]:
+    """
+    The snapshot file named by the pointer file, the single file of older versions otherwise
+    """
     try:
-        for id, len in trie.prefix(body.prompt):
-            pass
-    except:
+        with open(__snapshot_pointer(key), "r", encoding="utf-8") as f:
+            return os.path.join(str(settings.STATE_CACHE_DIR), f.read().strip())
+    except OSError:
         pass
-    if id != -1:
-        prompt: str = trie[id]
-        v = dtrie[id]
-        tokens: List[Union[str, int]] = copy.deepcopy(v["tokens"])
-        devices: List[torch.device] = v["devices"]
-        logits_device: Union[torch.device, None] = v["logits_device"]
-        state: Union[Any, None] = v["state"]
-        logits: Union[Any, None] = v["logits"]
-
-        state_type = type(state)
-        if state_type == list and hasattr(state[0], "device"):  # torch
-            state = [
-                (
-                    tensor.to(devices[i])
-                    if devices[i] != torch.device("cpu")
-                    else tensor.clone()
-                )
-                for i, tensor in enumerate(state)
-            ]
-            logits = (
-                logits.to(logits_device)
-                if logits_device != torch.device("cpu")
-                else logits.clone()
-            )
-        elif state_type == np.ndarray:  # rwkv.cpp
-            logits = np.copy(logits)
-        else:  # WebGPU
-            logits = np.copy(logits)
+    path = os.path.join(str(settings.STATE_CACHE_DIR), f"{__snapshot_name(key)}.cache")
+    return path if os.path.exists(path) else None
+
+
+def __remove_old_snapshots(key: Dict[str, str], keep: List[str]):
+    """
+    Removes the snapshot files of the key that are neither current nor mapped.
+    A file still mapped by another process fails to be removed on Windows, it goes next time.
+    """
+    prefix = __snapshot_name(key) + "."
+    directory = str(settings.STATE_CACHE_DIR)
+    keep = [os.path.abspath(path) for path in keep if path]
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not name.startswith(prefix) or not name.endswith(".cache"):
+            continue
+        if os.path.abspath(path) in keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
-        quick_log(request, body, "Hit:\n" + prompt)
-        return {
-            "prompt": prompt,
-            "tokens": tokens,
-            "state": state,
-            "logits": logits,
+
+def __align(n: int) -> int:
+    return (n + SNAPSHOT_ALIGN - 1) // SNAPSHOT_ALIGN * SNAPSHOT_ALIGN
+
+
+def __tensor_buffer(tensor):
+    """
+    Returns (spec, raw bytes as a uint8 array), None for the types that cannot be saved (WebGPU)
+    """
+    if hasattr(tensor, "detach"):  # torch (numpy 2 arrays have a device too)
+        import torch
+
+        buffer = tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy()
+        spec = {
+            "kind": "torch",
+            "dtype": str(tensor.dtype).replace("torch.", ""),
+            "shape": list(tensor.shape),
         }
+        return spec, buffer
+    if hasattr(tensor, "dtype") and hasattr(tensor, "tobytes"):  # numpy
+        import numpy as np
+
+        buffer = np.ascontiguousarray(tensor).reshape(-1).view(np.uint8)
+        spec = {"kind": "numpy", "dtype": tensor.dtype.str, "shape": list(tensor.shape)}
+        return spec, buffer
+    return None
+
+
+def __load_tensor(buffer, spec: Dict, offset: int):
+    if spec["kind"] == "torch":
+        import torch
+
+        tensor = torch.frombuffer(
+            buffer, dtype=torch.uint8, count=spec["nbytes"], offset=offset
+        )
+        return tensor.view(getattr(torch, spec["dtype"])).view(spec["shape"]).clone()
+    import numpy as np
+
+    dtype = np.dtype(spec["dtype"])
+    array = np.frombuffer(
+        buffer, dtype=dtype, count=spec["nbytes"] // dtype.itemsize, offset=offset
+    )
+    return array.reshape(spec["shape"]).copy()
+
+
+def __blob_buffers(blob) -> List:
+    """
+    Raw bytes of every tensor of a disk entry, state tensors first
+    """
+    specs = blob["state"] + [blob["logits"]]
+    if "mm" in blob:
+        view = memoryview(blob["mm"])
+        return [view[spec["offset"] : spec["offset"] + spec["nbytes"]] for spec in specs]
+    with open(blob["file"], "rb") as f:
+        data = f.read()
+    buffers = []
+    for spec in specs:
+        if "zlib" in spec:
+            raw = zlib.decompress(data[spec["offset"] : spec["offset"] + spec["zlib"]])
+        else:
+            raw = data[spec["offset"] : spec["offset"] + spec["nbytes"]]
+        buffers.append(bytearray(raw))  # writable, so torch.frombuffer does not warn
+    return buffers
+
+
+def __read_blob(blob):
+    specs = blob["state"] + [blob["logits"]]
+    tensors = [
+        __load_tensor(buffer, spec, 0)
+        for buffer, spec in zip(__blob_buffers(blob), specs)
+    ]
+    state = tensors[:-1] if blob["state_list"] else tensors[0]
+    return __as_packed(state, blob.get("layout")), tensors[-1]
+
+
+def __as_packed(state, layout: Union[List, None]):
+    """
+    Torch states are written as their packed buffers, older files and records hold a tensor per state entry
+    """
+    if layout is not None:
+        return PackedState.from_spec(state, layout)
+    if __is_torch_state(state):
+        return PackedState.pack(state)
+    return state
+
+
+def __entry_buffers(v):
+    """
+    Disk entries are copied from their file or the previous snapshot without materializing them
+    """
+    if v["tier"] == "disk":
+        blob = v["blob"]
+        specs = blob["state"] + [blob["logits"]]
+        state_format = {"state_list": blob["state_list"], "layout": blob.get("layout")}
+        return state_format, [
+            ({k: spec[k] for k in ["kind", "dtype", "shape"]}, buffer)
+            for spec, buffer in zip(specs, __blob_buffers(blob))
+        ]
+
+    state = v["state"]
+    if isinstance(state, PackedState):
+        # one raw buffer per device, the layout gives the tensors back
+        state_format = {"state_list": True, "layout": state.spec()}
+        tensors = state.buffers + [v["logits"]]
     else:
-        return {"prompt": "", "tokens": [], "state": None, "logits": None}
+        state_format = {"state_list": type(state) == list, "layout": None}
+        if state is None or v["logits"] is None:
+            return state_format, None
+        tensors = (state if state_format["state_list"] else [state]) + [v["logits"]]
+    buffers = [__tensor_buffer(tensor) for tensor in tensors]
+    if any(buffer is None for buffer in buffers):
+        return state_format, None
+    return state_format, buffers
+
+
+def persist_state(model) -> Union[str, None]:
+    """
+    Writes the prefix cache into a single file keyed by model path, version and strategy,
+    the entries of every state-tuned preset go into it under their namespace.
+    Layout: magic, header length, json header (tokens, tensor specs), 64-byte aligned raw tensors.
+    Every save goes to a new file and then switches the pointer file to it: the previous
+    snapshot may still be mapped by restore_state, and a mapped file cannot be replaced on Windows.
+    Returns the file path, None if nothing was written.
+    """
+    if not settings.RWKV_STATE_CACHE_PERSIST or trie is None or model is None:
+        return None
 
+    try:
+        entries = []
+        buffers = []
+        offset = 0
+        # the tiers may move entries around, the buffers are collected under the lock
+        with lock:
+            for id in lru.keys():
+                v = dtrie[id]
+                state_format, entry_buffers = __entry_buffers(v)
+                if entry_buffers is None:
+                    continue
+                specs = []
+                for spec, buffer in entry_buffers:
+                    spec = dict(spec, offset=offset, nbytes=len(buffer))
+                    specs.append(spec)
+                    buffers.append((offset, buffer))
+                    offset = __align(offset + len(buffer))
+                entries.append(
+                    {
+                        "tokens": trie.tokens(id),
+                        "hits": v["hits"],
+                        "devices": [str(device) for device in v["devices"]],
+                        "logits_device": (
+                            str(v["logits_device"])
+                            if v["logits_device"] is not None
+                            else None
+                        ),
+                        "dtypes": v.get("dtypes"),
+                        **state_format,
+                        "state": specs[:-1],
+                        "logits": specs[-1],
+                    }
+                )
 
-# @router.post("/save-state", tags=["State Cache"])
-def save_state():
-    global trie
+        key = __snapshot_key(model)
+        header = json.dumps(
+            {"key": key, "entries": entries}, ensure_ascii=False
+        ).encode("utf-8")
+        data_start = __align(len(SNAPSHOT_MAGIC) + 8 + len(header))
+
+        name = f"{__snapshot_name(key)}.{uuid.uuid4().hex}.cache"
+        path = os.path.join(str(settings.STATE_CACHE_DIR), name)
+        with open(path, "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            for buffer_offset, buffer in buffers:
+                f.seek(data_start + buffer_offset)
+                f.write(buffer)
+        # the pointer file is never mapped, replacing it works on every platform
+        pointer = __snapshot_pointer(key)
+        with open(pointer + ".tmp", "w", encoding="utf-8") as f:
+            f.write(name)
+        os.replace(pointer + ".tmp", pointer)
+        __remove_old_snapshots(key, [path, snapshot_file])
+
+        print(f"state cache saved: {len(entries)} entries, {path}")
+        return path
+    except Exception as e:
+        print(f"failed to save state cache: {e}")
+        return None
 
-    # if global_var.get(global_var.Deploy_Mode) is True:
-    #     raise HTTPException(status.HTTP_403_FORBIDDEN)
 
-    if trie is None:
-        raise HTTPException(status.HTTP_400_BAD_REQUEST, "trie not loaded")
+def restore_state(model) -> int:
+    """
+    Maps the snapshot of the model and inserts its token paths into the trie.
+    The entries start in the disk tier, their tensors are read from the mapping on the first hit.
+    Returns the number of restored entries.
+    """
+    global snapshot_mm, snapshot_file
+
+    if trie is not None and model is not None:
+        shared_state.attach(__snapshot_key(model))
 
-    # trie.save("state_cache.trie")
+    if not settings.RWKV_STATE_CACHE_PERSIST or trie is None or model is None:
+        return 0
 
-    return "not implemented"
+    path = __snapshot_path(__snapshot_key(model))
+    if path is None or not os.path.exists(path):
+        return 0
+
+    try:
+        with open(path, "rb") as f:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                print(f"bad state cache file: {path}")
+                return 0
+            (header_len,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_len).decode("utf-8"))
+            # copy-on-write pages, so the tensors can be built on top without a read-only warning
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        if header["key"] != __snapshot_key(model):
+            return 0
+        data_start = __align(len(SNAPSHOT_MAGIC) + 8 + header_len)
+
+        import torch
+
+        count = 0
+        with lock:
+            snapshot_mm = mm
+            snapshot_file = path
+            for e in header["entries"]:
+                if len(dtrie) >= max_trie_len:
+                    break
+                if len(e["tokens"]) == 0:
+                    continue
+                id: int = trie.insert(e["tokens"])
+                if id in dtrie:  # e.g. the preloaded prompt
+                    continue
+                for spec in e["state"] + [e["logits"]]:
+                    spec["offset"] += data_start
+                dtrie[id] = {
+                    "length": len([token for token in e["tokens"] if token >= 0]),
+                    "state": None,
+                    "logits": None,
+                    "devices": [torch.device(device) for device in e["devices"]],
+                    "logits_device": (
+                        torch.device(e["logits_device"])
+                        if e["logits_device"] is not None
+                        else None
+                    ),
+                    "dtypes": e["dtypes"],
+                    "hits": e["hits"],
+                    "tier": "disk",
+                    "nbytes": 0,  # mapped, no disk budget used
+                    "blob": {
+                        "mm": mm,
+                        "state_list": e["state_list"],
+                        "layout": e.get("layout"),
+                        "state": e["state"],
+                        "logits": e["logits"],
+                    },
+                }
+                lru[id] = None
+                count += 1
+
+        print(f"state cache restored: {count} entries, {path}")
+        return count
+    except Exception as e:
+        print(f"failed to restore state cache: {e}")
+        return 0
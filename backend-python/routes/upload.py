@@ -2,6 +2,7 @@ import os
 from fastapi import APIRouter, HTTPException, File, Form, UploadFile, status
 from typing import Optional
 from utils.knowledge import update_knowledge_db
+from routes.exercise import warm_lesson_state
 from config.settings import get_settings
 
 router = APIRouter()
@@ -115,6 +116,10 @@ async def upload_file(
                         collection_name += "_ask"
                     
                     knowledge_status = f"知识库更新成功，Collection: {collection_name}"
+                    
+                    # 课时文件：预填充课时内容，之后的问答和出题共用该状态
+                    if is_teacher and not is_resource and not is_ask:
+                        warm_lesson_state(user_id, course_id, lesson_num, is_teacher)
                 else:
                     knowledge_status = "知识库更新失败：没有找到可处理的文档"
                     knowledge_error = "文档加载或处理失败"
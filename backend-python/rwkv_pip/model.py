@@ -1661,6 +1661,240 @@ class RWKV(MyModule):
 
         return x + out, xx[-1, :], s
 
+    ########################################################################################################
+    # batched single-token variants: x and sx are [B, C], s is [B, H, N, N], one row per sequence
+
+    @MyFunction
+    def att_batch_v5(
+        self,
+        x,
+        sx,
+        s,
+        ln_w,
+        ln_b,
+        lx_w,
+        lx_b,
+        k_mix,
+        v_mix,
+        r_mix,
+        t_decay,
+        t_first,
+        kw,
+        vw,
+        rw,
+        ow,
+        kmx,
+        krx,
+        kmy,
+        kry,
+        vmx,
+        vrx,
+        vmy,
+        vry,
+        rmx,
+        rrx,
+        rmy,
+        rry,
+        omx,
+        orx,
+        omy,
+        ory,
+    ):
+        xx = F.layer_norm(x, (x.shape[-1],), weight=ln_w, bias=ln_b)
+        kx = xx * k_mix + sx * (1 - k_mix)
+        vx = xx * v_mix + sx * (1 - v_mix)
+        rx = xx * r_mix + sx * (1 - r_mix)
+
+        B = x.shape[0]
+        H = t_decay.shape[0]
+        N = x.shape[-1] // H
+
+        r = matmul(rx, rw, rmx, rrx, rmy, rry, output_dtype=torch.float32).view(
+            B, H, 1, N
+        )
+        k = matmul(kx, kw, kmx, krx, kmy, kry, output_dtype=torch.float32).view(
+            B, H, N, 1
+        )
+        v = matmul(vx, vw, vmx, vrx, vmy, vry, output_dtype=torch.float32).view(
+            B, H, 1, N
+        )
+
+        a = k @ v
+        out = r @ (t_first * a + s)
+        s = a + t_decay * s
+
+        out = out.view(B, H * N)
+        out = F.group_norm(out, num_groups=H, weight=lx_w, bias=lx_b, eps=64e-5)
+        out = out.to(dtype=x.dtype)
+        out = matmul(out, ow, omx, orx, omy, ory)
+
+        return x + out, xx, s
+
+    @MyFunction
+    def att_batch_v5_1(
+        self,
+        x,
+        sx,
+        s,
+        ln_w,
+        ln_b,
+        lx_w,
+        lx_b,
+        k_mix,
+        v_mix,
+        r_mix,
+        g_mix,
+        t_decay,
+        t_first,
+        kw,
+        vw,
+        rw,
+        gw,
+        ow,
+        kmx,
+        krx,
+        kmy,
+        kry,
+        vmx,
+        vrx,
+        vmy,
+        vry,
+        rmx,
+        rrx,
+        rmy,
+        rry,
+        gmx,
+        grx,
+        gmy,
+        gry,
+        omx,
+        orx,
+        omy,
+        ory,
+    ):
+        xx = F.layer_norm(x, (x.shape[-1],), weight=ln_w, bias=ln_b)
+        kx = xx * k_mix + sx * (1 - k_mix)
+        vx = xx * v_mix + sx * (1 - v_mix)
+        rx = xx * r_mix + sx * (1 - r_mix)
+        gx = xx * g_mix + sx * (1 - g_mix)
+
+        B = x.shape[0]
+        H = t_decay.shape[0]
+        N = x.shape[-1] // H
+
+        r = matmul(rx, rw, rmx, rrx, rmy, rry, output_dtype=torch.float32).view(
+            B, H, 1, N
+        )
+        k = matmul(kx, kw, kmx, krx, kmy, kry, output_dtype=torch.float32).view(
+            B, H, N, 1
+        )
+        v = matmul(vx, vw, vmx, vrx, vmy, vry, output_dtype=torch.float32).view(
+            B, H, 1, N
+        )
+        g = F.silu(matmul(gx, gw, gmx, grx, gmy, gry))
+
+        a = k @ v
+        out = r @ (t_first * a + s)
+        s = a + t_decay * s
+
+        out = out.view(B, H * N)
+        out = F.group_norm(out, num_groups=H, weight=lx_w, bias=lx_b, eps=64e-5)
+        out = out.to(dtype=x.dtype) * g
+        out = matmul(out, ow, omx, orx, omy, ory)
+
+        return x + out, xx, s
+
+    @MyFunction
+    def att_batch_v6_0(
+        self,
+        x,
+        sx,
+        s,
+        ln_w,
+        ln_b,
+        lx_w,
+        lx_b,
+        x_maa,
+        w_maa,
+        k_maa,
+        v_maa,
+        r_maa,
+        g_maa,
+        tm_w1,
+        tm_w2,
+        td_w1,
+        td_w2,
+        t_decay,
+        t_first,
+        kw,
+        vw,
+        rw,
+        gw,
+        ow,
+        kmx,
+        krx,
+        kmy,
+        kry,
+        vmx,
+        vrx,
+        vmy,
+        vry,
+        rmx,
+        rrx,
+        rmy,
+        rry,
+        gmx,
+        grx,
+        gmy,
+        gry,
+        omx,
+        orx,
+        omy,
+        ory,
+    ):
+        xx = F.layer_norm(x, (x.shape[-1],), weight=ln_w, bias=ln_b)
+
+        B = x.shape[0]
+        sx = sx - xx
+        xxx = xx + sx * x_maa
+        xxx = torch.tanh(xxx @ tm_w1).view(B, 5, -1).transpose(0, 1)
+        xxx = torch.bmm(xxx, tm_w2)
+        mw, mk, mv, mr, mg = xxx.unbind(dim=0)
+
+        wx = xx + sx * (w_maa + mw)
+        kx = xx + sx * (k_maa + mk)
+        vx = xx + sx * (v_maa + mv)
+        rx = xx + sx * (r_maa + mr)
+        gx = xx + sx * (g_maa + mg)
+
+        H = t_decay.shape[0]
+        N = x.shape[-1] // H
+
+        r = matmul(rx, rw, rmx, rrx, rmy, rry, output_dtype=torch.float32).view(
+            B, H, 1, N
+        )
+        k = matmul(kx, kw, kmx, krx, kmy, kry, output_dtype=torch.float32).view(
+            B, H, N, 1
+        )
+        v = matmul(vx, vw, vmx, vrx, vmy, vry, output_dtype=torch.float32).view(
+            B, H, 1, N
+        )
+        g = F.silu(matmul(gx, gw, gmx, grx, gmy, gry))
+
+        w = t_decay + (torch.tanh(wx @ td_w1) @ td_w2).float().view(B, H, N, 1)
+        w = torch.exp(-torch.exp(w.float()))
+
+        a = k @ v
+        out = r @ (t_first * a + s)
+        s = a + w * s
+
+        out = out.view(B, H * N)
+        out = F.group_norm(out, num_groups=H, weight=lx_w, bias=lx_b, eps=64e-5)
+        out = out.to(dtype=x.dtype) * g
+        out = matmul(out, ow, omx, orx, omy, ory)
+
+        return x + out, xx, s
+
     ########################################################################################################
 
     if os.environ["RWKV_CUDA_ON"] == "1":
@@ -2065,78 +2299,84 @@ class RWKV(MyModule):
 
     ########################################################################################################
 
+    def init_state(self):
+        w = self.w
+        args = self.args
+        if self.version == 4:
+            state = [None] * args.n_layer * 5
+            for i in range(
+                args.n_layer
+            ):  # state: 0=att_xx 1=att_aa 2=att_bb 3=att_pp 4=ffn_xx
+                dd = self.strategy[i]
+                dev = dd.device
+                atype = dd.atype
+                state[i * 5 + 0] = torch.zeros(
+                    args.n_embd, dtype=atype, requires_grad=False, device=dev
+                ).contiguous()
+                state[i * 5 + 1] = torch.zeros(
+                    args.n_att,
+                    dtype=torch.float,
+                    requires_grad=False,
+                    device=dev,
+                ).contiguous()
+                state[i * 5 + 2] = torch.zeros(
+                    args.n_att,
+                    dtype=torch.float,
+                    requires_grad=False,
+                    device=dev,
+                ).contiguous()
+                state[i * 5 + 3] = (
+                    torch.zeros(
+                        args.n_att,
+                        dtype=torch.float,
+                        requires_grad=False,
+                        device=dev,
+                    ).contiguous()
+                    - 1e30
+                )
+                state[i * 5 + 4] = torch.zeros(
+                    args.n_embd, dtype=atype, requires_grad=False, device=dev
+                ).contiguous()
+        elif int(self.version) in [5, 6]:
+            state = [None] * args.n_layer * 3
+            for i in range(args.n_layer):  # state: 0=att_xx 1=att_kv 2=ffn_xx
+                dd = self.strategy[i]
+                dev = dd.device
+                atype = dd.atype
+                state[i * 3 + 0] = torch.zeros(
+                    args.n_embd, dtype=atype, requires_grad=False, device=dev
+                ).contiguous()
+                if args.time_state:
+                    state[i * 3 + 1] = (
+                        w[f"blocks.{i}.att.time_state"]
+                        .transpose(1, 2)
+                        .to(dtype=torch.float, device=dev)
+                        .requires_grad_(False)
+                        .contiguous()
+                    )
+                else:
+                    state[i * 3 + 1] = torch.zeros(
+                        (
+                            args.n_head,
+                            args.n_att // args.n_head,
+                            args.n_att // args.n_head,
+                        ),
+                        dtype=torch.float,
+                        requires_grad=False,
+                        device=dev,
+                    ).contiguous()
+                state[i * 3 + 2] = torch.zeros(
+                    args.n_embd, dtype=atype, requires_grad=False, device=dev
+                ).contiguous()
+        return state
+
     def forward(self, tokens, state, full_output=False):
         with torch.no_grad():
             w = self.w
             args = self.args
 
             if state == None:
-                if self.version == 4:
-                    state = [None] * args.n_layer * 5
-                    for i in range(
-                        args.n_layer
-                    ):  # state: 0=att_xx 1=att_aa 2=att_bb 3=att_pp 4=ffn_xx
-                        dd = self.strategy[i]
-                        dev = dd.device
-                        atype = dd.atype
-                        state[i * 5 + 0] = torch.zeros(
-                            args.n_embd, dtype=atype, requires_grad=False, device=dev
-                        ).contiguous()
-                        state[i * 5 + 1] = torch.zeros(
-                            args.n_att,
-                            dtype=torch.float,
-                            requires_grad=False,
-                            device=dev,
-                        ).contiguous()
-                        state[i * 5 + 2] = torch.zeros(
-                            args.n_att,
-                            dtype=torch.float,
-                            requires_grad=False,
-                            device=dev,
-                        ).contiguous()
-                        state[i * 5 + 3] = (
-                            torch.zeros(
-                                args.n_att,
-                                dtype=torch.float,
-                                requires_grad=False,
-                                device=dev,
-                            ).contiguous()
-                            - 1e30
-                        )
-                        state[i * 5 + 4] = torch.zeros(
-                            args.n_embd, dtype=atype, requires_grad=False, device=dev
-                        ).contiguous()
-                elif int(self.version) in [5, 6]:
-                    state = [None] * args.n_layer * 3
-                    for i in range(args.n_layer):  # state: 0=att_xx 1=att_kv 2=ffn_xx
-                        dd = self.strategy[i]
-                        dev = dd.device
-                        atype = dd.atype
-                        state[i * 3 + 0] = torch.zeros(
-                            args.n_embd, dtype=atype, requires_grad=False, device=dev
-                        ).contiguous()
-                        if args.time_state:
-                            state[i * 3 + 1] = (
-                                w[f"blocks.{i}.att.time_state"]
-                                .transpose(1, 2)
-                                .to(dtype=torch.float, device=dev)
-                                .requires_grad_(False)
-                                .contiguous()
-                            )
-                        else:
-                            state[i * 3 + 1] = torch.zeros(
-                                (
-                                    args.n_head,
-                                    args.n_att // args.n_head,
-                                    args.n_att // args.n_head,
-                                ),
-                                dtype=torch.float,
-                                requires_grad=False,
-                                device=dev,
-                            ).contiguous()
-                        state[i * 3 + 2] = torch.zeros(
-                            args.n_embd, dtype=atype, requires_grad=False, device=dev
-                        ).contiguous()
+                state = self.init_state()
 
             seq_mode = len(tokens) > 1
 
@@ -2499,3 +2739,295 @@ class RWKV(MyModule):
                     )
 
             return x.float(), state
+
+    def forward_batch(self, tokens_list, states, batch_state=None):
+        """
+        Step several independent sequences together (v5.x / v6.0 only).
+        The last token of every sequence goes through the model as one [B, C] batch,
+        earlier tokens (prefill) are fed through forward() first.
+        batch_state: the states already stacked ([B, ...] tensors, one token per sequence),
+        they are updated in place and the returned states are views of their rows.
+        Returns a list of logits and a list of states, in the input order.
+        """
+        assert int(self.version) in [5, 6], "forward_batch only supports v5.x / v6.0"
+        assert len(tokens_list) == len(states)
+        with torch.no_grad():
+            w = self.w
+            args = self.args
+
+            B = len(tokens_list)
+            if batch_state is not None:
+                assert all(len(tokens) == 1 for tokens in tokens_list)
+                state = list(batch_state)
+            else:
+                states = list(states)
+                for b, tokens in enumerate(tokens_list):
+                    if len(tokens) > 1:
+                        _, states[b] = self.forward(tokens[:-1], states[b])
+                    elif states[b] is None:
+                        states[b] = self.init_state()
+                state = [
+                    torch.stack([s[j] for s in states])
+                    for j in range(args.n_layer * 3)
+                ]
+
+            x = w["emb.weight"][[tokens[-1] for tokens in tokens_list]]
+
+            for i in range(args.n_layer):
+                bbb = f"blocks.{i}."
+                att = f"blocks.{i}.att."
+                ffn = f"blocks.{i}.ffn."
+                dd = self.strategy[i]
+                dev = dd.device
+                atype = dd.atype
+                wtype = dd.wtype
+                if self.version == 5:
+                    ATT = self.att_batch_v5
+                elif self.version in [5.1, 5.2]:
+                    ATT = self.att_batch_v5_1
+                else:
+                    ATT = self.att_batch_v6_0
+                FFN = self.ffn_one  # [B, C] works as is
+                FFN_MIX = "time_mix"
+                if self.version >= 6.0:
+                    FFN = self.ffn_one_v6
+                    FFN_MIX = "time_maa"
+
+                x = x.to(dtype=atype, device=dev)
+
+                kw = w[f"{att}key.weight"]
+                vw = w[f"{att}value.weight"]
+                rw = w[f"{att}receptance.weight"]
+                ow = w[f"{att}output.weight"]
+                if dd.stream:
+                    kw = kw.to(device=dev, non_blocking=True)
+                    vw = vw.to(device=dev, non_blocking=True)
+                    rw = rw.to(device=dev, non_blocking=True)
+                    ow = ow.to(device=dev, non_blocking=True)
+                kmx = w[f"{att}key.weight_mx"] if wtype == torch.uint8 else x
+                krx = w[f"{att}key.weight_rx"] if wtype == torch.uint8 else x
+                kmy = w[f"{att}key.weight_my"] if wtype == torch.uint8 else x
+                kry = w[f"{att}key.weight_ry"] if wtype == torch.uint8 else x
+                vmx = w[f"{att}value.weight_mx"] if wtype == torch.uint8 else x
+                vrx = w[f"{att}value.weight_rx"] if wtype == torch.uint8 else x
+                vmy = w[f"{att}value.weight_my"] if wtype == torch.uint8 else x
+                vry = w[f"{att}value.weight_ry"] if wtype == torch.uint8 else x
+                rmx = w[f"{att}receptance.weight_mx"] if wtype == torch.uint8 else x
+                rrx = w[f"{att}receptance.weight_rx"] if wtype == torch.uint8 else x
+                rmy = w[f"{att}receptance.weight_my"] if wtype == torch.uint8 else x
+                rry = w[f"{att}receptance.weight_ry"] if wtype == torch.uint8 else x
+                omx = w[f"{att}output.weight_mx"] if wtype == torch.uint8 else x
+                orx = w[f"{att}output.weight_rx"] if wtype == torch.uint8 else x
+                omy = w[f"{att}output.weight_my"] if wtype == torch.uint8 else x
+                ory = w[f"{att}output.weight_ry"] if wtype == torch.uint8 else x
+                if self.version in [5.1, 5.2, 6.0]:
+                    gw = w[f"{att}gate.weight"]
+                    if dd.stream:
+                        gw = gw.to(device=dev, non_blocking=True)
+                    gmx = w[f"{att}gate.weight_mx"] if wtype == torch.uint8 else x
+                    grx = w[f"{att}gate.weight_rx"] if wtype == torch.uint8 else x
+                    gmy = w[f"{att}gate.weight_my"] if wtype == torch.uint8 else x
+                    gry = w[f"{att}gate.weight_ry"] if wtype == torch.uint8 else x
+                if self.version == 5:
+                    x, state[i * 3 + 0], state[i * 3 + 1] = ATT(
+                        x,
+                        state[i * 3 + 0],
+                        state[i * 3 + 1],
+                        w[f"{bbb}ln1.weight"],
+                        w[f"{bbb}ln1.bias"],
+                        w[f"{att}ln_x.weight"],
+                        w[f"{att}ln_x.bias"],
+                        w[f"{att}time_mix_k"],
+                        w[f"{att}time_mix_v"],
+                        w[f"{att}time_mix_r"],
+                        w[f"{att}time_decay"],
+                        w[f"{att}time_first"],
+                        kw,
+                        vw,
+                        rw,
+                        ow,
+                        kmx,
+                        krx,
+                        kmy,
+                        kry,
+                        vmx,
+                        vrx,
+                        vmy,
+                        vry,
+                        rmx,
+                        rrx,
+                        rmy,
+                        rry,
+                        omx,
+                        orx,
+                        omy,
+                        ory,
+                    )
+                elif self.version in [5.1, 5.2]:
+                    x, state[i * 3 + 0], state[i * 3 + 1] = ATT(
+                        x,
+                        state[i * 3 + 0],
+                        state[i * 3 + 1],
+                        w[f"{bbb}ln1.weight"],
+                        w[f"{bbb}ln1.bias"],
+                        w[f"{att}ln_x.weight"],
+                        w[f"{att}ln_x.bias"],
+                        w[f"{att}time_mix_k"],
+                        w[f"{att}time_mix_v"],
+                        w[f"{att}time_mix_r"],
+                        w[f"{att}time_mix_g"],
+                        w[f"{att}time_decay"],
+                        w[f"{att}time_first"],
+                        kw,
+                        vw,
+                        rw,
+                        gw,
+                        ow,
+                        kmx,
+                        krx,
+                        kmy,
+                        kry,
+                        vmx,
+                        vrx,
+                        vmy,
+                        vry,
+                        rmx,
+                        rrx,
+                        rmy,
+                        rry,
+                        gmx,
+                        grx,
+                        gmy,
+                        gry,
+                        omx,
+                        orx,
+                        omy,
+                        ory,
+                    )
+                else:
+                    x, state[i * 3 + 0], state[i * 3 + 1] = ATT(
+                        x,
+                        state[i * 3 + 0],
+                        state[i * 3 + 1],
+                        w[f"{bbb}ln1.weight"],
+                        w[f"{bbb}ln1.bias"],
+                        w[f"{att}ln_x.weight"],
+                        w[f"{att}ln_x.bias"],
+                        w[f"{att}time_maa_x"],
+                        w[f"{att}time_maa_w"],
+                        w[f"{att}time_maa_k"],
+                        w[f"{att}time_maa_v"],
+                        w[f"{att}time_maa_r"],
+                        w[f"{att}time_maa_g"],
+                        w[f"{att}time_maa_w1"],
+                        w[f"{att}time_maa_w2"],
+                        w[f"{att}time_decay_w1"],
+                        w[f"{att}time_decay_w2"],
+                        w[f"{att}time_decay"],
+                        w[f"{att}time_first"],
+                        kw,
+                        vw,
+                        rw,
+                        gw,
+                        ow,
+                        kmx,
+                        krx,
+                        kmy,
+                        kry,
+                        vmx,
+                        vrx,
+                        vmy,
+                        vry,
+                        rmx,
+                        rrx,
+                        rmy,
+                        rry,
+                        gmx,
+                        grx,
+                        gmy,
+                        gry,
+                        omx,
+                        orx,
+                        omy,
+                        ory,
+                    )
+                if dd.stream:
+                    del kw, vw, rw, ow
+                    if self.version in [5.1, 5.2, 6.0]:
+                        del gw
+
+                kw = w[f"{ffn}key.weight"]
+                vw = w[f"{ffn}value.weight"]
+                rw = w[f"{ffn}receptance.weight"]
+                if dd.stream:
+                    kw = kw.to(device=dev, non_blocking=True)
+                    vw = vw.to(device=dev, non_blocking=True)
+                    rw = rw.to(device=dev, non_blocking=True)
+                kmx = w[f"{ffn}key.weight_mx"] if wtype == torch.uint8 else x
+                krx = w[f"{ffn}key.weight_rx"] if wtype == torch.uint8 else x
+                kmy = w[f"{ffn}key.weight_my"] if wtype == torch.uint8 else x
+                kry = w[f"{ffn}key.weight_ry"] if wtype == torch.uint8 else x
+                vmx = w[f"{ffn}value.weight_mx"] if wtype == torch.uint8 else x
+                vrx = w[f"{ffn}value.weight_rx"] if wtype == torch.uint8 else x
+                vmy = w[f"{ffn}value.weight_my"] if wtype == torch.uint8 else x
+                vry = w[f"{ffn}value.weight_ry"] if wtype == torch.uint8 else x
+                rmx = w[f"{ffn}receptance.weight_mx"] if wtype == torch.uint8 else x
+                rrx = w[f"{ffn}receptance.weight_rx"] if wtype == torch.uint8 else x
+                rmy = w[f"{ffn}receptance.weight_my"] if wtype == torch.uint8 else x
+                rry = w[f"{ffn}receptance.weight_ry"] if wtype == torch.uint8 else x
+                offset = i * 3 + 2
+                x, state[offset] = FFN(
+                    x,
+                    state[offset],
+                    w[f"{bbb}ln2.weight"],
+                    w[f"{bbb}ln2.bias"],
+                    w[f"{ffn}{FFN_MIX}_k"],
+                    w[f"{ffn}{FFN_MIX}_r"],
+                    kw,
+                    vw,
+                    rw,
+                    kmx,
+                    krx,
+                    kmy,
+                    kry,
+                    vmx,
+                    vrx,
+                    vmy,
+                    vry,
+                    rmx,
+                    rrx,
+                    rmy,
+                    rry,
+                )
+                if dd.stream:
+                    del kw, vw, rw
+
+                if self.RESCALE_LAYER > 0:
+                    if (i + 1) % self.RESCALE_LAYER == 0:
+                        x = x / 2
+
+            dd = self.strategy[args.n_layer]
+            x = x.to(dtype=dd.atype, device=dd.device)
+
+            x = F.layer_norm(
+                x, (args.n_embd,), weight=w["ln_out.weight"], bias=w["ln_out.bias"]
+            )
+            if w["head.weight"].dtype != torch.uint8:
+                x = x @ w["head.weight"]  # one [B, C] x [C, V] GEMM for the whole batch
+            else:
+                x = mm8_seq(
+                    x,
+                    w["head.weight"],
+                    w["head.weight_mx"],
+                    w["head.weight_rx"],
+                    w["head.weight_my"],
+                    w["head.weight_ry"],
+                )
+
+            x = x.float()
+            if batch_state is not None:
+                for j in range(args.n_layer * 3):
+                    batch_state[j].copy_(state[j])
+                state = batch_state
+            out_states = [[s[b] for s in state] for b in range(B)]
+            return [x[b] for b in range(B)], out_states
@@ -2,7 +2,7 @@
 # The RWKV Language Model - https://github.com/BlinkDL/RWKV-LM
 ########################################################################################################
 
-import os, sys
+import os, sys, codecs
 import numpy as np
 import torch
 from torch.nn import functional as F
@@ -53,6 +53,44 @@ class ABC_TOKENIZER:
         return txt
 
 
+def bytes_to_unicode():
+    # the byte <-> printable char table of byte-level BPE (GPT-2, 20B_tokenizer)
+    bs = (
+        list(range(ord("!"), ord("~") + 1))
+        + list(range(ord("¡"), ord("¬") + 1))
+        + list(range(ord("®"), ord("ÿ") + 1))
+    )
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return dict(zip(bs, map(chr, cs)))
+
+
+class STREAM_DECODER:
+    """
+    Incremental detokenizer, tokens go in one step at a time and only complete
+    utf-8 characters come out. The bytes of an unfinished character are kept
+    until the next tokens, instead of re-decoding the whole tail every step.
+    """
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def decode(self, tokens) -> str:
+        return self.decoder.decode(
+            b"".join(self.pipeline.token_bytes(int(t)) for t in tokens)
+        )
+
+    @property
+    def pending(self) -> bool:
+        return len(self.decoder.getstate()[0]) > 0
+
+
 class PIPELINE:
     def __init__(self, model, WORD_NAME: str):
         self.model = model
@@ -99,49 +137,119 @@ class PIPELINE:
     def decode(self, x):
         return self.tokenizer.decode(x)
 
+    def token_bytes(self, token: int) -> bytes:
+        if hasattr(self.tokenizer, "idx2token"):  # TRIE_TOKENIZER
+            return self.tokenizer.idx2token.get(token, b"")
+        if hasattr(self.tokenizer, "decode_single_token_bytes"):  # tiktoken
+            return self.tokenizer.decode_single_token_bytes(token)
+        if "Tokenizer" in str(type(self.tokenizer)):
+            if not hasattr(self, "byte_decoder"):
+                self.byte_decoder = None
+                if "ByteLevel" in str(self.tokenizer.decoder):
+                    self.byte_decoder = {
+                        c: b for b, c in bytes_to_unicode().items()
+                    }
+            if self.byte_decoder is not None:
+                text = self.tokenizer.id_to_token(token) or ""
+                return b"".join(
+                    (
+                        bytes([self.byte_decoder[c]])
+                        if c in self.byte_decoder
+                        else c.encode("utf-8")  # special tokens
+                    )
+                    for c in text
+                )
+        return self.decode([token]).encode("utf-8")
+
+    def stream_decoder(self) -> STREAM_DECODER:
+        return STREAM_DECODER(self)
+
     def np_softmax(self, x: np.ndarray, axis: int):
         x -= x.max(axis=axis, keepdims=True)
         e: np.ndarray = np.exp(x)
         return e / e.sum(axis=axis, keepdims=True)
 
+    # top-p only looks at the highest probabilities first, the full vocab is sorted only
+    # when they do not reach top_p (very flat distributions)
+    TOP_P_CANDIDATES = 1024
+
     def sample_logits(self, logits, temperature=1.0, top_p=0.85, top_k=0):
+        """
+        logits: [vocab] or [B, vocab], list / np.ndarray / torch.Tensor.
+        Returns an int, or a list of B ints for batched logits.
+        """
         if type(logits) == list:
             logits = np.array(logits)
         np_logits = type(logits) == np.ndarray
-        if np_logits:
-            probs = self.np_softmax(logits, axis=-1)
-        else:
-            probs = F.softmax(logits.float(), dim=-1)
-        top_k = int(top_k)
         # 'privateuseone' is the type of custom devices like `torch_directml.device()`
-        if np_logits or probs.device.type in ["cpu", "privateuseone"]:
-            if not np_logits:
-                probs = probs.cpu().numpy()
-            sorted_ids = np.argsort(probs)
-            sorted_probs = probs[sorted_ids][::-1]
-            cumulative_probs = np.cumsum(sorted_probs)
-            cutoff = float(sorted_probs[np.argmax(cumulative_probs >= top_p)])
-            probs[probs < cutoff] = 0
-            if top_k < len(probs) and top_k > 0:
-                probs[sorted_ids[:-top_k]] = 0
-            if temperature != 1.0:
-                probs = probs ** (1.0 / temperature)
-            probs = probs / np.sum(probs)
-            out = np.random.choice(a=len(probs), p=probs)
-            return int(out)
+        if not np_logits and logits.device.type == "privateuseone":
+            logits = logits.float().cpu().numpy()
+            np_logits = True
+        batched = len(logits.shape) == 2
+        if not batched:
+            logits = logits[None, :]
+        if np_logits:
+            out = self.np_sample_probs(
+                self.np_softmax(logits.astype(np.float32), axis=-1),
+                temperature,
+                top_p,
+                int(top_k),
+            )
         else:
-            sorted_ids = torch.argsort(probs)
-            sorted_probs = probs[sorted_ids]
-            sorted_probs = torch.flip(sorted_probs, dims=(0,))
-            cumulative_probs = torch.cumsum(sorted_probs, dim=-1).cpu().numpy()
-            cutoff = float(sorted_probs[np.argmax(cumulative_probs >= top_p)])
-            probs[probs < cutoff] = 0
-            if top_k < len(probs) and top_k > 0:
-                probs[sorted_ids[:-top_k]] = 0
-            if temperature != 1.0:
-                probs = probs ** (1.0 / temperature)
-            out = torch.multinomial(probs, num_samples=1)[0]
-            return int(out)
+            out = self.torch_sample_probs(
+                F.softmax(logits.float(), dim=-1), temperature, top_p, int(top_k)
+            )
+        return out if batched else out[0]
+
+    def candidate_count(self, vocab: int, top_k: int) -> int:
+        if top_k < vocab and top_k > 0:
+            return top_k
+        return min(vocab, self.TOP_P_CANDIDATES)
+
+    def np_sample_probs(self, probs: np.ndarray, temperature, top_p, top_k):
+        vocab = probs.shape[-1]
+        c = self.candidate_count(vocab, top_k)
+        while True:
+            if c < vocab:
+                ids = np.argpartition(-probs, c - 1, axis=-1)[:, :c]
+            else:
+                ids = np.broadcast_to(np.arange(vocab), probs.shape)
+            cand = np.take_along_axis(probs, ids, axis=-1)
+            order = np.argsort(-cand, axis=-1)
+            ids = np.take_along_axis(ids, order, axis=-1)
+            cand = np.take_along_axis(cand, order, axis=-1)
+            cumulative_probs = np.cumsum(cand, axis=-1)
+            if c == vocab or top_k == c or (cumulative_probs[:, -1] >= top_p).all():
+                break
+            c = vocab
+        cut = np.minimum((cumulative_probs < top_p).sum(axis=-1, keepdims=True), c - 1)
+        cutoff = np.take_along_axis(cand, cut, axis=-1)
+        cand[cand < cutoff] = 0
+        if temperature != 1.0:
+            cand = cand ** (1.0 / temperature)
+        cdf = np.cumsum(cand, axis=-1)
+        r = np.random.random_sample((cand.shape[0], 1)) * cdf[:, -1:]
+        picked = np.minimum((cdf <= r).sum(axis=-1, keepdims=True), c - 1)
+        return np.take_along_axis(ids, picked, axis=-1)[:, 0].tolist()
+
+    def torch_sample_probs(self, probs: torch.Tensor, temperature, top_p, top_k):
+        vocab = probs.shape[-1]
+        c = self.candidate_count(vocab, top_k)
+        cand, ids = torch.topk(probs, c, dim=-1)  # sorted, stays on the device
+        cumulative_probs = torch.cumsum(cand, dim=-1)
+        if c < vocab and top_k != c:
+            # one scalar sync per step, only needed without top_k
+            if bool((cumulative_probs[:, -1] < top_p).any()):
+                c = vocab
+                cand, ids = torch.sort(probs, dim=-1, descending=True)
+                cumulative_probs = torch.cumsum(cand, dim=-1)
+        cut = (cumulative_probs < top_p).sum(dim=-1, keepdim=True).clamp(max=c - 1)
+        cutoff = torch.gather(cand, -1, cut)
+        cand = cand.masked_fill(cand < cutoff, 0)
+        if temperature != 1.0:
+            cand = cand ** (1.0 / temperature)
+        picked = torch.multinomial(cand, num_samples=1)
+        return torch.gather(ids, -1, picked)[:, 0].tolist()
 
     def generate(
         self, ctx, token_count=100, args=PIPELINE_ARGS(), callback=None, state=None
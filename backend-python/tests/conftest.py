@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 测试从backend-python目录导入routes、utils和config
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,116 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+os.environ.setdefault("RWKV_JIT_ON", "1")
+os.environ.setdefault("RWKV_CUDA_ON", "0")
+
+from rwkv_pip.model import RWKV  # noqa: E402
+
+VOCAB = 64
+EMBD = 32
+HEADS = 4
+FFN = 64
+LAYERS = 2
+# 长度不同的序列，长度1时不经过forward()预填充，直接进入批量解码
+SEQUENCES = [[3, 17, 42, 5, 9], [11], [8, 60, 2]]
+
+
+def rand(*shape):
+    return torch.randn(*shape) * 0.2
+
+
+def make_weights(version: str):
+    """随机权重的极小模型，键名和形状与对应版本的checkpoint一致"""
+    head_size = EMBD // HEADS
+    w = {
+        "emb.weight": rand(VOCAB, EMBD),
+        "blocks.0.ln0.weight": 1 + rand(EMBD),
+        "blocks.0.ln0.bias": rand(EMBD),
+    }
+    for i in range(LAYERS):
+        att = f"blocks.{i}.att."
+        ffn = f"blocks.{i}.ffn."
+        w[f"blocks.{i}.ln1.weight"] = 1 + rand(EMBD)
+        w[f"blocks.{i}.ln1.bias"] = rand(EMBD)
+        w[f"blocks.{i}.ln2.weight"] = 1 + rand(EMBD)
+        w[f"blocks.{i}.ln2.bias"] = rand(EMBD)
+        # 版本检测按键的顺序进行，ln_x要在time_decay之前
+        w[f"{att}ln_x.weight"] = 1 + rand(EMBD)
+        w[f"{att}ln_x.bias"] = rand(EMBD)
+        if version == "6.0":
+            for name in "xwkvrg":
+                w[f"{att}time_maa_{name}"] = torch.rand(1, 1, EMBD)
+            w[f"{att}time_maa_w1"] = rand(EMBD, 5 * 8)
+            w[f"{att}time_maa_w2"] = rand(5, 8, EMBD)
+            w[f"{att}time_decay_w1"] = rand(EMBD, 16)
+            w[f"{att}time_decay_w2"] = rand(16, EMBD)
+            w[f"{att}time_decay"] = rand(1, 1, EMBD) - 1
+            w[f"{att}time_faaaa"] = rand(HEADS, head_size)
+        else:
+            for name in "kvr" if version == "5.0" else "kvrg":
+                w[f"{att}time_mix_{name}"] = torch.rand(1, 1, EMBD)
+            if version == "5.0":
+                w[f"{att}time_decay"] = rand(HEADS) - 1
+                w[f"{att}time_first"] = rand(HEADS)
+            else:
+                w[f"{att}time_decay"] = rand(HEADS, head_size) - 1
+                w[f"{att}time_first"] = rand(HEADS, head_size)
+        for name in ["key", "value", "receptance", "output"]:
+            w[f"{att}{name}.weight"] = rand(EMBD, EMBD)
+        if version != "5.0":
+            w[f"{att}gate.weight"] = rand(EMBD, EMBD)
+        mix = "time_maa" if version == "6.0" else "time_mix"
+        w[f"{ffn}{mix}_k"] = torch.rand(1, 1, EMBD)
+        w[f"{ffn}{mix}_r"] = torch.rand(1, 1, EMBD)
+        w[f"{ffn}key.weight"] = rand(FFN, EMBD)
+        w[f"{ffn}value.weight"] = rand(EMBD, FFN)
+        w[f"{ffn}receptance.weight"] = rand(EMBD, EMBD)
+    w["ln_out.weight"] = 1 + rand(EMBD)
+    w["ln_out.bias"] = rand(EMBD)
+    w["head.weight"] = rand(VOCAB, EMBD)
+    return w
+
+
+@pytest.fixture(params=["5.0", "5.2", "6.0"])
+def model(request, tmp_path):
+    torch.manual_seed(0)
+    path = tmp_path / f"tiny-v{request.param}.pth"
+    torch.save(make_weights(request.param), path)
+    model = RWKV(str(path), "cpu fp32", verbose=False)
+    assert f"{model.version:.1f}" == request.param
+    return model
+
+
+def assert_close(actual, expected):
+    torch.testing.assert_close(actual, expected, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("batch", [1, 2, 3])
+def test_forward_batch_matches_forward(model, batch):
+    """批量解码（att_batch_v5/v5_1/v6_0）的logits和每层状态与逐条forward()一致"""
+    sequences = SEQUENCES[:batch]
+    expected = [model.forward(tokens, None) for tokens in sequences]
+
+    logits, states = model.forward_batch(sequences, [None] * batch)
+    assert len(logits) == len(states) == batch
+    for b, (out, state) in enumerate(expected):
+        assert_close(logits[b], out)
+        assert len(states[b]) == len(state) == LAYERS * 3
+        for actual, reference in zip(states[b], state):
+            assert_close(actual, reference)
+
+    # 第二步：在已堆叠的批量状态上原地解码一个token
+    next_tokens = [[7], [23], [51]][:batch]
+    batch_state = [
+        torch.stack([states[b][j] for b in range(batch)]).contiguous()
+        for j in range(LAYERS * 3)
+    ]
+    logits, states = model.forward_batch(next_tokens, [None] * batch, batch_state)
+    for b, (_, state) in enumerate(expected):
+        out, state = model.forward(next_tokens[b], [s.clone() for s in state])
+        assert_close(logits[b], out)
+        for actual, reference in zip(states[b], state):
+            assert_close(actual, reference)
@@ -0,0 +1,92 @@
+import threading
+import types
+
+import pytest
+
+from utils.ingest_pipeline import IngestPipeline
+
+
+def make_chunks(n, consumed=None):
+    for i in range(n):
+        if consumed is not None:
+            consumed.append(i)
+        yield f"id{i}", types.SimpleNamespace(page_content=f"text{i}"), {"chunk": i}
+
+
+def ingest_threads():
+    return [t for t in threading.enumerate() if t.name.startswith("ingest-")]
+
+
+def test_batch_sizes():
+    """向量化按embed_batch_size个一批，写入按upsert_batch_size个一批，最后一批可以较小"""
+    embedded, upserted = [], []
+
+    def embed(texts):
+        embedded.append(list(texts))
+        return [[float(text[4:])] for text in texts]
+
+    def upsert(ids, documents, embeddings, metadatas):
+        upserted.append((list(ids), embeddings, metadatas))
+
+    pipeline = IngestPipeline(embed, upsert, embed_batch_size=4, upsert_batch_size=10, queue_size=1)
+    stats = pipeline.run(make_chunks(23))
+
+    assert [len(batch) for batch in embedded] == [4, 4, 4, 4, 4, 3]
+    assert [len(ids) for ids, _, _ in upserted] == [10, 10, 3]
+    ids = [i for batch, _, _ in upserted for i in batch]
+    assert ids == [f"id{i}" for i in range(23)]
+    # 向量和metadata与ID一一对应
+    for batch, embeddings, metadatas in upserted:
+        for id_, embedding, metadata in zip(batch, embeddings, metadatas):
+            assert embedding == [float(id_[2:])]
+            assert metadata == {"chunk": int(id_[2:])}
+    summary = stats.to_dict()["stages"]
+    assert summary["embed"]["items"] == summary["upsert"]["items"] == 23
+    assert summary["embed"]["batches"] == 6 and summary["upsert"]["batches"] == 3
+    assert not ingest_threads()
+
+
+@pytest.mark.parametrize("stage", ["embed", "upsert"])
+def test_stage_error_stops_the_pipeline(stage):
+    """向量化或写入出错时，异常在调用线程中抛出，读取线程不再继续消费文本块"""
+    consumed = []
+    upserted = []
+
+    def embed(texts):
+        if stage == "embed" and len(consumed) > 8:
+            raise RuntimeError("embed failed")
+        return [[0.0] for _ in texts]
+
+    def upsert(ids, documents, embeddings, metadatas):
+        if stage == "upsert" and upserted:
+            raise RuntimeError("upsert failed")
+        upserted.extend(ids)
+
+    pipeline = IngestPipeline(embed, upsert, embed_batch_size=2, upsert_batch_size=2, queue_size=1)
+    with pytest.raises(RuntimeError, match=f"{stage} failed"):
+        pipeline.run(make_chunks(10000, consumed))
+
+    assert not ingest_threads()
+    # 队列有界，出错后只多读了几批
+    assert len(consumed) < 100
+    assert len(upserted) <= 8
+
+
+def test_parse_error_is_raised():
+    """解析出错时已读取的文本块不再写入，异常原样抛出"""
+    upserted = []
+
+    def chunks():
+        yield from make_chunks(3)
+        raise ValueError("broken file")
+
+    pipeline = IngestPipeline(
+        lambda texts: [[0.0] for _ in texts],
+        lambda ids, documents, embeddings, metadatas: upserted.extend(ids),
+        embed_batch_size=2,
+        upsert_batch_size=100,
+    )
+    with pytest.raises(ValueError, match="broken file"):
+        pipeline.run(chunks())
+    assert upserted == []
+    assert not ingest_threads()
@@ -0,0 +1,75 @@
+from utils.radix_tree import TokenRadixTree
+
+
+def test_insert_shares_prefix_nodes():
+    tree = TokenRadixTree()
+    a = tree.insert([1, 2, 3, 4])
+    b = tree.insert([1, 2, 5])
+    assert a != b
+    assert tree.insert([1, 2, 3, 4]) == a  # 已存在的条目返回原id
+    assert tree.tokens(a) == [1, 2, 3, 4]
+    assert tree.tokens(b) == [1, 2, 5]
+    # [1, 2]只存一次
+    assert tree.token_count == 5
+    assert len(tree) == 2
+
+
+def test_split_inside_an_edge():
+    tree = TokenRadixTree()
+    a = tree.insert([1, 2, 3, 4])
+    # 新条目在边的中间结束，边被切开，上半部分成为新条目的节点
+    b = tree.insert([1, 2])
+    assert tree.tokens(a) == [1, 2, 3, 4]
+    assert tree.tokens(b) == [1, 2]
+    assert tree.token_count == 4
+    assert tree.longest_prefix([1, 2, 3]) == (b, 2)
+    assert tree.longest_prefix([1, 2, 3, 4, 5]) == (a, 4)
+
+
+def test_longest_prefix_over_overlapping_runs():
+    tree = TokenRadixTree()
+    short = tree.insert([7, 7])
+    mid = tree.insert([7, 7, 7, 7])
+    tree.insert([7, 7, 8])
+    assert tree.longest_prefix([7]) == (-1, 0)
+    assert tree.longest_prefix([7, 7, 7]) == (short, 2)
+    assert tree.longest_prefix([7, 7, 7, 7, 7]) == (mid, 4)
+    assert tree.longest_prefix([8, 7]) == (-1, 0)
+    assert tree.longest_prefix([]) == (-1, 0)
+
+
+def test_shared_prefix_reports_the_branch_point():
+    tree = TokenRadixTree()
+    a = tree.insert([1, 2, 3, 4])
+    # 在边的中间分叉，分叉处没有条目
+    assert tree.shared_prefix([1, 2, 9]) == (2, None)
+    # 在已有条目处分叉
+    assert tree.shared_prefix([1, 2, 3, 4, 5]) == (4, a)
+    assert tree.shared_prefix([9]) == (0, None)
+    # 插入后分叉处成为一个没有条目的节点
+    tree.insert([1, 2, 9])
+    assert tree.shared_prefix([1, 2, 7]) == (2, None)
+    b = tree.insert([1, 2])
+    assert tree.shared_prefix([1, 2, 7]) == (2, b)
+
+
+def test_remove_merges_single_child_chains():
+    tree = TokenRadixTree()
+    a = tree.insert([1, 2, 3, 4])
+    b = tree.insert([1, 2, 5])
+    c = tree.insert([1, 2])
+    tree.remove(b)
+    assert b not in tree
+    assert tree.token_count == 4
+    assert tree.longest_prefix([1, 2, 5]) == (c, 2)
+    # 中间节点的条目删除后，只剩一个子节点的链合并回一条边
+    tree.remove(c)
+    assert tree.longest_prefix([1, 2, 5]) == (-1, 0)
+    assert tree.shared_prefix([1, 2, 5]) == (2, None)
+    assert tree.root.children[1].edge == (1, 2, 3, 4)
+    assert tree.tokens(a) == [1, 2, 3, 4]
+    tree.remove(a)
+    assert len(tree) == 0
+    assert tree.token_count == 0
+    assert tree.root.children == {}
+    tree.remove(a)  # 重复删除不报错
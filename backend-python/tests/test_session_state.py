@@ -0,0 +1,131 @@
+import types
+
+import pytest
+
+from rwkv_pip.rwkv_tokenizer import TRIE_TOKENIZER
+
+INTERFACE = "You are a helpful assistant."
+# 单字节token之外的合并token，其中"。\n\n"跨越回复和分隔符的边界
+MERGES = ["\n\n", ": ", "User", "Assistant", "【当前问题】", "。\n\n", "光合作用"]
+
+
+@pytest.fixture
+def completion():
+    return pytest.importorskip("routes.completion")
+
+
+@pytest.fixture
+def model(completion, tmp_path, monkeypatch):
+    np = pytest.importorskip("numpy")
+    rwkv = pytest.importorskip("utils.rwkv")
+    from utils.session_state import SessionStateStore
+
+    vocab = tmp_path / "vocab.txt"
+    lines = [f"{b + 1} {bytes([b])!r} 1" for b in range(256)]
+    for i, merge in enumerate(MERGES):
+        lines.append(f"{257 + i} {merge!r} {len(merge.encode('utf-8'))}")
+    vocab.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+    # 状态即已预填充的token序列，比较状态就是比较模型看到的token
+    class RecordingRWKV(rwkv.AbstractRWKV):
+        def adjust_occurrence(self, ctx, token):
+            pass
+
+        def adjust_forward_logits(self, ctx):
+            pass
+
+        def fix_tokens(self, tokens):
+            return tokens
+
+        def run_rnn(self, _tokens, newline_adj=0):
+            pass
+
+        def run_rnn_context(self, ctx, _tokens, newline_adj=0):
+            ctx.tokens = ctx.tokens + [int(x) for x in _tokens]
+            ctx.state = np.array(ctx.tokens, dtype=np.int64)
+            ctx.logits = np.zeros(4, dtype=np.float32)
+            return len(_tokens)
+
+        def run_rnn_batch(self, ctxs, tokens):
+            pass
+
+        def delta_postprocess(self, delta):
+            return delta
+
+        def cache_context(self, ctx):
+            pass
+
+    tokenizer = TRIE_TOKENIZER(str(vocab))
+    pipeline = types.SimpleNamespace(
+        encode=tokenizer.encode, stream_decoder=lambda: None
+    )
+    monkeypatch.setattr(rwkv, "session_state", SessionStateStore(1 << 20))
+    monkeypatch.setattr(
+        rwkv.state_cache, "longest_prefix_state", lambda *args, **kwargs: None
+    )
+    model = RecordingRWKV(types.SimpleNamespace(w={"emb.weight": []}), pipeline)
+    return model, tokenizer
+
+
+def make_body(completion, messages):
+    return completion.ChatCompletionBody(
+        messages=messages, user_id="u1", session_id="s1", presystem=True
+    )
+
+
+def prefill(completion, model, messages):
+    body = make_body(completion, messages)
+    prompt = completion.chat_template(model, body, INTERFACE, "User", "Assistant")
+    session = completion.chat_session_template(body, INTERFACE, "User", "Assistant")
+    ctx = model.create_context(prompt, None, session)
+    model.prefill_context(ctx)
+    return prompt, ctx
+
+
+TURN_2 = [
+    {"role": "user", "content": "什么是光合作用？"},
+    {"role": "assistant", "content": "光合作用把光能转化为化学能。"},
+    {"role": "user", "content": "它发生在哪里？"},
+]
+TURN_3 = TURN_2 + [
+    {"role": "assistant", "content": "主要发生在叶绿体中。"},
+    {"role": "user", "content": "需要哪些条件？"},
+]
+
+
+def test_current_question_marker(completion):
+    body = make_body(completion, TURN_2)
+    prompt = completion.chat_template(None, body, INTERFACE, "User", "Assistant")
+    assert "\n\n【当前问题】User: 它发生在哪里？\n\n" in prompt
+    assert prompt.count("【当前问题】") == 1
+    history = completion.chat_history_template(body, INTERFACE, "User", "Assistant")
+    assert prompt.startswith(history)
+    assert history.endswith("Assistant: 光合作用把光能转化为化学能。\n\n")
+
+
+def test_hit_prefills_the_cold_render(completion, model):
+    """命中会话状态时预填充的token序列与完整prompt冷启动时完全一致"""
+    model, tokenizer = model
+    prefill(completion, model, TURN_2)  # 保存第二轮对话历史结束处的状态
+
+    prompt, ctx = prefill(completion, model, TURN_3)
+    cold = tokenizer.encode(prompt)
+    assert ctx.tokens == cold
+    assert ctx.state.tolist() == cold
+    # 只预填充了上一轮的问答和本轮问题
+    history = completion.chat_history_template(
+        make_body(completion, TURN_2), INTERFACE, "User", "Assistant"
+    )
+    assert ctx.prefill_tokens == len(cold) - len(tokenizer.encode(history))
+
+
+def test_changed_history_misses(completion, model):
+    """历史被修改后，缓存的token不再是prompt的前缀，完整预填充"""
+    model, tokenizer = model
+    prefill(completion, model, TURN_2)
+
+    edited = [dict(message) for message in TURN_3]
+    edited[1]["content"] = "新的回复。"
+    prompt, ctx = prefill(completion, model, edited)
+    assert ctx.tokens == tokenizer.encode(prompt)
+    assert ctx.prefill_tokens == len(ctx.tokens)
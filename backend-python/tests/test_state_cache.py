@@ -0,0 +1,54 @@
+import pytest
+
+
+@pytest.fixture
+def state_cache(monkeypatch):
+    pytest.importorskip("torch")
+    state_cache = pytest.importorskip("routes.state_cache")
+    state_cache.init()
+    monkeypatch.setattr(state_cache, "dtrie", {})
+    monkeypatch.setattr(state_cache, "lru", state_cache.OrderedDict())
+    yield state_cache
+    state_cache.trie = None
+
+
+def add(state_cache, tokens, namespace=""):
+    import torch
+
+    state = [torch.full((4,), float(len(tokens))), torch.zeros(2, 2)]
+    state_cache.add_state(
+        state_cache.AddStateBody(
+            tokens=tokens, state=state, logits=torch.zeros(8), namespace=namespace
+        )
+    )
+
+
+def lookup(state_cache, tokens, namespace=""):
+    return state_cache.longest_prefix_state(
+        state_cache.LongestPrefixStateBody(tokens=tokens, namespace=namespace), None
+    )
+
+
+def test_branch_point_gets_a_snapshot(state_cache):
+    """两个prompt分叉处在切分边时没有状态，预填充在分叉处缓存状态后，第三个prompt从分叉处开始"""
+    add(state_cache, [1, 2, 3, 4, 5, 6])
+    assert state_cache.branch_offset([1, 2, 3, 9, 9]) == 3
+    # 前缀已有状态或prompt是已有路径的前缀时不需要切分
+    assert state_cache.branch_offset([1, 2, 3, 4, 5, 6, 7]) == 0
+    assert state_cache.branch_offset([1, 2, 3]) == 0
+    assert state_cache.branch_offset([8, 9]) == 0
+
+    add(state_cache, [1, 2, 3])  # 预填充到分叉处时缓存的状态
+    add(state_cache, [1, 2, 3, 9, 9])
+    assert state_cache.branch_offset([1, 2, 3, 7]) == 0
+
+    hit = lookup(state_cache, [1, 2, 3, 7, 7])
+    assert hit["tokens"] == [1, 2, 3]
+    assert hit["state"][0][0].item() == 3
+
+
+def test_branch_offset_is_per_namespace(state_cache):
+    add(state_cache, [1, 2, 3, 4], "preset-a.pth")
+    assert state_cache.branch_offset([1, 2, 9], "preset-a.pth") == 2
+    assert state_cache.branch_offset([1, 2, 9], "preset-b.pth") == 0
+    assert state_cache.branch_offset([1, 2, 9]) == 0
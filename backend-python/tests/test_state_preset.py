@@ -0,0 +1,25 @@
+import os
+
+from utils.state_preset import StatePresetRegistry
+
+
+def test_rewritten_file_gets_a_new_namespace(tmp_path):
+    """state文件更新后重新加载，命名空间随修改时间改变，旧文件的缓存不会再命中"""
+    path = tmp_path / "preset.pth"
+    path.write_bytes(b"v1")
+    registry = StatePresetRegistry(2)
+    load = lambda p: open(p, "rb").read()
+
+    state, namespace = registry.get("model.pth", str(path), load)
+    assert state == b"v1"
+    assert namespace.startswith(str(path) + "@")
+    assert registry.get("model.pth", str(path), load) == (state, namespace)
+    assert registry.loads == 1 and registry.hits == 1
+
+    path.write_bytes(b"v2")
+    mtime = os.path.getmtime(path) + 10
+    os.utime(path, (mtime, mtime))
+    state, reloaded = registry.get("model.pth", str(path), load)
+    assert state == b"v2"
+    assert reloaded != namespace
+    assert registry.loads == 2
@@ -0,0 +1,77 @@
+import pytest
+
+knowledge = pytest.importorskip("utils.knowledge")
+
+# 编号不同的句子，每个窗口在全文中的位置唯一
+SENTENCES = [f"第{i}句话" + "内容" * (i % 7) + "。" for i in range(120)]
+
+
+def pages(sentences, per_page):
+    return ["".join(sentences[i : i + per_page]) for i in range(0, len(sentences), per_page)]
+
+
+def locate(windows, full, overlap_cap, separator=""):
+    """依次找到每个窗口在全文中的位置，返回每个窗口与上一个窗口重叠的字符数"""
+    overlaps = []
+    pos = 0
+    for window in windows:
+        start = full.find(window, max(0, pos - overlap_cap))
+        assert start >= 0, "窗口不是原文的连续片段"
+        # 窗口之间没有丢失文本，重叠不超过上限
+        assert pos - overlap_cap <= start <= pos + len(separator)
+        overlaps.append(max(0, pos - start))
+        pos = start + len(window)
+    assert pos == len(full)
+    return overlaps
+
+
+def test_window_cut_prefers_paragraphs_then_sentences():
+    text = "甲" * 10 + "。" + "乙" * 10 + "\n\n" + "丙" * 5 + "。丁"
+    assert knowledge._window_cut(text) == text.index("丙")
+    text = "甲" * 10 + "\n" + "乙" * 10 + "。丙"
+    assert knowledge._window_cut(text) == len(text) - 1
+    # 切分点只在后半段查找，找不到时整段输出
+    assert knowledge._window_cut("甲\n\n" + "乙" * 20) == 23
+
+
+@pytest.mark.parametrize("overlap", [0, 20, 60])
+def test_windows_keep_all_text(overlap):
+    """PDF按页拼接：窗口依次覆盖全文，不丢字，重叠从句首开始且不超过上限"""
+    parts = pages(SENTENCES, 3)
+    full = "".join(parts)
+    windows = list(knowledge._iter_text_windows(parts, 200, "", overlap))
+    assert len(windows) > 5
+    cap = min(overlap, 200 // 4)
+    overlaps = locate(windows, full, cap)
+    assert overlaps[0] == 0
+    for window, overlapped in zip(windows[1:], overlaps[1:]):
+        assert overlapped <= cap
+        if overlapped:
+            # 重叠部分由完整的句子组成
+            start = full.find(window)
+            assert full[start - 1] == "。"
+    # 重复的文本只有窗口之间的重叠
+    assert sum(map(len, windows)) - len(full) == sum(overlaps) <= (len(windows) - 1) * cap
+
+
+def test_overlap_is_capped():
+    """重叠不超过窗口的1/4，较大的overlap_chars不会让窗口重复输出"""
+    parts = pages(SENTENCES, 2)
+    full = "".join(parts)
+    windows = list(knowledge._iter_text_windows(parts, 100, "", 1000))
+    overlaps = locate(windows, full, 25)
+    assert max(overlaps) <= 25
+    assert sum(map(len, windows)) <= len(full) + (len(windows) - 1) * 25
+
+
+def test_paragraph_windows_keep_all_text():
+    """DOCX按段落以换行拼接，窗口同样覆盖全文"""
+    parts = SENTENCES
+    full = "\n".join(parts)
+    windows = list(knowledge._iter_text_windows(parts, 150, "\n", 30))
+    locate(windows, full, 30, "\n")
+
+
+def test_short_input_is_one_window():
+    assert list(knowledge._iter_text_windows(["甲。", "乙。"], 200, "", 20)) == ["甲。乙。"]
+    assert list(knowledge._iter_text_windows([], 200, "", 20)) == []
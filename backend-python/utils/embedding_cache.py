@@ -0,0 +1,174 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from config.settings import get_settings
+
+
+class EmbeddingCache:
+    """
+    文本块向量的磁盘缓存：键为模型名、max_length和文本的哈希，向量以float16保存在SQLite中。
+    同一本教材被多位老师上传、重复上传或重建ask目录时，相同的文本块直接读取已有向量。
+    超出磁盘预算时按最近使用时间淘汰；SQLite使用WAL模式，多个worker进程可以共用同一个文件。
+    """
+
+    def __init__(self, path: str, budget_bytes: int):
+        self.path = path
+        self.budget_bytes = budget_bytes
+        self.conn: Optional[sqlite3.Connection] = None
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget_bytes > 0
+
+    def __connect(self) -> Optional[sqlite3.Connection]:
+        # 第一次使用时打开，打开失败时关闭缓存，不影响向量化
+        if self.conn is None and self.enabled:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings ("
+                    "key TEXT PRIMARY KEY, vector BLOB NOT NULL, used REAL NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings(used)")
+                conn.commit()
+                self.nbytes = conn.execute(
+                    "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+                ).fetchone()[0]
+                self.conn = conn
+            except sqlite3.Error as e:
+                print(f"Error opening embedding cache {self.path}: {e}")
+                self.budget_bytes = 0
+        return self.conn
+
+    @staticmethod
+    def key(model: str, max_length: int, text: str) -> str:
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        return f"{model}/{max_length}/{digest}"
+
+    def get_many(self, model: str, max_length: int, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        返回与texts一一对应的向量，未缓存的为None
+        """
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        with self.lock:
+            conn = self.__connect()
+            if conn is None or not texts:
+                return results
+            keys = [self.key(model, max_length, text) for text in texts]
+            found: Dict[str, bytes] = {}
+            try:
+                # SQLite的参数个数有上限，分批查询
+                unique = list(dict.fromkeys(keys))
+                for start in range(0, len(unique), 500):
+                    batch = unique[start : start + 500]
+                    rows = conn.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                        batch,
+                    ).fetchall()
+                    found.update(rows)
+                if found:
+                    now = time.time()
+                    conn.executemany(
+                        "UPDATE embeddings SET used = ? WHERE key = ?",
+                        [(now, key) for key in found],
+                    )
+                    conn.commit()
+            except sqlite3.Error as e:
+                print(f"Error reading embedding cache: {e}")
+                return results
+
+            for i, key in enumerate(keys):
+                vector = found.get(key)
+                if vector is not None:
+                    results[i] = np.frombuffer(vector, dtype=np.float16).astype(np.float32).tolist()
+            hit_count = len([x for x in results if x is not None])
+            self.hits += hit_count
+            self.misses += len(texts) - hit_count
+        return results
+
+    def put_many(self, model: str, max_length: int, texts: List[str], vectors: List[List[float]]):
+        with self.lock:
+            conn = self.__connect()
+            if conn is None or not texts:
+                return
+            now = time.time()
+            rows = {}
+            for text, vector in zip(texts, vectors):
+                rows[self.key(model, max_length, text)] = np.asarray(vector, dtype=np.float16).tobytes()
+            try:
+                existing = 0
+                keys = list(rows.keys())
+                for start in range(0, len(keys), 500):
+                    batch = keys[start : start + 500]
+                    existing += conn.execute(
+                        f"SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                        batch,
+                    ).fetchone()[0]
+                conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector, used) VALUES (?, ?, ?)",
+                    [(key, vector, now) for key, vector in rows.items()],
+                )
+                conn.commit()
+                self.nbytes += sum(len(vector) for vector in rows.values()) - existing
+                self.__evict(conn)
+            except sqlite3.Error as e:
+                print(f"Error writing embedding cache: {e}")
+
+    def __evict(self, conn: sqlite3.Connection):
+        if self.nbytes <= self.budget_bytes:
+            return
+        # 其他进程也在写，淘汰前重新统计实际大小
+        self.nbytes = conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()[0]
+        # 淘汰到预算的90%，避免每次写入都触发淘汰
+        target = self.budget_bytes * 0.9
+        while self.nbytes > target:
+            rows = conn.execute(
+                "SELECT key, LENGTH(vector) FROM embeddings ORDER BY used LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                self.nbytes = 0
+                break
+            victims = []
+            for key, size in rows:
+                if self.nbytes <= target:
+                    break
+                victims.append((key,))
+                self.nbytes -= size
+            conn.executemany("DELETE FROM embeddings WHERE key = ?", victims)
+            conn.commit()
+            self.evictions += len(victims)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "path": self.path,
+                "bytes": self.nbytes,
+                "budget_bytes": self.budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+settings = get_settings()
+embedding_cache = EmbeddingCache(
+    str(settings.EMBEDDING_CACHE_PATH / "embeddings.sqlite3"),
+    settings.EMBEDDING_CACHE_BUDGET_MB * 1024 * 1024,
+)
@@ -0,0 +1,201 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+# 文本块：(ID, Document, metadata)
+Chunk = Tuple[str, Any, Optional[Dict[str, Any]]]
+
+STAGES = ("parse", "split", "embed", "upsert")
+
+_DONE = object()
+
+
+class IngestStats:
+    """
+    入库各阶段的计数和耗时：items为处理条数（parse为文本段数，其余为文本块数），
+    seconds为阶段本身的耗时，blocked_seconds为下游队列已满时等待的时间。
+    """
+
+    def __init__(self):
+        self.stages = {
+            name: {"items": 0, "batches": 0, "seconds": 0.0, "blocked_seconds": 0.0}
+            for name in STAGES
+        }
+        self.files = 0
+        self.failed_files = 0
+        self.lock = threading.Lock()
+
+    def record(self, stage: str, items: int, seconds: float):
+        with self.lock:
+            self.stages[stage]["items"] += items
+            self.stages[stage]["batches"] += 1
+            self.stages[stage]["seconds"] += seconds
+
+    def blocked(self, stage: str, seconds: float):
+        with self.lock:
+            self.stages[stage]["blocked_seconds"] += seconds
+
+    def file_done(self, failed: bool = False):
+        with self.lock:
+            if failed:
+                self.failed_files += 1
+            else:
+                self.files += 1
+
+    def merge(self, other: "IngestStats"):
+        with self.lock:
+            for name, counters in other.stages.items():
+                for key, value in counters.items():
+                    self.stages[name][key] += value
+            self.files += other.files
+            self.failed_files += other.failed_files
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "files": self.files,
+                "failed_files": self.failed_files,
+                "stages": {
+                    name: {
+                        "items": counters["items"],
+                        "batches": counters["batches"],
+                        "seconds": round(counters["seconds"], 3),
+                        "blocked_seconds": round(counters["blocked_seconds"], 3),
+                    }
+                    for name, counters in self.stages.items()
+                },
+            }
+
+    def summary(self) -> str:
+        return "，".join(
+            f"{name} {counters['items']}条/{counters['seconds']:.2f}s"
+            for name, counters in self.to_dict()["stages"].items()
+        )
+
+
+class IngestPipeline:
+    """
+    流式入库：解析+分块 -> 向量化 -> 写入，三个阶段分别在读取线程、向量化线程和调用线程中运行，
+    之间用有界队列连接。文本块按embed_batch_size个一批向量化，按upsert_batch_size个一批写入，
+    内存占用只取决于队列长度和批次大小，与文档大小无关；下游变慢时上游在队列上等待。
+    """
+
+    def __init__(self, embed: Callable[[List[str]], List[List[float]]],
+                 upsert: Callable[[List[str], List[Any], List[List[float]], List[Optional[Dict[str, Any]]]], Any],
+                 embed_batch_size: int = 32, upsert_batch_size: int = 256, queue_size: int = 4):
+        self.embed = embed
+        self.upsert = upsert
+        self.embed_batch_size = max(1, embed_batch_size)
+        self.upsert_batch_size = max(1, upsert_batch_size)
+        self.queue_size = max(1, queue_size)
+
+    def run(self, chunks: Iterable[Chunk], stats: Optional[IngestStats] = None) -> IngestStats:
+        """
+        消费chunks（解析和分块在迭代时发生）直到结束，返回各阶段统计；
+        任一阶段出错时停止其他阶段，并在调用线程中抛出该异常，已写入的批次不会回滚。
+        """
+        stats = stats or IngestStats()
+        to_embed: "queue.Queue" = queue.Queue(maxsize=self.queue_size)
+        to_upsert: "queue.Queue" = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        errors: List[BaseException] = []
+
+        def fail(e: BaseException):
+            errors.append(e)
+            stop.set()
+
+        def put(q: "queue.Queue", item, stage: str) -> bool:
+            # 队列满时等待下游，其他阶段出错后放弃
+            start = time.perf_counter()
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    stats.blocked(stage, time.perf_counter() - start)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def get(q: "queue.Queue"):
+            while True:
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    if stop.is_set():
+                        return _DONE
+
+        def read():
+            batch: List[Chunk] = []
+            try:
+                for chunk in chunks:
+                    batch.append(chunk)
+                    if len(batch) >= self.embed_batch_size:
+                        if not put(to_embed, batch, "split"):
+                            return
+                        batch = []
+                if batch and not put(to_embed, batch, "split"):
+                    return
+            except BaseException as e:
+                fail(e)
+            finally:
+                put(to_embed, _DONE, "split")
+
+        def embed():
+            try:
+                while True:
+                    batch = get(to_embed)
+                    if batch is _DONE:
+                        break
+                    start = time.perf_counter()
+                    vectors = self.embed([doc.page_content for _, doc, _ in batch])
+                    stats.record("embed", len(batch), time.perf_counter() - start)
+                    if not put(to_upsert, (batch, vectors), "embed"):
+                        return
+            except BaseException as e:
+                fail(e)
+            finally:
+                put(to_upsert, _DONE, "embed")
+
+        def flush(batch: List[Chunk], vectors: List[List[float]]):
+            start = time.perf_counter()
+            self.upsert(
+                [cid for cid, _, _ in batch],
+                [doc for _, doc, _ in batch],
+                vectors,
+                [metadata for _, _, metadata in batch],
+            )
+            stats.record("upsert", len(batch), time.perf_counter() - start)
+
+        threads = [
+            threading.Thread(target=read, name="ingest-read", daemon=True),
+            threading.Thread(target=embed, name="ingest-embed", daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+
+        pending: List[Chunk] = []
+        pending_vectors: List[List[float]] = []
+        try:
+            while True:
+                item = get(to_upsert)
+                if item is _DONE:
+                    break
+                batch, vectors = item
+                pending.extend(batch)
+                pending_vectors.extend(vectors)
+                while len(pending) >= self.upsert_batch_size:
+                    flush(pending[:self.upsert_batch_size], pending_vectors[:self.upsert_batch_size])
+                    pending = pending[self.upsert_batch_size:]
+                    pending_vectors = pending_vectors[self.upsert_batch_size:]
+            if pending and not stop.is_set():
+                flush(pending, pending_vectors)
+        except BaseException as e:
+            fail(e)
+        finally:
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+        return stats
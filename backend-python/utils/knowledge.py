@@ -6,9 +6,14 @@ import chromadb
 import os
 import fitz  # PyMuPDF 用于处理 PDF 文件
 import docx  # python-docx 用于处理 DOCX 文件
+import hashlib
 import re
+import threading
+import time
 import uuid
 from typing import List, Dict, Any, Optional
+from utils.embedding_cache import embedding_cache
+from utils.ingest_pipeline import IngestPipeline, IngestStats
 from config.settings import get_settings
 
 # 智能文本分块器
@@ -151,32 +156,81 @@ class SmartTextSplitter:
         
         return docs
 
+# ChromaDB连接：每个host:port只创建一个HttpClient，进程内共用（底层HTTP会话保持连接），
+# 同时缓存collection句柄，检索时不再额外请求get_collection
+class ChromaConnection:
+    def __init__(self, host: str, port: int):
+        self.client = chromadb.HttpClient(host=host, port=port)
+        self.collections: Dict[str, Any] = {}  # collection名称 -> Collection对象
+        self.lock = threading.Lock()
+
+
+_chroma_connections: Dict[tuple, ChromaConnection] = {}
+_chroma_connections_lock = threading.Lock()
+
+
+def get_chroma_connection(host: str, port: int) -> ChromaConnection:
+    """获取共享的ChromaDB连接，创建失败时抛出异常，下次调用重新尝试"""
+    key = (host, port)
+    connection = _chroma_connections.get(key)
+    if connection is None:
+        with _chroma_connections_lock:
+            connection = _chroma_connections.get(key)
+            if connection is None:
+                connection = ChromaConnection(host, port)
+                _chroma_connections[key] = connection
+                print(f"✅ 成功连接到ChromaDB: {host}:{port}")
+    return connection
+
 # ChromaDB管理器
 class ChromaDBManager:
     def __init__(self, host: str = "localhost", port: int = 8000):
-        """初始化ChromaDB管理器"""
+        """初始化ChromaDB管理器，使用共享的客户端，创建开销很小"""
         self.host = host
         self.port = port
         self.client = None
+        self._connection: Optional[ChromaConnection] = None
         self._init_client()
     
     def _init_client(self):
         """初始化ChromaDB客户端"""
         try:
-            self.client = chromadb.HttpClient(host=self.host, port=self.port)
-            print(f"✅ 成功连接到ChromaDB: {self.host}:{self.port}")
+            self._connection = get_chroma_connection(self.host, self.port)
+            self.client = self._connection.client
         except Exception as e:
             print(f"❌ 连接ChromaDB失败: {e}")
             raise
     
+    def _cache_collection(self, collection_name: str, collection):
+        with self._connection.lock:
+            self._connection.collections[collection_name] = collection
+        return collection
+    
+    def invalidate_collection(self, collection_name: str):
+        """丢弃缓存的collection句柄，collection被删除或重建后调用"""
+        with self._connection.lock:
+            self._connection.collections.pop(collection_name, None)
+    
+    def get_collection(self, collection_name: str):
+        """获取已存在的collection，句柄缓存后不再请求服务器；不存在时抛出异常"""
+        collection = self._connection.collections.get(collection_name)
+        if collection is None:
+            collection = self._cache_collection(
+                collection_name, self.client.get_collection(collection_name)
+            )
+        return collection
+    
     def get_or_create_collection(self, collection_name: str):
         """获取或创建collection"""
+        collection = self._connection.collections.get(collection_name)
+        if collection is not None:
+            return collection
         try:
             collection = self.client.get_or_create_collection(
                 name=collection_name,
                 metadata={"hnsw:space": "cosine"}
             )
-            return collection
+            return self._cache_collection(collection_name, collection)
         except Exception as e:
             print(f"❌ 创建collection失败: {e}")
             raise
@@ -203,16 +257,62 @@ class ChromaDBManager:
             print(f"❌ 添加文档失败: {e}")
             raise
     
-    def search_documents(self, collection_name: str, query_embedding: List[float], top_k: int = 5):
-        """搜索文档"""
+    def upsert_documents(self, collection_name: str, ids: List[str], documents: List[Document],
+                         embeddings: List[List[float]], metadatas: List[Dict[str, Any]]):
+        """按给定ID写入文档，ID已存在时覆盖"""
+        try:
+            collection = self.get_or_create_collection(collection_name)
+            collection.upsert(
+                ids=ids,
+                embeddings=embeddings,
+                documents=[doc.page_content for doc in documents],
+                metadatas=metadatas
+            )
+            print(f"✅ 成功写入 {len(documents)} 个文档到collection: {collection_name}")
+            return ids
+        except Exception as e:
+            print(f"❌ 写入文档失败: {e}")
+            raise
+    
+    def get_chunk_metadatas(self, collection_name: str) -> List[tuple]:
+        """返回collection中所有文本块的(ID, metadata)，不取文档和向量"""
+        try:
+            collection = self.get_or_create_collection(collection_name)
+            results = collection.get(include=['metadatas'])
+            return list(zip(results['ids'], results['metadatas'] or [None] * len(results['ids'])))
+        except Exception as e:
+            print(f"❌ 获取文档信息失败: {e}")
+            raise
+    
+    def delete_documents(self, collection_name: str, ids: List[str]):
+        """按ID删除文本块"""
         try:
-            collection = self.client.get_collection(collection_name)
-            results = collection.query(
+            collection = self.get_or_create_collection(collection_name)
+            collection.delete(ids=ids)
+            print(f"✅ 成功从collection {collection_name} 删除 {len(ids)} 个文档")
+        except Exception as e:
+            print(f"❌ 删除文档失败: {e}")
+            raise
+    
+    def search_documents(self, collection_name: str, query_embedding: List[float], top_k: int = 5):
+        """搜索文档，句柄已缓存时只有一次请求"""
+        def query(collection):
+            return collection.query(
                 query_embeddings=[query_embedding],
                 n_results=top_k,
                 include=['documents', 'distances']
             )
-            return results
+        
+        try:
+            cached = collection_name in self._connection.collections
+            try:
+                return query(self.get_collection(collection_name))
+            except Exception:
+                if not cached:
+                    raise
+                # 缓存的句柄可能已失效（collection在别处被删除或重建），重新获取后再试一次
+                self.invalidate_collection(collection_name)
+                return query(self.get_collection(collection_name))
         except Exception as e:
             print(f"❌ 搜索文档失败: {e}")
             raise
@@ -220,6 +320,7 @@ class ChromaDBManager:
     def delete_collection(self, collection_name: str):
         """删除collection"""
         try:
+            self.invalidate_collection(collection_name)
             self.client.delete_collection(collection_name)
             print(f"✅ 成功删除collection: {collection_name}")
         except Exception as e:
@@ -237,12 +338,37 @@ class ChromaDBManager:
 
 # BGEM3模型管理器
 class BGEM3Manager:
-    def __init__(self, model_path: str):
+    def __init__(self, model_path: str, max_length: int = 512):
         """初始化BGEM3模型管理器"""
         self.model_path = model_path
+        self.model_name = self._model_key(model_path)
+        self.max_length = max_length
         self.model = None
+        # 同一实例被请求、预热和入库线程共用，分词器不支持并发调用，推理时串行
+        self.lock = threading.Lock()
         self._load_model()
     
+    @staticmethod
+    def _model_key(model_path: str) -> str:
+        """
+        向量缓存的模型标识：目录名加上解析后的路径、配置文件内容和权重文件大小的哈希，
+        同名的不同模型或替换过权重的模型不会读到彼此的向量
+        """
+        if not os.path.isdir(model_path):
+            return model_path  # HuggingFace模型名，由加载时的版本决定
+        resolved = os.path.realpath(model_path)
+        digest = hashlib.sha1(resolved.encode("utf-8"))
+        for name in sorted(os.listdir(resolved)):
+            file_path = os.path.join(resolved, name)
+            if not os.path.isfile(file_path):
+                continue
+            if name.endswith(".json"):
+                with open(file_path, "rb") as f:
+                    digest.update(name.encode("utf-8") + f.read())
+            elif name.endswith((".safetensors", ".bin", ".pt", ".pth", ".model")):
+                digest.update(f"{name}:{os.path.getsize(file_path)}".encode("utf-8"))
+        return f"{os.path.basename(resolved)}-{digest.hexdigest()[:16]}"
+    
     def _load_model(self):
         """加载BGEM3模型"""
         try:
@@ -252,13 +378,28 @@ class BGEM3Manager:
             print(f"❌ 加载BGEM3模型失败: {e}")
             raise
     
-    def encode(self, texts: List[str]) -> List[List[float]]:
-        """编码文本为向量"""
+    def encode(self, texts: List[str], cache: bool = False) -> List[List[float]]:
+        """
+        编码文本为向量。cache为True时（入库的文本块）已缓存的文本直接读取，只向量化未缓存的部分；
+        检索时的查询不经过缓存，不增加磁盘写入
+        """
         try:
-            embeddings = self.model.encode(
-                texts,
-                max_length=512
-            )["dense_vecs"].tolist()
+            if cache:
+                embeddings = embedding_cache.get_many(self.model_name, self.max_length, texts)
+            else:
+                embeddings = [None] * len(texts)
+            missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+            if missing:
+                missing_texts = [texts[i] for i in missing]
+                with self.lock:
+                    new_embeddings = self.model.encode(
+                        missing_texts,
+                        max_length=self.max_length
+                    )["dense_vecs"].tolist()
+                for i, embedding in zip(missing, new_embeddings):
+                    embeddings[i] = embedding
+                if cache:
+                    embedding_cache.put_many(self.model_name, self.max_length, missing_texts, new_embeddings)
             return embeddings
         except Exception as e:
             print(f"❌ 编码文本失败: {e}")
@@ -266,10 +407,15 @@ class BGEM3Manager:
 
 # BGE-Reranker模型管理器
 class BGERerankerManager:
-    def __init__(self, model_path: str):
+    def __init__(self, model_path: str, batch_size: Optional[int] = None, max_length: Optional[int] = None):
         """初始化BGE-Reranker模型管理器"""
+        settings = get_settings()
         self.model_path = model_path
+        self.batch_size = max(1, batch_size or settings.RERANK_BATCH_SIZE)
+        self.max_length = max_length or settings.RERANK_MAX_LENGTH
         self.model = None
+        # 同一实例被多个请求和预热线程共用，分词器不支持并发调用，推理时串行
+        self.lock = threading.Lock()
         self._load_model()
     
     def _load_model(self):
@@ -284,19 +430,41 @@ class BGERerankerManager:
     def compute_score(self, text_a: str, text_b: str) -> float:
         """计算两个文本的相关性分数"""
         try:
-            score = self.model.compute_score([text_a, text_b])
+            with self.lock:
+                score = self.model.compute_score([text_a, text_b], max_length=self.max_length)
             return score
         except Exception as e:
             print(f"❌ 计算相关性分数失败: {e}")
             raise
     
+    def compute_scores(self, query: str, documents: List[str]) -> List[float]:
+        """
+        批量计算查询与每个文档的相关性分数，返回顺序与documents一致。
+        按文档长度排序后切成子批次，同一批次长度相近，padding少。
+        """
+        if not documents:
+            return []
+        order = sorted(range(len(documents)), key=lambda i: len(documents[i]))
+        scores = [0.0] * len(documents)
+        for start in range(0, len(order), self.batch_size):
+            bucket = order[start:start + self.batch_size]
+            with self.lock:
+                bucket_scores = self.model.compute_score(
+                    [[query, documents[i]] for i in bucket],
+                    batch_size=len(bucket),
+                    max_length=self.max_length
+                )
+            # 只有一对时返回的是单个分数
+            if not isinstance(bucket_scores, list):
+                bucket_scores = [bucket_scores]
+            for i, score in zip(bucket, bucket_scores):
+                scores[i] = score
+        return scores
+    
     def rerank_documents(self, query: str, documents: List[str]) -> List[tuple]:
         """重排序文档"""
         try:
-            scores = []
-            for doc in documents:
-                score = self.compute_score(query, doc)
-                scores.append((score, doc))
+            scores = list(zip(self.compute_scores(query, documents), documents))
             
             # 按分数降序排序
             scores.sort(key=lambda x: x[0], reverse=True)
@@ -305,71 +473,233 @@ class BGERerankerManager:
             print(f"❌ 重排序文档失败: {e}")
             raise
 
+# 检索模型注册表
+class RetrievalModelRegistry:
+    """
+    进程内共享的BGEM3和Reranker模型：第一次使用时加载，之后所有请求共用同一个实例。
+    启动时可调用warm_up预先加载并用一个小批次预热，ready表示两个模型都已可用。
+    """
+
+    def __init__(self):
+        self._bgem3: Optional[BGEM3Manager] = None
+        self._reranker: Optional[BGERerankerManager] = None
+        # 每个模型一把锁，加载Reranker时不会挡住向量检索
+        self._bgem3_lock = threading.Lock()
+        self._reranker_lock = threading.Lock()
+        self._ready = threading.Event()
+        self.warmup_seconds: Optional[float] = None
+        self.errors: Dict[str, str] = {}
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def get_bgem3(self) -> BGEM3Manager:
+        """获取BGEM3模型，加载失败时抛出异常，下次调用重新尝试"""
+        if self._bgem3 is None:
+            with self._bgem3_lock:
+                if self._bgem3 is None:
+                    settings = get_settings()
+                    self._bgem3 = BGEM3Manager(str(settings.BGEM3_MODEL_PATH))
+        return self._bgem3
+
+    def get_reranker(self) -> BGERerankerManager:
+        """获取Reranker模型，加载失败时抛出异常，下次调用重新尝试"""
+        if self._reranker is None:
+            with self._reranker_lock:
+                if self._reranker is None:
+                    settings = get_settings()
+                    self._reranker = BGERerankerManager(str(settings.BGE_RERANKER_MODEL_PATH))
+        return self._reranker
+
+    def warm_up(self) -> bool:
+        """加载两个模型并各跑一个小批次，返回是否全部就绪"""
+        start_time = time.time()
+        self.errors = {}
+        try:
+            self.get_bgem3().encode(["预热", "warm up"])
+        except Exception as e:
+            self.errors["bgem3"] = str(e)
+        try:
+            self.get_reranker().compute_score("预热", "warm up")
+        except Exception as e:
+            self.errors["reranker"] = str(e)
+        self.warmup_seconds = time.time() - start_time
+
+        if not self.errors:
+            self._ready.set()
+            print(f"✅ 检索模型预热完成，用时 {self.warmup_seconds:.2f} 秒")
+        else:
+            print(f"❌ 检索模型预热失败: {self.errors}")
+        return self.ready
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "bgem3_loaded": self._bgem3 is not None,
+            "reranker_loaded": self._reranker is not None,
+            "warmup_seconds": self.warmup_seconds,
+            "errors": self.errors,
+        }
+
+
+model_registry = RetrievalModelRegistry()
+
+
+def get_bgem3_manager() -> BGEM3Manager:
+    return model_registry.get_bgem3()
+
+
+def get_reranker_manager() -> BGERerankerManager:
+    return model_registry.get_reranker()
+
 # 加载 DOCX 文件
 def load_docx(file_path):
+    return "\n".join(iter_docx_paragraphs(file_path))
+
+# 逐段读取 DOCX 文件
+def iter_docx_paragraphs(file_path):
     doc = docx.Document(file_path)
-    full_text = []
     for paragraph in doc.paragraphs:
-        full_text.append(paragraph.text)
-    return "\n".join(full_text)
+        yield paragraph.text
 
 # 加载 PDF 文件
 def load_pdf(file_path):
-    doc = fitz.open(file_path)
-    text = ""
-    for page in doc:
-        text += page.get_text()
-    return text
+    return "".join(iter_pdf_pages(file_path))
 
-# 加载文件
-def load_documents(dir_path):
-    docs = []
-    print(f"正在加载目录: {dir_path}")  # 调试输出
-    
+# 逐页读取 PDF 文件，不把整本书的文本留在内存中
+def iter_pdf_pages(file_path):
+    with fitz.open(file_path) as doc:
+        for page in doc:
+            yield page.get_text()
+
+SUPPORTED_FILE_TYPES = ('md', 'txt', 'pdf', 'docx')
+
+# 流式解析时每段文本约为多少个文本块大小，PDF按页、DOCX按段落凑够后再分块
+PARSE_WINDOW_CHUNKS = 32
+
+def get_smart_splitter():
     # 使用配置管理系统获取分块参数
     settings = get_settings()
-    smart_splitter = SmartTextSplitter(
+    return SmartTextSplitter(
         chunk_size=settings.VECTOR_DB_CHUNK_SIZE, 
         chunk_overlap=settings.VECTOR_DB_CHUNK_OVERLAP
     )
+
+# 窗口的切分位置：后半段最后一个段落边界，没有时退回到句末、换行，避免把句子切断
+def _window_cut(text):
+    for sep in ("\n\n", "。", "\n"):
+        pos = text.rfind(sep, len(text) // 2)
+        if pos >= 0:
+            return pos + len(sep)
+    return len(text)
+
+# 窗口之间重叠部分的起点：切分点之前overlap_chars个字符内最早的段落、句子或行首，
+# 重叠只包含完整的句子，不会在下一段开头分出半句话的文本块；范围内没有边界时不重叠
+def _overlap_start(text, cut, overlap_chars):
+    start = max(0, cut - overlap_chars)
+    if start == 0:
+        return 0
+    best = cut
+    for sep in ("\n\n", "。", "\n"):
+        pos = text.find(sep, max(0, start - len(sep)), cut)
+        if pos >= 0 and pos + len(sep) < cut:
+            best = min(best, pos + len(sep))
+    return best
+
+# 按窗口拼接文本片段，凑够window_chars个字符时在段落或句子边界处输出一段；
+# 切分点之后的文本连同之前最多overlap_chars个字符（不超过窗口的1/4）带入下一段，窗口之间同样保留分块重叠。
+# 重叠的文本会被分块和向量化两次：输出总长度最多比输入多(窗口数-1)*overlap_chars个字符，
+# 按每个窗口PARSE_WINDOW_CHUNKS个文本块计，约每32个文本块多一次分块重叠
+def _iter_text_windows(parts, window_chars, separator="", overlap_chars=0):
+    overlap_chars = min(overlap_chars, window_chars // 4)
+    window = []
+    size = 0
+    pending = False  # 窗口中有尚未输出的新片段
+    for part in parts:
+        window.append(part)
+        size += len(part) + len(separator)
+        pending = True
+        if size >= window_chars:
+            text = separator.join(window)
+            cut = _window_cut(text)
+            yield text[:cut]
+            carry = text[_overlap_start(text, cut, overlap_chars):]
+            window = [carry] if carry else []
+            size = len(carry)
+            pending = cut < len(text)
+    if window and pending:
+        yield separator.join(window)
+
+# 解析单个文件，逐段返回(文本, 分块类型)
+def iter_file_texts(file_path, window_chars, overlap_chars=0):
+    filename = os.path.basename(file_path)
+    file_type = filename.split('.')[-1].lower()
+    
+    if file_type == 'md':
+        print(f"加载 Markdown 文件: {filename}")  # 调试输出
+        # Markdown按标题分块，需要整篇文本
+        loader = UnstructuredMarkdownLoader(file_path)
+        for doc in loader.load():
+            yield doc.page_content, "md"
+            
+    elif file_type == 'txt':
+        print(f"加载文本文件: {filename}")  # 调试输出
+        loader = TextLoader(file_path)
+        for doc in loader.load():
+            yield doc.page_content, "txt"
+            
+    elif file_type == 'pdf':
+        print(f"加载 PDF 文件: {filename}")  # 调试输出
+        for text in _iter_text_windows(iter_pdf_pages(file_path), window_chars, "", overlap_chars):
+            yield text, "pdf"
+        
+    elif file_type == 'docx':
+        print(f"加载 DOCX 文件: {filename}")  # 调试输出
+        for text in _iter_text_windows(iter_docx_paragraphs(file_path), window_chars, "\n", overlap_chars):
+            yield text, "txt"
+
+# 流式加载单个文件：每解析出一段文本就分块并返回这一段的文本块
+def iter_file_documents(file_path, smart_splitter=None, stats: Optional[IngestStats] = None):
+    smart_splitter = smart_splitter or get_smart_splitter()
+    texts = iter_file_texts(
+        file_path,
+        smart_splitter.chunk_size * PARSE_WINDOW_CHUNKS,
+        smart_splitter.chunk_overlap
+    )
+    while True:
+        start = time.perf_counter()
+        item = next(texts, None)
+        parsed = time.perf_counter()
+        if item is None:
+            break
+        text, split_type = item
+        # 使用智能分块
+        docs = smart_splitter.split_text(text, split_type)
+        if stats is not None:
+            stats.record("parse", 1, parsed - start)
+            stats.record("split", len(docs), time.perf_counter() - parsed)
+        yield docs
+
+# 加载单个文件并分块
+def load_file_documents(file_path, smart_splitter=None):
+    docs = []
+    for split_docs in iter_file_documents(file_path, smart_splitter):
+        docs.extend(split_docs)
+    return docs
+
+# 加载文件
+def load_documents(dir_path):
+    docs = []
+    print(f"正在加载目录: {dir_path}")  # 调试输出
+    
+    smart_splitter = get_smart_splitter()
     
     for filename in os.listdir(dir_path):
         file_path = os.path.join(dir_path, filename)
-        file_type = filename.split('.')[-1].lower()
         
         try:
-            if file_type == 'md':
-                print(f"加载 Markdown 文件: {filename}")  # 调试输出
-                loader = UnstructuredMarkdownLoader(file_path)
-                raw_docs = loader.load()
-                # 使用智能分块
-                for doc in raw_docs:
-                    split_docs = smart_splitter.split_text(doc.page_content, "md")
-                    docs.extend(split_docs)
-                    
-            elif file_type == 'txt':
-                print(f"加载文本文件: {filename}")  # 调试输出
-                loader = TextLoader(file_path)
-                raw_docs = loader.load()
-                # 使用智能分块
-                for doc in raw_docs:
-                    split_docs = smart_splitter.split_text(doc.page_content, "txt")
-                    docs.extend(split_docs)
-                    
-            elif file_type == 'pdf':
-                print(f"加载 PDF 文件: {filename}")  # 调试输出
-                pdf_text = load_pdf(file_path)
-                # 使用智能分块
-                split_docs = smart_splitter.split_text(pdf_text, "pdf")
-                docs.extend(split_docs)
-                
-            elif file_type == 'docx':
-                print(f"加载 DOCX 文件: {filename}")  # 调试输出
-                docx_text = load_docx(file_path)
-                # 使用智能分块
-                split_docs = smart_splitter.split_text(docx_text, "txt")
-                docs.extend(split_docs)
-                
+            docs.extend(load_file_documents(file_path, smart_splitter))
         except Exception as e:
             print(f"处理文件 {filename} 时出错: {str(e)}")
             continue
@@ -377,6 +707,142 @@ def load_documents(dir_path):
     print(f"总共加载了 {len(docs)} 个文档块")  # 调试输出
     return docs
 
+# 文件内容哈希，文件改名不影响，内容不变时不重新向量化
+def file_hash(file_path) -> str:
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# 文本块ID由文件名、文件哈希和块序号决定，同一文件重复上传时覆盖而不是重复添加；
+# 包含文件名，内容相同的两个文件（如"lesson (1).pdf"）各有自己的文本块，ID不会冲突
+def chunk_id(source: str, content_hash: str, index: int) -> str:
+    key = hashlib.sha1(f"{source}\0{content_hash}".encode('utf-8')).hexdigest()
+    return f"{key}_{index}"
+
+# 列出目录下支持的文件：文件名 -> 内容哈希
+def list_source_files(dir_path) -> Dict[str, str]:
+    files = {}
+    for filename in sorted(os.listdir(dir_path)):
+        file_path = os.path.join(dir_path, filename)
+        if not os.path.isfile(file_path):
+            continue
+        if filename.split('.')[-1].lower() not in SUPPORTED_FILE_TYPES:
+            continue
+        try:
+            files[filename] = file_hash(file_path)
+        except OSError as e:
+            print(f"读取文件 {filename} 时出错: {str(e)}")
+    return files
+
+# 进程内累计的入库统计，/v1/knowledge/status 返回
+ingest_totals = IngestStats()
+
+# 入库的文本块经过向量缓存，相同文本不再重复向量化
+def embed_chunks(texts: List[str]) -> List[List[float]]:
+    return get_bgem3_manager().encode(texts, cache=True)
+
+def get_ingest_pipeline(embed, upsert) -> IngestPipeline:
+    settings = get_settings()
+    return IngestPipeline(
+        embed,
+        upsert,
+        embed_batch_size=settings.VECTOR_DB_EMBED_BATCH_SIZE,
+        upsert_batch_size=settings.VECTOR_DB_UPSERT_BATCH_SIZE,
+        queue_size=settings.VECTOR_DB_QUEUE_SIZE
+    )
+
+# 增量同步目录与向量知识库
+def sync_vector_db(dir_path, collection_name):
+    """
+    只向量化新增或内容变化的文件，删除已移除或已变化文件的旧文本块。
+    每个文本块的metadata记录来源文件名、文件哈希和块序号；
+    没有这些metadata的旧数据（随机ID）会被清空后重新导入一次。
+    :return: (ChromaDB管理器, 新增文本块数, 删除文本块数)，目录中没有支持的文件时返回(None, 0, 0)
+    """
+    print(f"正在同步目录: {dir_path} -> {collection_name}")  # 调试输出
+    files = list_source_files(dir_path)
+    if not files:
+        return None, 0, 0
+    
+    settings = get_settings()
+    chroma_manager = ChromaDBManager(
+        host=settings.CHROMADB_HOST,
+        port=settings.CHROMADB_PORT
+    )
+    
+    # 一次请求取回已有文本块的ID和metadata
+    existing = chroma_manager.get_chunk_metadatas(collection_name)
+    indexed: Dict[str, str] = {}  # 文件名 -> 已入库的哈希
+    stale: Dict[str, Optional[str]] = {}  # 文本块ID -> 来源文件名
+    for cid, metadata in existing:
+        metadata = metadata or {}
+        source = metadata.get('source')
+        content_hash = metadata.get('file_hash')
+        if source is None or content_hash is None or files.get(source) != content_hash:
+            # 旧版本数据、已删除的文件或内容已变化的文件
+            stale[cid] = source
+        else:
+            indexed[source] = content_hash
+    
+    changed = [filename for filename in files if filename not in indexed]
+    
+    # 只加载和向量化变化的文件，解析、向量化和写入流水线进行
+    stats = IngestStats()
+    added = 0
+    failed_ids: List[str] = []
+    failed_files = set()
+    written_ids: List[str] = []
+    
+    def iter_chunks():
+        nonlocal added
+        smart_splitter = get_smart_splitter()
+        for filename in changed:
+            content_hash = files[filename]
+            index = 0
+            try:
+                for docs in iter_file_documents(os.path.join(dir_path, filename), smart_splitter, stats):
+                    for doc in docs:
+                        yield chunk_id(filename, content_hash, index), doc, {'source': filename, 'file_hash': content_hash, 'chunk': index}
+                        index += 1
+            except Exception as e:
+                print(f"处理文件 {filename} 时出错: {str(e)}")
+                # 已送出的文本块稍后删除，避免文件只入库一部分却被当作已同步
+                failed_ids.extend(chunk_id(filename, content_hash, i) for i in range(index))
+                failed_files.add(filename)
+                stats.file_done(failed=True)
+                continue
+            added += index
+            stats.file_done()
+    
+    def upsert(ids, documents, embeddings, metadatas):
+        chroma_manager.upsert_documents(collection_name, ids, documents, embeddings, metadatas)
+        written_ids.extend(ids)
+    
+    try:
+        if changed:
+            get_ingest_pipeline(embed_chunks, upsert).run(iter_chunks(), stats)
+    except Exception:
+        # 中途失败时删除本次已写入的文本块，旧文本块保留，下次同步重新导入这些文件
+        failed_ids.extend(written_ids)
+        raise
+    finally:
+        ingest_totals.merge(stats)
+        if failed_ids:
+            chroma_manager.delete_documents(collection_name, failed_ids)
+    
+    # 新文本块全部写入后再删除旧文本块，同步失败时知识库仍是上次同步的内容；
+    # 处理失败的文件保留旧文本块，本次写入的ID不删除
+    written = set(written_ids)
+    stale_ids = [cid for cid, source in stale.items() if source not in failed_files and cid not in written]
+    if stale_ids:
+        chroma_manager.delete_documents(collection_name, stale_ids)
+    
+    print(f"✅ 同步完成，collection: {collection_name}，变化文件 {len(changed)} 个，新增 {added} 个文本块，删除 {len(stale_ids)} 个文本块")
+    print(f"入库各阶段: {stats.summary()}")  # 调试输出
+    return chroma_manager, added, len(stale_ids)
+
 # 创建向量知识库
 def create_vector_db(documents, collection_name):
     if not documents:
@@ -387,8 +853,8 @@ def create_vector_db(documents, collection_name):
         # 使用配置管理系统获取模型路径和ChromaDB配置
         settings = get_settings()
         
-        # 初始化BGEM3模型
-        bgem3_manager = BGEM3Manager(str(settings.BGEM3_MODEL_PATH))
+        # 获取共享的BGEM3模型
+        bgem3_manager = get_bgem3_manager()
         
         # 初始化ChromaDB管理器
         chroma_manager = ChromaDBManager(
@@ -396,12 +862,13 @@ def create_vector_db(documents, collection_name):
             port=settings.CHROMADB_PORT
         )
         
-        # 生成文档向量
-        texts = [doc.page_content for doc in documents]
-        embeddings = bgem3_manager.encode(texts)
-        
-        # 添加到ChromaDB
-        ids = chroma_manager.add_documents(collection_name, documents, embeddings)
+        # 分批生成文档向量并分批添加到ChromaDB
+        pipeline = get_ingest_pipeline(
+            lambda texts: bgem3_manager.encode(texts, cache=True),
+            lambda ids, docs, embeddings, metadatas: chroma_manager.add_documents(collection_name, docs, embeddings)
+        )
+        stats = pipeline.run((None, doc, None) for doc in documents)
+        ingest_totals.merge(stats)
         
         print(f"✅ 成功创建向量知识库，collection: {collection_name}")
         print(f"✅ 添加了 {len(documents)} 个文档块")
@@ -450,19 +917,16 @@ def update_knowledge_db(userId, isTeacher=False, courseID=None, lessonNum=None,
         
         print(f"开始更新知识库，userId: {userId}, isTeacher: {isTeacher}, courseID: {courseID}, lessonNum: {lessonNum}, isResource: {isResource}, isAsk: {isAsk}")  # 调试输出
 
-        # 加载文档
-        docs = load_documents(session_folder)
-        if not docs:
-            print("没有找到任何支持的文档类型，请确认上传的文件类型。")  # 调试输出
-            return None
-        
         # 生成collection名称
         collection_name = f"kb_{userId}_{courseID or 'student'}_{lessonNum or 'default'}"
         if isAsk:
             collection_name += "_ask"
         
-        # 创建向量知识库
-        chroma_manager = create_vector_db(docs, collection_name)
+        # 增量同步：只处理新增或变化的文件
+        chroma_manager, _, _ = sync_vector_db(session_folder, collection_name)
+        if not chroma_manager:
+            print("没有找到任何支持的文档类型，请确认上传的文件类型。")  # 调试输出
+            return None
         return chroma_manager
         
     except ValueError as e:
@@ -497,9 +961,9 @@ def load_vector_db(userId, isTeacher=False, courseID=None, lessonNum=None, isAsk
             port=settings.CHROMADB_PORT
         )
         
-        # 检查collection是否存在
+        # 检查collection是否存在（句柄缓存后不再请求服务器）
         try:
-            collection = chroma_manager.client.get_collection(collection_name)
+            collection = chroma_manager.get_collection(collection_name)
             print(f"✅ 成功加载向量数据库，collection: {collection_name}")
             return chroma_manager
         except Exception as e:
@@ -524,8 +988,8 @@ def search_knowledge_db(query: str, chroma_manager: ChromaDBManager, collection_
     try:
         settings = get_settings()
         
-        # 初始化BGEM3模型
-        bgem3_manager = BGEM3Manager(str(settings.BGEM3_MODEL_PATH))
+        # 获取共享的BGEM3模型
+        bgem3_manager = get_bgem3_manager()
         
         # 生成查询向量
         query_embedding = bgem3_manager.encode([query])[0]
@@ -543,8 +1007,8 @@ def search_knowledge_db(query: str, chroma_manager: ChromaDBManager, collection_
         # 如果启用重排序
         if use_rerank and len(documents) > 1:
             try:
-                # 初始化BGE-Reranker模型
-                reranker_manager = BGERerankerManager(str(settings.BGE_RERANKER_MODEL_PATH))
+                # 获取共享的BGE-Reranker模型
+                reranker_manager = get_reranker_manager()
                 
                 # 重排序
                 reranked_results = reranker_manager.rerank_documents(query, documents)
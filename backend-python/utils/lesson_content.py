@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+import os
+from typing import List
+
+from utils.knowledge import load_vector_db
+from config.settings import get_settings
+
+
+def get_lesson_collection_name(user_id: str, course_id: str, lesson_num: str) -> str:
+    return f"kb_{user_id}_{course_id}_{lesson_num}"
+
+
+def get_user_path(user_id: str, is_teacher: bool) -> str:
+    """根据userID和isTeacher确定用户路径"""
+    settings = get_settings()
+    if is_teacher:
+        base_dir = settings.TEACHERS_DIR
+    else:
+        base_dir = settings.STUDENTS_DIR
+    return os.path.join(str(base_dir), user_id)
+
+
+def get_lesson_content_from_chromadb(user_id: str, course_id: str, lesson_num: str, is_teacher: bool) -> List[str]:
+    """
+    从ChromaDB知识库获取课时内容，返回文本块列表
+    """
+    print(f"正在从ChromaDB获取课时内容: userID={user_id}, courseId={course_id}, lessonNum={lesson_num}, isTeacher={is_teacher}")
+    
+    try:
+        # 加载向量数据库
+        chroma_manager = load_vector_db(
+            userId=user_id,
+            isTeacher=is_teacher,
+            courseID=course_id,
+            lessonNum=lesson_num,
+            isAsk=False      # 不是ask文件
+        )
+        
+        if not chroma_manager:
+            print("ChromaDB知识库不存在")
+            return None
+        
+        # 生成collection名称
+        collection_name = get_lesson_collection_name(user_id, course_id, lesson_num)
+        
+        # 获取collection中的所有文档
+        try:
+            collection = chroma_manager.get_collection(collection_name)
+            
+            # 获取所有文档（这里我们需要获取所有文档，所以使用一个通用的查询）
+            # 由于ChromaDB没有直接获取所有文档的API，我们使用一个技巧
+            # 先获取一个文档的embedding，然后用它来查询所有文档
+            results = collection.get(include=['documents'])
+            
+            if results and results['documents']:
+                text_blocks = results['documents']
+                print(f"成功从ChromaDB获取 {len(text_blocks)} 个文本块")
+                return text_blocks
+            else:
+                print("ChromaDB中没有找到文档")
+                return None
+                
+        except Exception as e:
+            print(f"从ChromaDB获取文档失败: {e}")
+            return None
+            
+    except Exception as e:
+        print(f"加载ChromaDB知识库失败: {e}")
+        return None
+
+
+def get_lesson_content_whole_from_chromadb(user_id: str, course_id: str, lesson_num: str, is_teacher: bool) -> str:
+    """
+    从ChromaDB知识库获取课时内容，返回合并的文本内容
+    """
+    print(f"正在从ChromaDB获取课时内容: userID={user_id}, courseId={course_id}, lessonNum={lesson_num}, isTeacher={is_teacher}")
+    
+    text_blocks = get_lesson_content_from_chromadb(user_id, course_id, lesson_num, is_teacher)
+    
+    if text_blocks:
+        # 合并文本块
+        combined_content = "\n\n".join(text_blocks)
+        print(f"成功从ChromaDB获取课时内容，总长度: {len(combined_content)} 字符")
+        return combined_content
+    
+    print("无法从ChromaDB获取课时内容")
+    return None
+
+
+def get_lesson_content_fallback(user_id: str, course_id: str, lesson_num: str, is_teacher: bool) -> List[str]:
+    """
+    备用方案：从文件系统获取课时内容
+    """
+    print(f"使用备用方案从文件系统获取课时内容: userID={user_id}, courseId={course_id}, lessonNum={lesson_num}, isTeacher={is_teacher}")
+    
+    # 获取用户路径
+    user_path = get_user_path(user_id, is_teacher)
+    
+    # 构建文件路径
+    lesson_path = os.path.join(user_path, course_id, lesson_num)
+    if not os.path.exists(lesson_path):
+        print(f"课时路径不存在: {lesson_path}")
+        return None
+    
+    # 读取课时文件夹中的所有文件
+    text_blocks = read_files_as_blocks(lesson_path)
+    if text_blocks:
+        print("成功从文件系统获取课时内容")
+        return text_blocks
+    
+    print("无法从文件系统获取课时内容")
+    return None
+
+
+def get_lesson_content_whole_fallback(user_id: str, course_id: str, lesson_num: str, is_teacher: bool) -> str:
+    """
+    备用方案：从文件系统获取课时内容，返回合并的文本
+    """
+    text_blocks = get_lesson_content_fallback(user_id, course_id, lesson_num, is_teacher)
+    
+    if text_blocks:
+        # 合并文本块
+        combined_content = "\n\n".join(text_blocks)
+        print(f"成功从文件系统获取课时内容，总长度: {len(combined_content)} 字符")
+        return combined_content
+    
+    return None
+
+
+def get_lesson_content(user_id: str, course_id: str, lesson_num: str, is_teacher: bool) -> List[str]:
+    """
+    获取课时内容，优先从ChromaDB获取，失败则从文件系统获取
+    返回文本块列表
+    """
+    # 首先尝试从ChromaDB获取
+    text_blocks = get_lesson_content_from_chromadb(user_id, course_id, lesson_num, is_teacher)
+    if text_blocks:
+        return text_blocks
+    
+    # 如果ChromaDB获取失败，使用备用方案
+    return get_lesson_content_fallback(user_id, course_id, lesson_num, is_teacher)
+
+
+def get_lesson_content_whole(user_id: str, course_id: str, lesson_num: str, is_teacher: bool) -> str:
+    """
+    获取课时内容，优先从ChromaDB获取，失败则从文件系统获取
+    返回合并的文本内容
+    """
+    # 首先尝试从ChromaDB获取
+    combined_content = get_lesson_content_whole_from_chromadb(user_id, course_id, lesson_num, is_teacher)
+    if combined_content:
+        return combined_content
+    
+    # 如果ChromaDB获取失败，使用备用方案
+    return get_lesson_content_whole_fallback(user_id, course_id, lesson_num, is_teacher)
+
+
+def read_files_as_blocks(folder_path: str) -> List[str]:
+    """
+    读取文件夹中的所有文本文件内容，返回文本块列表
+    """
+    print(f"正在读取文件夹内容: {folder_path}")
+    
+    if not os.path.exists(folder_path):
+        print(f"文件夹不存在: {folder_path}")
+        return None
+    
+    text_blocks = []
+    supported_extensions = ['.txt', '.md', '.docx', '.pdf']
+    
+    try:
+        for filename in os.listdir(folder_path):
+            file_path = os.path.join(folder_path, filename)
+            
+            # 跳过目录和隐藏文件
+            if os.path.isdir(file_path) or filename.startswith('.'):
+                continue
+            
+            # 检查文件扩展名
+            file_ext = os.path.splitext(filename)[1].lower()
+            if file_ext not in supported_extensions:
+                continue
+            
+            try:
+                if file_ext == '.txt' or file_ext == '.md':
+                    with open(file_path, 'r', encoding='utf-8') as f:
+                        content = f.read()
+                        if content.strip():
+                            # 按段落分割文本块
+                            paragraphs = [p.strip() for p in content.split('\n\n') if p.strip()]
+                            text_blocks.extend(paragraphs)
+                            print(f"成功读取文件: {filename}，分割为 {len(paragraphs)} 个文本块")
+                # 对于其他格式的文件，可以添加相应的处理逻辑
+                
+            except Exception as e:
+                print(f"读取文件 {filename} 时出错: {e}")
+                continue
+        
+        if text_blocks:
+            print(f"成功读取 {len(text_blocks)} 个文本块")
+            return text_blocks
+        else:
+            print("未找到可读取的文本文件")
+            return None
+            
+    except Exception as e:
+        print(f"读取文件夹时出错: {e}")
+        return None
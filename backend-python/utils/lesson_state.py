@@ -0,0 +1,53 @@
+import hashlib
+from typing import Union
+
+from utils.session_state import SessionStateStore
+from config.settings import get_settings
+
+# 课时内容放在提示词最前面，问答和出题共用同一个课时状态
+LESSON_PREFIX = "课时内容：\n{content}\n\n"
+
+
+class LessonPrompt:
+    """
+    从课时状态开始的提示词：prefix为课时内容，suffix为问题或出题要求。
+    key由collection名称和课时内容的哈希组成，课时内容更新后自动换成新的状态。
+    """
+
+    def __init__(self, key: str, prefix: str, suffix: str):
+        self.key = key
+        self.prefix = prefix
+        self.suffix = suffix
+
+    @property
+    def prompt(self) -> str:
+        return self.prefix + self.suffix
+
+
+def lesson_key(collection_name: str, content: str) -> str:
+    digest = hashlib.sha1(content.encode("utf-8")).hexdigest()
+    return f"{collection_name}/{digest}"
+
+
+def lesson_prompt(
+    collection_name: str, content: str, suffix: str
+) -> Union[LessonPrompt, None]:
+    """
+    课时内容过长（超过RWKV_LESSON_STATE_MAX_CHARS）时返回None，由调用方改用检索到的片段
+    """
+    if not content or len(content) > settings.RWKV_LESSON_STATE_MAX_CHARS:
+        return None
+    return LessonPrompt(
+        lesson_key(collection_name, content),
+        LESSON_PREFIX.format(content=content),
+        suffix,
+    )
+
+
+settings = get_settings()
+# 课时状态：每个课时预填充一次，所有学生的问答和出题共用；内存不足时溢出到STATE_CACHE_DIR/lessons
+lesson_state = SessionStateStore(
+    settings.RWKV_LESSON_STATE_BUDGET_MB * 1024 * 1024,
+    str(settings.STATE_CACHE_DIR / "lessons"),
+    settings.RWKV_LESSON_STATE_DISK_BUDGET_MB * 1024 * 1024,
+)
@@ -1,5 +1,6 @@
 import json
 import logging
+import logging.handlers
 from typing import Any
 from fastapi import Request
 from pydantic import BaseModel
@@ -0,0 +1,235 @@
+import functools
+from typing import Any, Dict, List, Tuple, Union
+
+
+@functools.lru_cache(maxsize=None)
+def itemsize(dtype) -> int:
+    import torch
+
+    return torch.empty((), dtype=dtype).element_size()
+
+
+class PackedState:
+    """
+    A torch RNN state (n_layer * 3 tensors for v5/v6, n_layer * 5 for v4) kept in one contiguous
+    uint8 buffer per device, the tensors being typed views into it. Copying, moving and serializing
+    a state is one copy per buffer instead of one allocation per tensor.
+
+    A batch of states with the same layout is a [B, nbytes] buffer, the tensors are then [B, ...]
+    views, row b being the state of sequence b.
+    """
+
+    ALIGN = 64  # every view starts on a boundary any dtype can be reinterpreted from
+
+    def __init__(self, buffers: List, layout: List[Tuple[int, int, Any, Tuple[int, ...]]]):
+        # layout: (buffer index, byte offset, dtype, shape) of every tensor
+        self.buffers = buffers
+        self.layout = layout
+        self.tensors = [
+            self.__view(buffers[index], offset, dtype, shape)
+            for index, offset, dtype, shape in layout
+        ]
+        self.__rows: Union[List[List], None] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # the views are rebuilt on load, only the buffers are written
+        return {"buffers": self.buffers, "layout": self.layout}
+
+    def __setstate__(self, data: Dict[str, Any]):
+        self.__init__(data["buffers"], data["layout"])
+
+    @staticmethod
+    def __view(buffer, offset: int, dtype, shape: Tuple[int, ...]):
+        count = 1
+        for n in shape:
+            count *= n
+        nbytes = count * itemsize(dtype)
+        raw = buffer[..., offset : offset + nbytes]
+        return raw.view(dtype).view(*buffer.shape[:-1], *shape)
+
+    @classmethod
+    def __plan(cls, state: List, dtypes: Union[List, None] = None):
+        """
+        Returns (devices of the buffers, buffer sizes, layout) for the tensors of state.
+        """
+        devices: List = []
+        sizes: List[int] = []
+        layout = []
+        for i, tensor in enumerate(state):
+            dtype = dtypes[i] if dtypes is not None and dtypes[i] is not None else tensor.dtype
+            if tensor.device not in devices:
+                devices.append(tensor.device)
+                sizes.append(0)
+            index = devices.index(tensor.device)
+            offset = sizes[index]
+            nbytes = tensor.nelement() * itemsize(dtype)
+            sizes[index] = (offset + nbytes + cls.ALIGN - 1) // cls.ALIGN * cls.ALIGN
+            layout.append((index, offset, dtype, tuple(tensor.shape)))
+        return devices, sizes, layout
+
+    @classmethod
+    def pack(cls, state: List, dtypes: Union[List, None] = None) -> "PackedState":
+        """
+        Copies the tensors of state into new buffers on their devices, casting them to dtypes if given.
+        """
+        import torch
+
+        devices, sizes, layout = cls.__plan(state, dtypes)
+        buffers = [
+            torch.empty(size, dtype=torch.uint8, device=device)
+            for device, size in zip(devices, sizes)
+        ]
+        packed = cls(buffers, layout)
+        for view, tensor in zip(packed.tensors, state):
+            view.copy_(tensor)
+        return packed
+
+    @classmethod
+    def from_spec(cls, buffers: List, spec: List) -> "PackedState":
+        """
+        Builds a state on top of serialized buffers, without copying them.
+        """
+        import torch
+
+        layout = [
+            (index, offset, getattr(torch, dtype), tuple(shape))
+            for index, offset, dtype, shape in spec
+        ]
+        return cls(buffers, layout)
+
+    def spec(self) -> List:
+        """
+        Json-serializable layout, see from_spec.
+        """
+        return [
+            [index, offset, str(dtype).replace("torch.", ""), list(shape)]
+            for index, offset, dtype, shape in self.layout
+        ]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(buffer.nelement() for buffer in self.buffers)
+
+    @property
+    def devices(self) -> List:
+        return [self.buffers[index].device for index, _, _, _ in self.layout]
+
+    @property
+    def batch_size(self) -> Union[int, None]:
+        return self.buffers[0].shape[0] if self.buffers[0].dim() == 2 else None
+
+    def clone(self) -> "PackedState":
+        return PackedState([buffer.clone() for buffer in self.buffers], self.layout)
+
+    def to(self, device, pin_memory: bool = False) -> "PackedState":
+        """
+        Moves every buffer to device with one copy each, returns self if they are already there.
+        """
+        import torch
+
+        device = torch.device(device)
+        if all(
+            buffer.device == device and (not pin_memory or buffer.is_pinned())
+            for buffer in self.buffers
+        ):
+            return self
+        buffers = []
+        for buffer in self.buffers:
+            if pin_memory:
+                moved = torch.empty(
+                    buffer.shape, dtype=buffer.dtype, device=device, pin_memory=True
+                )
+                moved.copy_(buffer)
+            else:
+                moved = buffer.to(device, copy=True)
+            buffers.append(moved)
+        return PackedState(buffers, self.layout)
+
+    def restore(self, devices: Union[List, None] = None, dtypes: Union[List, None] = None):
+        """
+        Returns a new state with every tensor on devices[i] as dtypes[i], the buffers are moved
+        with one copy per target device, the tensors to cast are converted on their device.
+        """
+        import torch
+
+        moved: List[Dict[str, Any]] = [{} for _ in self.buffers]
+        tensors = []
+        for i, (index, offset, dtype, shape) in enumerate(self.layout):
+            buffer = self.buffers[index]
+            device = torch.device(devices[i]) if devices is not None else buffer.device
+            if str(device) not in moved[index]:
+                moved[index][str(device)] = buffer.to(
+                    device, non_blocking=buffer.is_pinned(), copy=True
+                )
+            tensors.append(self.__view(moved[index][str(device)], offset, dtype, shape))
+
+        same_dtypes = dtypes is None or all(
+            dtype is None or dtype == layout[2]
+            for dtype, layout in zip(dtypes, self.layout)
+        )
+        if same_dtypes and all(len(targets) == 1 for targets in moved):
+            return PackedState(
+                [next(iter(targets.values())) for targets in moved], self.layout
+            )
+        return PackedState.pack(tensors, dtypes)
+
+    def unpack(self, devices: Union[List, None] = None, dtypes: Union[List, None] = None) -> List:
+        """
+        Tensors for one generation, in memory of their own: the model replaces them as it runs.
+        """
+        return self.restore(devices, dtypes).tensors
+
+    def rows(self) -> List[List]:
+        """
+        States of a batch, as views of the rows.
+        """
+        if self.__rows is None:
+            self.__rows = [
+                [tensor[b] for tensor in self.tensors] for b in range(self.batch_size)
+            ]
+        return self.__rows
+
+    @classmethod
+    def stack(cls, states: List[List], previous: Union["PackedState", None] = None):
+        """
+        Packs the states of a batch into [B, nbytes] buffers.
+        The states that are still the rows of the previous batch are gathered with one copy per
+        buffer, previous itself is returned when the batch did not change; the other states are
+        copied in tensor by tensor.
+        """
+        import torch
+
+        devices, sizes, layout = cls.__plan(states[0])
+        sources: List[Union[int, None]] = [None] * len(states)
+        if previous is not None and previous.batch_size is not None:
+            if previous.layout == layout:
+                rows = previous.rows()
+                first = {id(row[0]): b for b, row in enumerate(rows)}
+                for b, state in enumerate(states):
+                    source = first.get(id(state[0]))
+                    # the model replaces the tensors it runs over, a row is only valid untouched
+                    if source is not None and all(
+                        x is y for x, y in zip(state, rows[source])
+                    ):
+                        sources[b] = source
+                if sources == list(range(previous.batch_size)):
+                    return previous
+
+        B = len(states)
+        buffers = [
+            torch.empty((B, size), dtype=torch.uint8, device=device)
+            for device, size in zip(devices, sizes)
+        ]
+        packed = cls(buffers, layout)
+        gathered = [(b, source) for b, source in enumerate(sources) if source is not None]
+        if gathered:
+            for buffer, old in zip(buffers, previous.buffers):
+                index = torch.tensor([b for b, _ in gathered], device=buffer.device)
+                source = torch.tensor([s for _, s in gathered], device=old.device)
+                buffer.index_copy_(0, index, old.index_select(0, source))
+        rows = packed.rows()
+        for b, state in enumerate(states):
+            if sources[b] is None:
+                for view, tensor in zip(rows[b], state):
+                    view.copy_(tensor)
+        return packed
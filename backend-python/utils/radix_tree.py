@@ -0,0 +1,140 @@
+from typing import Dict, List, Tuple, Union
+
+
+class RadixNode:
+    __slots__ = ("edge", "children", "parent", "id")
+
+    def __init__(self, edge: Tuple[int, ...], parent: Union["RadixNode", None]):
+        self.edge = edge  # token run from the parent to this node
+        self.children: Dict[int, RadixNode] = {}  # first token of the edge -> child
+        self.parent = parent
+        self.id: Union[int, None] = None  # set when an entry ends at this node
+
+
+class TokenRadixTree:
+    """
+    Radix tree over token ids, entries sharing a prefix share the nodes of that prefix.
+    Only the nodes where an entry ends carry an id, the token path of an entry is not stored twice.
+    """
+
+    def __init__(self):
+        self.root = RadixNode((), None)
+        self.nodes: Dict[int, RadixNode] = {}
+        self.next_id = 0
+        self.token_count = 0  # tokens stored on the edges
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __contains__(self, id: int) -> bool:
+        return id in self.nodes
+
+    def insert(self, tokens: List[int]) -> int:
+        """
+        Returns the id of the entry ending after tokens, the existing one if there is already one.
+        """
+        node = self.root
+        i = 0
+        while i < len(tokens):
+            child = node.children.get(tokens[i])
+            if child is None:
+                child = RadixNode(tuple(tokens[i:]), node)
+                node.children[tokens[i]] = child
+                self.token_count += len(child.edge)
+                node = child
+                break
+            edge = child.edge
+            n = 1
+            while n < len(edge) and i + n < len(tokens) and edge[n] == tokens[i + n]:
+                n += 1
+            if n < len(edge):
+                child = self.__split(child, n)
+            node = child
+            i += n
+
+        if node.id is None:
+            node.id = self.next_id
+            self.next_id += 1
+            self.nodes[node.id] = node
+        return node.id
+
+    def longest_prefix(self, tokens: List[int]) -> Tuple[int, int]:
+        """
+        Returns (id, length) of the deepest entry whose tokens are a prefix of tokens, (-1, 0) if none.
+        """
+        node = self.root
+        i = 0
+        best = (-1, 0)
+        while i < len(tokens):
+            child = node.children.get(tokens[i])
+            if child is None:
+                break
+            edge = child.edge
+            if len(edge) > len(tokens) - i or tuple(tokens[i : i + len(edge)]) != edge:
+                break
+            node = child
+            i += len(edge)
+            if node.id is not None:
+                best = (node.id, i)
+        return best
+
+    def shared_prefix(self, tokens: List[int]) -> Tuple[int, Union[int, None]]:
+        """
+        Returns (length, id): length of the longest prefix of tokens on a path of the tree,
+        id of the entry ending right there, None if there is none (inserting tokens branches off there).
+        """
+        node = self.root
+        i = 0
+        while i < len(tokens):
+            child = node.children.get(tokens[i])
+            if child is None:
+                break
+            edge = child.edge
+            n = 1
+            while n < len(edge) and i + n < len(tokens) and edge[n] == tokens[i + n]:
+                n += 1
+            if n < len(edge):
+                return i + n, None  # inside an edge
+            node = child
+            i += n
+        return i, node.id
+
+    def tokens(self, id: int) -> List[int]:
+        runs = []
+        node = self.nodes[id]
+        while node is not self.root:
+            runs.append(node.edge)
+            node = node.parent
+        return [token for run in reversed(runs) for token in run]
+
+    def remove(self, id: int):
+        node = self.nodes.pop(id, None)
+        if node is None:
+            return
+        node.id = None
+        # drop the branch if nothing ends below it anymore, then merge single-child chains
+        while node is not self.root and node.id is None and not node.children:
+            parent = node.parent
+            del parent.children[node.edge[0]]
+            self.token_count -= len(node.edge)
+            node = parent
+        if node is not self.root and node.id is None and len(node.children) == 1:
+            self.__merge(node)
+
+    def __split(self, node: RadixNode, n: int) -> RadixNode:
+        """
+        Cuts the edge of node after n tokens, returns the new upper node.
+        """
+        parent = node.parent
+        upper = RadixNode(node.edge[:n], parent)
+        parent.children[upper.edge[0]] = upper
+        node.edge = node.edge[n:]
+        node.parent = upper
+        upper.children[node.edge[0]] = node
+        return upper
+
+    def __merge(self, node: RadixNode):
+        (child,) = node.children.values()
+        child.edge = node.edge + child.edge
+        child.parent = node.parent
+        node.parent.children[child.edge[0]] = child
@@ -3,13 +3,19 @@ from enum import Enum, auto
 import os
 import pathlib
 import copy
+import functools
 import re
 import time
-from typing import Dict, Iterable, List, Tuple, Union, Type, Callable
+from collections import deque
+from typing import Any, Dict, Iterable, List, Tuple, Union, Type, Callable
 from utils.log import quick_log
 from fastapi import HTTPException, status
 from pydantic import BaseModel, Field
 from routes import state_cache
+from utils.session_state import session_state
+from utils.lesson_state import LessonPrompt, lesson_state
+from utils.packed_state import PackedState
+from utils.state_preset import state_presets
 import global_var
 from config.settings import get_settings
 
@@ -29,6 +35,7 @@ class AbstractRWKV(ABC):
         self.name = "rwkv"
         settings = get_settings()
         self.model_path = str(settings.DEFAULT_MODEL_PATH)
+        self.strategy = settings.DEFAULT_STRATEGY
         self.version = 4
         self.model = model
         self.pipeline = pipeline
@@ -46,14 +53,16 @@ class AbstractRWKV(ABC):
         self.penalty_decay = 0.996
         self.global_penalty = False
         self.state_path = ""
+        self.state_namespace = ""  # cache key of the loaded preset, changes when the file does
         self.state_tuned = None
+        self.batch_state = None
 
     @abstractmethod
-    def adjust_occurrence(self, occurrence: Dict, token: int):
+    def adjust_occurrence(self, ctx: "GenerationContext", token: int):
         pass
 
     @abstractmethod
-    def adjust_forward_logits(self, logits: List[float], occurrence: Dict, i: int):
+    def adjust_forward_logits(self, ctx: "GenerationContext"):
         pass
 
     # Model only saw '\n\n' as [187, 187] before, but the tokenizer outputs [535] for it at the end
@@ -67,6 +76,17 @@ class AbstractRWKV(ABC):
     ) -> Tuple[List[float], int]:
         pass
 
+    @abstractmethod
+    def run_rnn_context(
+        self, ctx: "GenerationContext", _tokens: List[str], newline_adj: int = 0
+    ) -> int:
+        pass
+
+    # feed one token per context, the contexts are stepped together between two samplings
+    @abstractmethod
+    def run_rnn_batch(self, ctxs: List["GenerationContext"], tokens: List[int]):
+        pass
+
     @abstractmethod
     def delta_postprocess(self, delta: str) -> str:
         pass
@@ -225,146 +245,519 @@ class AbstractRWKV(ABC):
 
                 return state[0].tolist(), token_len
 
-    def generate(
-        self, prompt: str, stop: Union[str, List[str], None] = None
-    ) -> Iterable[Tuple[str, str, int, int]]:
-        import numpy as np
+    def create_context(
+        self,
+        prompt: str,
+        stop: Union[str, List[str], None] = None,
+        session: Union["SessionPrompt", None] = None,
+        lesson: Union[LessonPrompt, None] = None,
+        sampling: Union[Dict[str, Any], None] = None,
+    ) -> "GenerationContext":
+        """
+        sampling overrides the model config for this request only, keys are GenerationContext
+        attributes (max_tokens, temperature, top_p, ...).
+        """
+        # snapshot the sampling config, so later set_rwkv_config calls do not leak into running requests
+        ctx = GenerationContext(prompt, stop)
+        ctx.session = session
+        ctx.lesson = lesson
+        ctx.max_tokens = self.max_tokens_per_generation
+        ctx.temperature = self.temperature
+        ctx.top_p = self.top_p
+        ctx.top_k = self.top_k
+        ctx.penalty_alpha_presence = self.penalty_alpha_presence
+        ctx.penalty_alpha_frequency = self.penalty_alpha_frequency
+        ctx.penalty_decay = self.penalty_decay
+        ctx.global_penalty = self.global_penalty
+        ctx.state_path = self.state_path
+        ctx.state_namespace = self.state_namespace
+        ctx.state_tuned = self.state_tuned
+        for key, value in (sampling or {}).items():
+            if key not in GenerationContext.SAMPLING_KEYS:
+                raise ValueError(f"unknown sampling parameter: {key}")
+            setattr(ctx, key, value)
+        return ctx
+
+    def cache_context(self, ctx: "GenerationContext"):
+        try:
+            state_cache.add_state(
+                state_cache.AddStateBody(
+                    tokens=ctx.tokens,
+                    state=ctx.state,
+                    logits=ctx.logits,
+                    namespace=ctx.state_namespace,
+                )
+            )
+        except HTTPException:
+            pass
+
+    def __cache_response(self, ctx: "GenerationContext"):
+        # called before the response is cut at the stop string, the state has consumed all of it
+        self.cache_context(ctx)
+
+    def __restore_session(
+        self, ctx: "GenerationContext"
+    ) -> Union[List[Tuple[List[int], Union[Callable[[], None], None]]], None]:
+        """
+        Starts from the state saved for the session if its tokens are a prefix of the prompt,
+        from the prefix cache otherwise, and saves the state at the end of the history for the next turn.
+        Returns the prefill segments, or None if the prompt is not a session prompt.
+        """
+        session = ctx.session
+        if session is None:
+            return None
+        # the whole prompt is tokenized, so a hit prefills exactly the tokens of a cold render
+        encoded = [int(x) for x in self.pipeline.encode(ctx.prompt)]
+        tokens = [int(x) for x in self.fix_tokens(encoded)]
+        cache = session_state.get(session.key, self.model_path, ctx.state_namespace)
+        if (
+            cache is not None
+            and len(cache["tokens"]) <= len(tokens)
+            and tokens[: len(cache["tokens"])] == cache["tokens"]
+        ):
+            ctx.state = cache["state"]
+            ctx.tokens = cache["tokens"]
+            ctx.logits = cache["logits"]
+            quick_log(None, None, "Session State Hit: " + session.key)
+            delta_tokens = tokens[len(ctx.tokens) :]
+        else:
+            delta_tokens = self.__restore_prefix(ctx, tokens)
+        marks = [self.__branch_mark(ctx, tokens)]
+
+        # the next turn renders the same history followed by this turn, so it starts with these tokens
+        history = [int(x) for x in self.pipeline.encode(session.history)]
+        if (
+            len(history) > 0
+            and len(history) < len(encoded)
+            and encoded[: len(history)] == history
+        ):
+
+            def store():
+                session_state.put(
+                    session.key,
+                    session.history,
+                    ctx.tokens,
+                    ctx.state,
+                    ctx.logits,
+                    self.model_path,
+                    ctx.state_namespace,
+                )
+
+            marks.append((len(history), store))
+        return self.__split_prefill(ctx, delta_tokens, marks)
+
+    def __restore_lesson(
+        self, ctx: "GenerationContext"
+    ) -> Union[List[Tuple[List[int], Union[Callable[[], None], None]]], None]:
+        """
+        Starts from the state after the lesson content, the content is prefilled first and stored on a miss.
+        Returns the prefill segments, or None if the prompt is not a lesson prompt.
+        """
+        lesson = ctx.lesson
+        if lesson is None:
+            return None
+        segments = []
+        cache = lesson_state.get(lesson.key, self.model_path, ctx.state_namespace)
+        if cache is not None and cache["reply"] == lesson.prefix:
+            ctx.state = cache["state"]
+            ctx.tokens = cache["tokens"]
+            ctx.logits = cache["logits"]
+            quick_log(None, None, "Lesson State Hit: " + lesson.key)
+        else:
+            # the lesson is prefilled on its own, so its state ends exactly at the content
+            if ctx.state_path:
+                ctx.state = ctx.state_tuned.unpack()
+            else:
+                ctx.state = None
+            ctx.tokens = []
+
+            def store():
+                lesson_state.put(
+                    lesson.key,
+                    lesson.prefix,
+                    ctx.tokens,
+                    ctx.state,
+                    ctx.logits,
+                    self.model_path,
+                    ctx.state_namespace,
+                )
+
+            segments.append((self.fix_tokens(self.pipeline.encode(lesson.prefix)), store))
+        if lesson.suffix != "":
+            segments.append((self.fix_tokens(self.pipeline.encode(lesson.suffix)), None))
+        return segments
 
-        quick_log(None, None, "Generation Prompt:\n" + prompt)
+    def __restore_prefix(self, ctx: "GenerationContext", tokens: List[int]) -> List[int]:
+        """
+        Loads the state of the longest cached token prefix of the prompt tokens,
+        returns the tokens still to prefill.
+        """
         cache = None
-        delta_prompt = prompt
         try:
             cache = state_cache.longest_prefix_state(
-                state_cache.LongestPrefixStateBody(prompt=prompt), None
+                state_cache.LongestPrefixStateBody(
+                    tokens=tokens, namespace=ctx.state_namespace
+                ),
+                None,
             )
         except HTTPException:
             pass
-        if cache is None or cache["prompt"] == "" or cache["state"] is None:
-            if self.state_path:
-                self.model_state = copy.deepcopy(self.state_tuned)
+        if cache is None or len(cache["tokens"]) == 0 or cache["state"] is None:
+            if ctx.state_path:
+                ctx.state = ctx.state_tuned.unpack()
             else:
-                self.model_state = None
-            self.model_tokens = []
-        else:
-            delta_prompt = prompt[len(cache["prompt"]) :]
-            self.model_state = cache["state"]
-            self.model_tokens = cache["tokens"]
-            logits = cache["logits"]
-
-        prompt_token_len = 0
-        if delta_prompt != "":
-            prompt_start_time = time.time()
-            logits, prompt_token_len = self.run_rnn(
-                self.fix_tokens(self.pipeline.encode(delta_prompt))
-            )
-            prompt_end_time = time.time()
-            prompt_interval = prompt_end_time - prompt_start_time
+                ctx.state = None
+            ctx.tokens = []
+            return tokens
+        ctx.state = cache["state"]
+        ctx.tokens = cache["tokens"]
+        ctx.logits = cache["logits"]
+        return tokens[len(cache["tokens"]) :]
+
+    def __branch_mark(
+        self, ctx: "GenerationContext", tokens: List[int]
+    ) -> Union[Tuple[int, Callable[[], None]], None]:
+        """
+        Where the prompt branches off the cached paths, the state there is cached on the way,
+        so that the other prompts sharing the prefix can start from it.
+        """
+        try:
+            offset = state_cache.branch_offset(tokens, ctx.state_namespace)
+        except HTTPException:
+            return None
+        if offset <= len(ctx.tokens):
+            return None
+        return offset, lambda: self.cache_context(ctx)
+
+    def __split_prefill(
+        self,
+        ctx: "GenerationContext",
+        delta_tokens: List[int],
+        marks: List[Union[Tuple[int, Callable[[], None]], None]],
+    ) -> List[Tuple[List[int], Union[Callable[[], None], None]]]:
+        """
+        Cuts the tokens still to prefill at the marks, (offset in the prompt, called once the prefill reaches it).
+        """
+        segments = []
+        begin = len(ctx.tokens)
+        pos = 0
+        for offset, done in sorted(
+            [mark for mark in marks if mark is not None], key=lambda mark: mark[0]
+        ):
+            split = offset - begin
+            if split <= 0 or split >= len(delta_tokens):
+                continue
+            segments.append((delta_tokens[pos:split], done))
+            pos = split
+        segments.append((delta_tokens[pos:], None))
+        return segments
+
+    def begin_prefill(self, ctx: "GenerationContext"):
+        """
+        Restores the best cached state for the prompt and queues the tokens still to run,
+        nothing goes through the model until prefill_step.
+        """
+        quick_log(None, None, "Generation Prompt:\n" + ctx.prompt)
+        segments = self.__restore_session(ctx)
+        if segments is None:
+            segments = self.__restore_lesson(ctx)
+            if segments is None:
+                # the whole prompt is tokenized, so a merge across the cached boundary cannot happen
+                tokens = [int(x) for x in self.fix_tokens(self.pipeline.encode(ctx.prompt))]
+                delta_tokens = self.__restore_prefix(ctx, tokens)
+                segments = self.__split_prefill(
+                    ctx, delta_tokens, [self.__branch_mark(ctx, tokens)]
+                )
+        ctx.prefill = [
+            ([int(x) for x in tokens], done)
+            for tokens, done in segments
+            if len(tokens) > 0 or done is not None
+        ]
+        ctx.prefill_tokens = 0
+        ctx.prefill_seconds = 0.0
+
+    def prefill_step(self, ctx: "GenerationContext", max_tokens: int = 0) -> bool:
+        """
+        Runs up to max_tokens (all of them if 0) of the queued prompt tokens,
+        so that a long prompt can be interleaved with the decode steps of other requests.
+        Returns True once the prompt is done and the context is ready to sample.
+        """
+        budget = max_tokens if max_tokens > 0 else None
+        start_time = time.time()
+        while ctx.prefill and (budget is None or budget > 0):
+            tokens, done = ctx.prefill[0]
+            count = len(tokens) if budget is None else min(budget, len(tokens))
+            if count > 0:
+                ctx.prompt_token_len += self.run_rnn_context(ctx, tokens[:count])
+                ctx.prefill_tokens += count
+                if budget is not None:
+                    budget -= count
+            if count < len(tokens):
+                ctx.prefill[0] = (tokens[count:], done)
+                continue
+            ctx.prefill.pop(0)
+            if done is not None:
+                done()
+        ctx.prefill_seconds += time.time() - start_time
+        if ctx.prefill:
+            return False
+
+        if ctx.prefill_tokens > 0:
             tps = 0
-            if prompt_interval > 0:
-                tps = prompt_token_len / prompt_interval
+            if ctx.prefill_seconds > 0:
+                tps = ctx.prefill_tokens / ctx.prefill_seconds
             print(f"Prompt Prefill TPS: {tps:.2f}", end=" ", flush=True)
-            try:
-                state_cache.add_state(
-                    state_cache.AddStateBody(
-                        prompt=prompt,
-                        tokens=self.model_tokens,
-                        state=self.model_state,
-                        logits=logits,
-                    )
-                )
-            except HTTPException:
-                pass
+            self.cache_context(ctx)
+
+        ctx.begin = len(ctx.tokens)
+        ctx.out_last = ctx.begin
+        ctx.decoder = self.pipeline.stream_decoder()
+        return True
+
+    def prefill_context(self, ctx: "GenerationContext"):
+        self.begin_prefill(ctx)
+        self.prefill_step(ctx)
+
+    def can_fork(self, ctx: "GenerationContext") -> bool:
+        """
+        Whether fork_context can copy the state of ctx. The WebGPU state stays on the device
+        ("State_Gpu"), the continuations then have to be prefilled on their own.
+        """
+        import numpy as np
 
-        begin = len(self.model_tokens)
-        out_last = begin
+        def copyable(x):
+            return x is None or hasattr(x, "clone") or type(x) == np.ndarray
 
-        occurrence: Dict = {}
+        if type(ctx.state) == list:
+            return all(copyable(tensor) for tensor in ctx.state)
+        return copyable(ctx.state)
 
-        completion_token_len = 0
-        response = ""
-        for i in range(self.max_tokens_per_generation):
-            self.adjust_forward_logits(logits, occurrence, i)
+    def fork_context(self, ctx: "GenerationContext") -> "GenerationContext":
+        """
+        Copy of a prefilled context, so that several continuations share one prefill.
+        The fork keeps the sampling config and samples on its own, it does not update the session state.
+        Only valid if can_fork(ctx).
+        """
+        import numpy as np
 
-            token = self.pipeline.sample_logits(
-                logits, temperature=self.temperature, top_p=self.top_p, top_k=self.top_k
-            )
+        def clone(x):
+            if x is None:
+                return None
+            if hasattr(x, "clone"):  # torch
+                return x.clone()
+            if type(x) == np.ndarray:  # rwkv.cpp
+                return np.copy(x)
+            if type(x) == list:  # WebGPU logits
+                return list(x)
+            raise ValueError(f"cannot copy {type(x).__name__}, check can_fork first")
+
+        if ctx.state is not None and type(ctx.state) != list:
+            state = clone(ctx.state)
+        elif ctx.state and hasattr(ctx.state[0], "device"):  # torch
+            state = PackedState.pack(ctx.state).tensors
+        else:
+            state = [clone(tensor) for tensor in ctx.state or []] or None
+        fork = copy.copy(ctx)
+        fork.state = state
+        fork.tokens = list(ctx.tokens)
+        fork.logits = clone(ctx.logits)
+        fork.occurrence = clone(ctx.occurrence)
+        fork.presence = clone(ctx.presence)
+        fork.stop_matcher = StopMatcher(ctx.stop)
+        fork.session = None
+        fork.decoder = self.pipeline.stream_decoder()
+        return fork
+
+    def next_token(self, ctx: "GenerationContext") -> int:
+        self.adjust_forward_logits(ctx)
+
+        token = self.pipeline.sample_logits(
+            ctx.logits, temperature=ctx.temperature, top_p=ctx.top_p, top_k=ctx.top_k
+        )
+        if token != self.EOS_ID:
+            self.adjust_occurrence(ctx, token)
+        return token
+
+    def finish_context(self, ctx: "GenerationContext") -> Tuple[str, str, int, int]:
+        self.__cache_response(ctx)
+        ctx.finished = True
+        return ctx.response, "", ctx.prompt_token_len, ctx.completion_token_len
+
+    def accept_token(
+        self, ctx: "GenerationContext"
+    ) -> Union[Tuple[str, str, int, int], None]:
+        """
+        Called after the sampled token has been fed through the model.
+        Returns the tuple to yield for this step, or None if nothing is printable yet.
+        """
+        ctx.completion_token_len = ctx.completion_token_len + 1
+        last_step = ctx.completion_token_len >= ctx.max_tokens
+        if last_step:
+            ctx.finished = True
+        # only the new tokens are decoded, an unfinished utf-8 character stays in the decoder
+        delta: str = self.delta_postprocess(
+            ctx.decoder.decode(ctx.tokens[ctx.out_last :])
+        )
+        ctx.out_last = len(ctx.tokens)
+        if delta == "" and ctx.decoder.pending:
+            return None
+        ctx.response += delta
+        stop_pos = ctx.stop_matcher.feed(delta)
+        if stop_pos >= 0:
+            self.__cache_response(ctx)
+            ctx.response = ctx.response[:stop_pos]
+            ctx.finished = True
+            return ctx.response, "", ctx.prompt_token_len, ctx.completion_token_len
+        if last_step:
+            self.__cache_response(ctx)
+        return ctx.response, delta, ctx.prompt_token_len, ctx.completion_token_len
 
+    def generate(
+        self, prompt: str, stop: Union[str, List[str], None] = None
+    ) -> Iterable[Tuple[str, str, int, int]]:
+        ctx = self.create_context(prompt, stop)
+        self.prefill_context(ctx)
+
+        while not ctx.finished:
+            token = self.next_token(ctx)
             if token == self.EOS_ID:
-                try:
-                    state_cache.add_state(
-                        state_cache.AddStateBody(
-                            prompt=prompt + response,
-                            tokens=self.model_tokens,
-                            state=self.model_state,
-                            logits=logits,
-                        )
-                    )
-                except HTTPException:
-                    pass
-                yield response, "", prompt_token_len, completion_token_len
+                yield self.finish_context(ctx)
                 break
 
-            self.adjust_occurrence(occurrence, token)
+            self.run_rnn_context(ctx, [token])
+            output = self.accept_token(ctx)
+            if output is not None:
+                yield output
+
+
+@functools.lru_cache(maxsize=32)
+def build_stop_automaton(stops: Tuple[str, ...]):
+    """
+    Aho-Corasick automaton over characters.
+    out[node] is the length of the longest stop string ending at node, 0 if none.
+    """
+    goto: List[Dict[str, int]] = [{}]
+    fail: List[int] = [0]
+    out: List[int] = [0]
+    for stop in stops:
+        node = 0
+        for ch in stop:
+            if ch not in goto[node]:
+                goto[node][ch] = len(goto)
+                goto.append({})
+                fail.append(0)
+                out.append(0)
+            node = goto[node][ch]
+        out[node] = max(out[node], len(stop))
+
+    queue = deque(goto[0].values())
+    while queue:
+        node = queue.popleft()
+        for ch, child in goto[node].items():
+            f = fail[node]
+            while f and ch not in goto[f]:
+                f = fail[f]
+            fail[child] = goto[f].get(ch, 0)
+            out[child] = max(out[child], out[fail[child]])
+            queue.append(child)
+    return goto, fail, out
+
+
+class StopMatcher:
+    """
+    Incremental stop string matcher, each delta is scanned once,
+    matches spanning several deltas are found as well.
+    """
+
+    def __init__(self, stop: Union[str, List[str], None]):
+        stops = [stop] if type(stop) == str else (stop or [])
+        self.goto, self.fail, self.out = build_stop_automaton(
+            tuple(s for s in stops if s)
+        )
+        self.node = 0
+        self.consumed = 0
+
+    def feed(self, text: str) -> int:
+        """
+        Returns the position (in all the text fed so far) where the first stop string starts, or -1.
+        """
+        goto, fail, out = self.goto, self.fail, self.out
+        node = self.node
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            self.consumed += 1
+            if out[node]:
+                self.node = node
+                return self.consumed - out[node]
+        self.node = node
+        return -1
+
+
+class SessionPrompt:
+    """
+    Turn of a chat session: history is the start of the prompt, everything before the current message.
+    The state after it is saved under key, the next turn renders the same history followed by this turn.
+    """
+
+    def __init__(self, key: str, history: str):
+        self.key = key
+        self.history = history
+
+
+class GenerationContext:
+    """
+    Per-request decoding state, so that several generations can share one model.
+    """
+
+    SAMPLING_KEYS = (
+        "max_tokens",
+        "temperature",
+        "top_p",
+        "top_k",
+        "penalty_alpha_presence",
+        "penalty_alpha_frequency",
+        "penalty_decay",
+        "global_penalty",
+    )
 
-            logits, _ = self.run_rnn([token])
-            completion_token_len = completion_token_len + 1
-            delta: str = self.delta_postprocess(
-                self.pipeline.decode(self.model_tokens[out_last:])
-            )
-            if "\ufffd" not in delta:  # avoid utf-8 display issues
-                response += delta
-                if stop is not None:
-                    if type(stop) == str:
-                        if stop in response:
-                            try:
-                                state_cache.add_state(
-                                    state_cache.AddStateBody(
-                                        prompt=prompt + response,
-                                        tokens=self.model_tokens,
-                                        state=self.model_state,
-                                        logits=logits,
-                                    )
-                                )
-                            except HTTPException:
-                                pass
-                            response = response.split(stop)[0]
-                            yield response, "", prompt_token_len, completion_token_len
-                            break
-                    elif type(stop) == list:
-                        exit_flag = False
-                        for s in stop:
-                            if s in response:
-                                try:
-                                    state_cache.add_state(
-                                        state_cache.AddStateBody(
-                                            prompt=prompt + response,
-                                            tokens=self.model_tokens,
-                                            state=self.model_state,
-                                            logits=logits,
-                                        )
-                                    )
-                                except HTTPException:
-                                    pass
-                                exit_flag = True
-                                response = response.split(s)[0]
-                                yield response, "", prompt_token_len, completion_token_len
-                                break
-                        if exit_flag:
-                            break
-                out_last = begin + i + 1
-                if i == self.max_tokens_per_generation - 1:
-                    try:
-                        state_cache.add_state(
-                            state_cache.AddStateBody(
-                                prompt=prompt + response,
-                                tokens=self.model_tokens,
-                                state=self.model_state,
-                                logits=logits,
-                            )
-                        )
-                    except HTTPException:
-                        pass
-                yield response, delta, prompt_token_len, completion_token_len
+    def __init__(self, prompt: str, stop: Union[str, List[str], None] = None):
+        self.prompt = prompt
+        self.stop = stop
+        self.stop_matcher = StopMatcher(stop)
+        self.session: Union[SessionPrompt, None] = None
+        self.lesson: Union[LessonPrompt, None] = None
+        self.prefill_only = False  # e.g. lesson warm-up, nothing is generated
+        # prompt tokens still to run, (tokens, called once they have run), see prefill_step
+        self.prefill: List[Tuple[List[int], Union[Callable[[], None], None]]] = []
+        self.prefill_tokens = 0
+        self.prefill_seconds = 0.0
+
+        self.state = None
+        self.tokens: List[int] = []
+        self.logits = None
+        self.occurrence = None  # dense repetition penalty, see TextRWKV.adjust_occurrence
+        self.presence = None
+        self.response = ""
+        self.begin = 0
+        self.out_last = 0
+        self.decoder = None
+        self.prompt_token_len = 0
+        self.completion_token_len = 0
+        self.finished = False
+
+        self.max_tokens = 1000
+        self.temperature = 0.8
+        self.top_p = 0.3
+        self.top_k = 0
+        self.penalty_alpha_presence = 0
+        self.penalty_alpha_frequency = 0.8
+        self.penalty_decay = 0.996
+        self.global_penalty = False
+        self.state_path = ""
+        self.state_namespace = ""
+        self.state_tuned = None
 
 
 class TextRWKV(AbstractRWKV):
@@ -407,28 +800,68 @@ class TextRWKV(AbstractRWKV):
 
         self.__preload()
 
-    def adjust_occurrence(self, occurrence: Dict, token: int):
-        for xxx in occurrence:
-            occurrence[xxx] *= self.penalty_decay
-        if token not in occurrence:
-            occurrence[token] = 1
+    def __init_penalty(self, ctx: GenerationContext):
+        import numpy as np
+
+        # dense [vocab] vectors on the logits' device: decayed token counts and a presence mask
+        if type(ctx.logits) == list:
+            ctx.logits = np.array(ctx.logits, dtype=np.float32)
+        if ctx.occurrence is None:
+            if type(ctx.logits) == np.ndarray:
+                ctx.occurrence = np.zeros(len(ctx.logits), dtype=np.float32)
+                ctx.presence = np.zeros(len(ctx.logits), dtype=np.float32)
+            else:
+                import torch
+
+                ctx.occurrence = torch.zeros_like(ctx.logits, dtype=torch.float)
+                ctx.presence = torch.zeros_like(ctx.logits, dtype=torch.float)
+
+    def adjust_occurrence(self, ctx: GenerationContext, token: int):
+        self.__init_penalty(ctx)
+        ctx.occurrence *= ctx.penalty_decay
+        ctx.occurrence[token] += 1
+        ctx.presence[token] = 1
+
+    def __replay_occurrence(self, ctx: GenerationContext, tokens: List[int]):
+        """
+        Same result as calling adjust_occurrence for every token in order,
+        the i-th token from the end is decayed penalty_decay ** i times.
+        """
+        import numpy as np
+
+        tokens = [t for t in tokens if t not in self.AVOID_PENALTY_TOKENS]
+        if len(tokens) == 0:
+            return
+        weights = ctx.penalty_decay ** np.arange(
+            len(tokens) - 1, -1, -1, dtype=np.float64
+        )
+        ctx.occurrence *= ctx.penalty_decay ** len(tokens)
+        if type(ctx.occurrence) == np.ndarray:
+            np.add.at(ctx.occurrence, tokens, weights.astype(np.float32))
+            ctx.presence[tokens] = 1
         else:
-            occurrence[token] += 1
-
-    def adjust_forward_logits(self, logits: List[float], occurrence: Dict, i: int):
-        for n in occurrence:
-            # if n not in self.AVOID_PENALTY_TOKENS:
-            logits[n] -= (
-                self.penalty_alpha_presence
-                + occurrence[n] * self.penalty_alpha_frequency
+            import torch
+
+            index = torch.tensor(tokens, dtype=torch.long, device=ctx.occurrence.device)
+            ctx.occurrence.index_add_(
+                0,
+                index,
+                torch.from_numpy(weights).to(
+                    dtype=torch.float, device=ctx.occurrence.device
+                ),
             )
+            ctx.presence[index] = 1
+
+    def adjust_forward_logits(self, ctx: GenerationContext):
+        self.__init_penalty(ctx)
+        ctx.logits -= (
+            ctx.presence * ctx.penalty_alpha_presence
+            + ctx.occurrence * ctx.penalty_alpha_frequency
+        )
 
         # set global_penalty to False to get the same generated results as the official RWKV Gradio
-        if self.global_penalty and i == 0:
-            for token in self.model_tokens:
-                token = int(token)
-                if token not in self.AVOID_PENALTY_TOKENS:
-                    self.adjust_occurrence(occurrence, token)
+        if ctx.global_penalty and ctx.completion_token_len == 0:
+            self.__replay_occurrence(ctx, [int(token) for token in ctx.tokens])
 
     # Model only saw '\n\n' as [187, 187] before, but the tokenizer outputs [535] for it at the end
     def fix_tokens(self, tokens) -> List[int]:
@@ -438,6 +871,19 @@ class TextRWKV(AbstractRWKV):
             tokens = tokens[:-1] + [self.END_OF_LINE, self.END_OF_LINE]
         return tokens
 
+    def __forward(self, tokens: List[int], state):
+        while len(tokens) > 0:
+            out, state = self.model.forward(tokens[: self.CHUNK_LEN], state)
+            tokens = tokens[self.CHUNK_LEN :]
+        return out, state
+
+    def __adjust_out(self, out, model_tokens: List[int], newline_adj: int = 0):
+        out[self.END_OF_LINE] += newline_adj  # adjust \n probability
+
+        if model_tokens[-1] in self.AVOID_REPEAT_TOKENS:
+            out[model_tokens[-1]] = -999999999
+        return out
+
     def run_rnn(
         self, _tokens: List[str], newline_adj: int = 0
     ) -> Tuple[List[float], int]:
@@ -445,17 +891,47 @@ class TextRWKV(AbstractRWKV):
         token_len = len(tokens)
         self.model_tokens += tokens
 
-        while len(tokens) > 0:
-            out, self.model_state = self.model.forward(
-                tokens[: self.CHUNK_LEN], self.model_state
-            )
-            tokens = tokens[self.CHUNK_LEN :]
+        out, self.model_state = self.__forward(tokens, self.model_state)
+        return self.__adjust_out(out, self.model_tokens, newline_adj), token_len
 
-        out[self.END_OF_LINE] += newline_adj  # adjust \n probability
-
-        if self.model_tokens[-1] in self.AVOID_REPEAT_TOKENS:
-            out[self.model_tokens[-1]] = -999999999
-        return out, token_len
+    def run_rnn_context(
+        self, ctx: GenerationContext, _tokens: List[str], newline_adj: int = 0
+    ) -> int:
+        tokens = [int(x) for x in _tokens]
+        token_len = len(tokens)
+        ctx.tokens += tokens
+
+        out, ctx.state = self.__forward(tokens, ctx.state)
+        ctx.logits = self.__adjust_out(out, ctx.tokens, newline_adj)
+        return token_len
+
+    def run_rnn_batch(self, ctxs: List[GenerationContext], tokens: List[int]):
+        if (
+            len(ctxs) > 1
+            and hasattr(self.model, "forward_batch")
+            and int(self.version) in [5, 6]
+        ):
+            tokens = [int(x) for x in tokens]
+            states = [ctx.state for ctx in ctxs]
+            batch_state = None
+            if all(state is not None for state in states):
+                # consecutive steps of the same batch run in place in one [B, nbytes] buffer
+                self.batch_state = PackedState.stack(states, self.batch_state)
+                batch_state = self.batch_state.tensors
+            outs, states = self.model.forward_batch(
+                [[token] for token in tokens], states, batch_state
+            )
+            if batch_state is not None:
+                # the contexts get their own lists, the model replaces the tensors of a list it runs
+                states = [list(row) for row in self.batch_state.rows()]
+            for ctx, token, out, state in zip(ctxs, tokens, outs, states):
+                ctx.tokens.append(token)
+                ctx.state = state
+                ctx.logits = self.__adjust_out(out, ctx.tokens)
+            return
+
+        for ctx, token in zip(ctxs, tokens):
+            self.run_rnn_context(ctx, [token])
 
     def delta_postprocess(self, delta: str) -> str:
         return delta
@@ -482,7 +958,6 @@ The following is a coherent verbose detailed conversation between a girl named {
         try:
             state_cache.add_state(
                 state_cache.AddStateBody(
-                    prompt=preset_system,
                     tokens=self.model_tokens,
                     state=self.model_state,
                     logits=logits,
@@ -576,6 +1051,7 @@ def RWKV(model: str, strategy: str, tokenizer: Union[str, None]) -> AbstractRWKV
         rwkv = TextRWKV(model, pipeline)
     rwkv.name = filename
     rwkv.model_path = model_path
+    rwkv.strategy = strategy
     rwkv.version = model.version
 
     return rwkv
@@ -611,68 +1087,86 @@ class ModelConfigBody(BaseModel):
     }
 
 
+def build_state_tuned(model: AbstractRWKV, state_path: str) -> PackedState:
+    """
+    Reads a state-tuned file into the initial state of the model, raises HTTPException if it does not fit.
+    """
+    import torch
+
+    try:
+        state_raw = torch.load(state_path, map_location="cpu")
+    except Exception as e:
+        print(e)
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "state file failed to load")
+    state_raw_shape = next(iter(state_raw.values())).shape
+
+    args = model.model.args
+    if (
+        len(state_raw) != args.n_layer
+        or state_raw_shape[0] * state_raw_shape[1] != args.n_embd
+    ):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "state shape mismatch")
+
+    strategy = model.model.strategy
+    state_tuned = [None] * args.n_layer * 3
+
+    for i in range(args.n_layer):
+        dd = strategy[i]
+        dev = dd.device
+        atype = dd.atype
+        state_tuned[i * 3 + 0] = torch.zeros(
+            args.n_embd, dtype=atype, requires_grad=False, device=dev
+        ).contiguous()
+        state_tuned[i * 3 + 1] = (
+            state_raw[f"blocks.{i}.att.time_state"]
+            .transpose(1, 2)
+            .to(dtype=torch.float, device=dev)
+            .requires_grad_(False)
+            .contiguous()
+        )
+        state_tuned[i * 3 + 2] = torch.zeros(
+            args.n_embd, dtype=atype, requires_grad=False, device=dev
+        ).contiguous()
+
+    # every generation starts from a copy of it, one memcpy per device
+    return PackedState.pack(state_tuned)
+
+
 def load_rwkv_state(
     model: AbstractRWKV, state_path: str, print_log: bool = True
 ) -> HTTPException:
+    """
+    Selects the state-tuned preset of the next generations. The presets stay resident in
+    state_presets and the prefix cache is namespaced by state file and its mtime, so switching is
+    a lookup and a rewritten file never matches the states cached from the old one.
+    """
     if model:
         if state_path:
             if model.model_path.endswith(".pth") and state_path.endswith(".pth"):
-                import torch
-
                 state_path = get_model_path(state_path)
-                if model.state_path == state_path:
-                    return
-
                 if not os.path.isfile(state_path):
                     return HTTPException(
                         status.HTTP_400_BAD_REQUEST, "state file not found"
                     )
 
                 try:
-                    state_raw = torch.load(state_path, map_location="cpu")
-                except Exception as e:
-                    print(e)
-                    return HTTPException(
-                        status.HTTP_400_BAD_REQUEST, "state file failed to load"
+                    state_tuned, state_namespace = state_presets.get(
+                        model.model_path,
+                        state_path,
+                        lambda path: build_state_tuned(model, path),
                     )
-                state_raw_shape = next(iter(state_raw.values())).shape
-
-                args = model.model.args
-                if (
-                    len(state_raw) != args.n_layer
-                    or state_raw_shape[0] * state_raw_shape[1] != args.n_embd
-                ):
+                except HTTPException as e:
                     if model.state_path:
                         pass
                     elif print_log:
                         print("state failed to load")
-                    return HTTPException(
-                        status.HTTP_400_BAD_REQUEST, "state shape mismatch"
-                    )
-
-                strategy = model.model.strategy
-                model.state_tuned = [None] * args.n_layer * 3
+                    return e
 
-                for i in range(args.n_layer):
-                    dd = strategy[i]
-                    dev = dd.device
-                    atype = dd.atype
-                    model.state_tuned[i * 3 + 0] = torch.zeros(
-                        args.n_embd, dtype=atype, requires_grad=False, device=dev
-                    ).contiguous()
-                    model.state_tuned[i * 3 + 1] = (
-                        state_raw[f"blocks.{i}.att.time_state"]
-                        .transpose(1, 2)
-                        .to(dtype=torch.float, device=dev)
-                        .requires_grad_(False)
-                        .contiguous()
-                    )
-                    model.state_tuned[i * 3 + 2] = torch.zeros(
-                        args.n_embd, dtype=atype, requires_grad=False, device=dev
-                    ).contiguous()
-
-                state_cache.force_reset_state()
+                if model.state_namespace == state_namespace:
+                    return
+                model.state_tuned = state_tuned
                 model.state_path = state_path
+                model.state_namespace = state_namespace
                 if print_log:
                     print("state loaded")
             else:
@@ -686,9 +1180,9 @@ def load_rwkv_state(
                 )
         else:
             if state_path == "" and model.state_path != "":
-                state_cache.force_reset_state()
                 model.state_path = ""
-                model.state_tuned = None  # TODO cached
+                model.state_namespace = ""
+                model.state_tuned = None  # still resident in state_presets
                 if print_log:
                     print("state unloaded")
     else:
@@ -0,0 +1,531 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from typing import Any, Dict, List, Tuple, Union
+
+from fastapi import HTTPException, status
+
+from utils.log import quick_log
+from utils.rwkv import AbstractRWKV, GenerationContext, SessionPrompt
+from utils.lesson_state import LessonPrompt
+import global_var
+from config.settings import get_settings
+
+# lower value is served first
+PRIORITY_INTERACTIVE = 0  # chat / QA
+PRIORITY_BATCH = 1  # exercise / outline generation
+
+
+class QueueFullError(HTTPException):
+    def __init__(self, retry_after: int):
+        super().__init__(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="推理队列已满，请稍后重试",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+class QueueTimeoutError(HTTPException):
+    def __init__(self, retry_after: int):
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="排队等待超时，请稍后重试",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+class TooManyCompletionsError(HTTPException):
+    def __init__(self, max_n: int):
+        super().__init__(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"n不能超过{max_n}（同时解码的最大请求数）",
+        )
+
+
+class GenerationTask:
+    """
+    Handle of a generation running on the scheduler thread.
+    Outputs are the same (response, delta, prompt_tokens, completion_tokens) tuples
+    as AbstractRWKV.generate, consumed with `async for`.
+    """
+
+    __DONE = object()
+
+    def __init__(
+        self,
+        model: AbstractRWKV,
+        ctx: GenerationContext,
+        loop: asyncio.AbstractEventLoop,
+        priority: int = PRIORITY_INTERACTIVE,
+        deadline: Union[float, None] = None,
+    ):
+        self.model = model
+        self.ctx = ctx
+        self.loop = loop
+        self.priority = priority
+        self.deadline = deadline  # latest time.monotonic() to leave the queue
+        self.seq = 0  # arrival order, kept when the task is preempted
+        self.prefilled = False
+        self.preempted = False
+        self.slice_tokens = 0  # tokens decoded since the task was (re)admitted
+        self.forks: List["GenerationTask"] = []  # continuations started from this prefill
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.started = asyncio.Event()
+        self.cancelled = False
+        self.closed = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _put(self, item):
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+        except RuntimeError:  # event loop already closed
+            self.cancelled = True
+
+    def start(self):
+        try:
+            self.loop.call_soon_threadsafe(self.started.set)
+        except RuntimeError:
+            self.cancelled = True
+
+    def emit(self, output: Tuple[str, str, int, int]):
+        self._put(output)
+
+    def fail(self, e: Exception):
+        self.closed = True
+        self._put(e)
+        self.start()  # wake up wait_started
+
+    def close(self):
+        self.closed = True
+        self._put(GenerationTask.__DONE)
+        self.start()
+
+    async def wait_started(self, timeout: float) -> bool:
+        """
+        Returns True once the task has left the queue, False on timeout.
+        """
+        try:
+            await asyncio.wait_for(self.started.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def __aiter__(self):
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is GenerationTask.__DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # the consumer stopped early (break, disconnect, asyncio cancellation)
+            self.cancel()
+
+
+class InferenceScheduler:
+    """
+    Continuous batching: every decode step samples one token for each running task,
+    then feeds all of them through the model together.
+    Waiting tasks are admitted between two decode steps, by priority then arrival.
+    The waiting queue is bounded, tasks that wait past their deadline are dropped.
+
+    An admitted prompt is prefilled prefill_chunk tokens per loop iteration, between the
+    decode steps of the running tasks, so a long prompt does not stall their output.
+
+    A batch task that has decoded preempt_interval tokens can be put back in the queue
+    when interactive tasks are waiting for a slot. Its GenerationContext holds the whole
+    decoding state (RNN state, tokens, logits, penalties), so it resumes exactly later.
+
+    A task submitted with n > 1 is prefilled once, then forked into n - 1 more tasks
+    that sample on their own (n-best, several questions from one prompt).
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int = 8,
+        max_queue_size: int = 32,
+        queue_timeout: Union[Dict[int, float], None] = None,
+        retry_after: int = 10,
+        preempt_interval: int = 64,
+        prefill_chunk: int = 512,
+    ):
+        self.max_batch_size = max_batch_size
+        self.max_queue_size = max_queue_size
+        self.queue_timeout = queue_timeout or {}
+        self.retry_after = retry_after
+        self.preempt_interval = preempt_interval
+        self.prefill_chunk = prefill_chunk
+        self.waiting: List[Tuple[int, int, GenerationTask]] = []  # heap
+        self.running: List[GenerationTask] = []
+        self.prefilling: List[GenerationTask] = []  # admitted, prompt partly prefilled
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.thread: Union[threading.Thread, None] = None
+
+    def check_admission(self, priority: int = PRIORITY_INTERACTIVE):
+        """
+        Raise QueueFullError early, before a route does its retrieval work.
+        """
+        with self.cond:
+            if self.__queue_full() and self.__shed_candidate(priority) is None:
+                raise QueueFullError(self.retry_after)
+
+    def submit(
+        self,
+        model: AbstractRWKV,
+        prompt: str,
+        stop: Union[str, List[str], None] = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        timeout: Union[float, None] = None,
+        session: Union[SessionPrompt, None] = None,
+        lesson: Union[LessonPrompt, None] = None,
+        prefill_only: bool = False,
+        n: int = 1,
+        sampling: Union[Dict[str, Any], None] = None,
+    ) -> GenerationTask:
+        """
+        Returns the task of the first continuation, the other n - 1 are in task.forks.
+        n is bounded by max_completions(priority), all the continuations decode in one batch.
+        sampling overrides the model config (max_tokens, temperature, top_p, ...) for this
+        request only, the shared model is left untouched.
+        """
+        # must be called from the event loop, right after set_rwkv_config
+        max_n = self.max_completions(priority)
+        if n < 1 or n > max_n:
+            raise TooManyCompletionsError(max_n)
+        if timeout is None:
+            timeout = self.queue_timeout.get(priority)
+        deadline = time.monotonic() + timeout if timeout else None
+        loop = asyncio.get_running_loop()
+        ctx = model.create_context(prompt, stop, session, lesson, sampling)
+        ctx.prefill_only = prefill_only
+        task = GenerationTask(model, ctx, loop, priority, deadline)
+        # the forks get a context of their own in case the state cannot be copied (WebGPU)
+        task.forks = [
+            GenerationTask(
+                model,
+                model.create_context(prompt, stop, None, lesson, sampling),
+                loop,
+                priority,
+            )
+            for _ in range(n - 1)
+        ]
+        with self.cond:
+            if self.__queue_full():
+                shed = self.__shed_candidate(priority)
+                if shed is None:
+                    raise QueueFullError(self.retry_after)
+                # load shedding: the newest waiting task of a lower priority makes room
+                self.waiting.remove(shed)
+                heapq.heapify(self.waiting)
+                shed[2].fail(QueueFullError(self.retry_after))
+            task.seq = next(self.counter)
+            heapq.heappush(self.waiting, (priority, task.seq, task))
+            self.__ensure_thread()
+            self.cond.notify()
+        return task
+
+    def max_completions(self, priority: int = PRIORITY_INTERACTIVE) -> int:
+        """
+        Largest n of one submit: a task and its forks take a slot each, batch jobs leave one
+        slot free for interactive requests.
+        """
+        limit = self.__batch_limit()
+        if priority != PRIORITY_INTERACTIVE and limit > 1:
+            limit -= 1
+        return limit
+
+    def position(self, task: GenerationTask) -> int:
+        """
+        Number of waiting tasks served before this one, -1 if it is not waiting.
+        """
+        with self.cond:
+            key = None
+            for item in self.waiting:
+                if item[2] is task:
+                    key = item[:2]
+                    break
+            if key is None:
+                return -1
+            return len(
+                [
+                    item
+                    for item in self.waiting
+                    if item[:2] < key and not item[2].cancelled
+                ]
+            )
+
+    def stats(self) -> Dict:
+        with self.cond:
+            waiting = [item[2] for item in self.waiting if not item[2].cancelled]
+            return {
+                "running": len(self.running),
+                "prefilling": len(self.prefilling),
+                "waiting": len(waiting),
+                "waiting_interactive": len(
+                    [t for t in waiting if t.priority == PRIORITY_INTERACTIVE]
+                ),
+                "waiting_batch": len(
+                    [t for t in waiting if t.priority != PRIORITY_INTERACTIVE]
+                ),
+                "max_batch_size": self.max_batch_size,
+                "max_queue_size": self.max_queue_size,
+            }
+
+    def __queue_full(self) -> bool:
+        # preempted tasks were already admitted once, they do not count against new arrivals
+        waiting = len(
+            [
+                item
+                for item in self.waiting
+                if not item[2].cancelled and not item[2].preempted
+            ]
+        )
+        return waiting >= self.max_queue_size
+
+    def __shed_candidate(self, priority: int):
+        candidates = [
+            item
+            for item in self.waiting
+            if item[0] > priority and not item[2].cancelled and not item[2].preempted
+        ]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda item: item[:2])
+
+    def __ensure_thread(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(
+                target=self.__loop, name="inference-scheduler", daemon=True
+            )
+            self.thread.start()
+
+    def __batch_limit(self) -> int:
+        args = global_var.get(global_var.Args)
+        if args is not None and getattr(args, "webgpu", False):
+            return 1  # web-rwkv keeps a single state on the device
+        return max(1, self.max_batch_size)
+
+    def __preemptible(self) -> bool:
+        args = global_var.get(global_var.Args)
+        if args is not None and getattr(args, "webgpu", False):
+            return False  # the state stays on the device, it cannot be parked
+        return self.preempt_interval > 0
+
+    def __occupied(self) -> int:
+        # a prefilling task holds a slot for each continuation it is about to fork
+        return len(self.running) + sum(1 + len(task.forks) for task in self.prefilling)
+
+    def __preempt(self, limit: int):
+        # a cancelled task (client gone) neither asks for a slot nor holds one:
+        # it is closed at the next step, it must not park a live batch generation
+        interactive_waiting = len(
+            [
+                item
+                for item in self.waiting
+                if item[0] == PRIORITY_INTERACTIVE and not item[2].cancelled
+            ]
+        )
+        running = len(
+            [task for task in self.running if not task.cancelled and not task.closed]
+        ) + sum(1 + len(task.forks) for task in self.prefilling)
+        needed = interactive_waiting - (limit - running)
+        if needed <= 0 or not self.__preemptible():
+            return
+        candidates = [
+            task
+            for task in self.running
+            if task.priority != PRIORITY_INTERACTIVE
+            and not task.closed
+            and not task.cancelled
+            and task.slice_tokens >= self.preempt_interval
+        ]
+        # the latest arrivals are parked first
+        candidates.sort(key=lambda task: task.seq, reverse=True)
+        for task in candidates[:needed]:
+            self.running.remove(task)
+            task.preempted = True
+            task.deadline = None
+            task.slice_tokens = 0
+            heapq.heappush(self.waiting, (task.priority, task.seq, task))
+
+    def __admit(self) -> List[GenerationTask]:
+        with self.cond:
+            while not self.waiting and not self.running and not self.prefilling:
+                self.cond.wait()
+
+            now = time.monotonic()
+            for _, _, task in self.waiting:
+                if task.cancelled:
+                    task.close()
+                elif task.deadline is not None and now > task.deadline:
+                    task.fail(QueueTimeoutError(self.retry_after))
+            self.waiting = [item for item in self.waiting if not item[2].closed]
+            heapq.heapify(self.waiting)
+            # free the slots of running tasks whose client went away before counting them
+            for task in self.running:
+                if task.cancelled:
+                    task.close()
+            self.running = [task for task in self.running if not task.closed]
+
+            admitted = []
+            slots = 0  # a task about to fork takes a slot per continuation
+            limit = self.__batch_limit()
+            self.__preempt(limit)
+            # keep one slot free for interactive requests while batch jobs are decoding
+            batch_limit = limit - 1 if limit > 1 else limit
+            running_batch = len(
+                [t for t in self.running if t.priority != PRIORITY_INTERACTIVE]
+            ) + sum(
+                1 + len(t.forks)
+                for t in self.prefilling
+                if t.priority != PRIORITY_INTERACTIVE
+            )
+            deferred = []
+            while self.waiting and self.__occupied() + slots < limit:
+                item = heapq.heappop(self.waiting)
+                task = item[2]
+                task_slots = 1 if task.prefilled else 1 + len(task.forks)
+                if task.priority != PRIORITY_INTERACTIVE:
+                    if running_batch >= batch_limit:
+                        deferred.append(item)
+                        continue
+                    running_batch += task_slots
+                task.start()
+                admitted.append(task)
+                slots += task_slots
+            for item in deferred:
+                heapq.heappush(self.waiting, item)
+            return admitted
+
+    def __loop(self):
+        while True:
+            for task in self.__admit():
+                if task.prefilled:  # preempted, its context is ready to decode
+                    with self.cond:
+                        self.running.append(task)
+                    continue
+                try:
+                    task.model.begin_prefill(task.ctx)
+                    with self.cond:
+                        self.prefilling.append(task)
+                except Exception as e:
+                    self.__prefill_failed(task, e)
+
+            # one chunk of each pending prompt, then one decode step of the running tasks
+            for task in list(self.prefilling):
+                self.__prefill(task)
+
+            groups: Dict[int, List[GenerationTask]] = {}
+            for task in self.running:
+                if task.cancelled:
+                    task.close()
+                else:
+                    groups.setdefault(id(task.model), []).append(task)
+            for tasks in groups.values():
+                self.__step(tasks)
+
+            with self.cond:
+                self.running = [task for task in self.running if not task.closed]
+
+    def __prefill(self, task: GenerationTask):
+        if task.cancelled and all(fork.cancelled for fork in task.forks):
+            task.close()
+            for fork in task.forks:
+                fork.close()
+            with self.cond:
+                self.prefilling.remove(task)
+            return
+        try:
+            if not task.model.prefill_step(task.ctx, self.prefill_chunk):
+                return
+        except Exception as e:
+            with self.cond:
+                self.prefilling.remove(task)
+            self.__prefill_failed(task, e)
+            return
+        task.prefilled = True
+        with self.cond:
+            self.prefilling.remove(task)
+        self.__fork(task)
+        if task.ctx.prefill_only:
+            task.close()
+            return
+        with self.cond:
+            self.running.append(task)
+
+    def __prefill_failed(self, task: GenerationTask, e: Exception):
+        print(f"Prefill error: {e}")
+        task.fail(e)
+        for fork in task.forks:
+            if not fork.prefilled:
+                fork.fail(e)
+
+    def __fork(self, task: GenerationTask):
+        for fork in task.forks:
+            if fork.cancelled:
+                fork.close()
+                continue
+            if not task.model.can_fork(task.ctx):
+                # prefilled on its own, as a separate request
+                with self.cond:
+                    fork.seq = next(self.counter)
+                    heapq.heappush(self.waiting, (fork.priority, fork.seq, fork))
+                continue
+            fork.ctx = task.model.fork_context(task.ctx)
+            fork.seq = task.seq
+            fork.prefilled = True
+            fork.start()
+            with self.cond:
+                self.running.append(fork)
+
+    def __step(self, tasks: List[GenerationTask]):
+        model = tasks[0].model
+        try:
+            active: List[GenerationTask] = []
+            tokens: List[int] = []
+            for task in tasks:
+                token = model.next_token(task.ctx)
+                if token == model.EOS_ID:
+                    task.emit(model.finish_context(task.ctx))
+                    task.close()
+                else:
+                    active.append(task)
+                    tokens.append(token)
+            if not active:
+                return
+
+            model.run_rnn_batch([task.ctx for task in active], tokens)
+            for task in active:
+                task.slice_tokens += 1
+                output = model.accept_token(task.ctx)
+                if output is not None:
+                    task.emit(output)
+                if task.ctx.finished:
+                    task.close()
+        except Exception as e:
+            print(f"Generation error: {e}")
+            quick_log(None, None, f"Scheduler step failed: {e}")
+            for task in tasks:
+                if not task.closed:
+                    task.fail(e)
+
+
+settings = get_settings()
+scheduler = InferenceScheduler(
+    settings.RWKV_MAX_BATCH_SIZE,
+    settings.RWKV_MAX_QUEUE_SIZE,
+    {
+        PRIORITY_INTERACTIVE: settings.RWKV_QUEUE_TIMEOUT,
+        PRIORITY_BATCH: settings.RWKV_BATCH_QUEUE_TIMEOUT,
+    },
+    settings.RWKV_RETRY_AFTER,
+    settings.RWKV_PREEMPT_INTERVAL,
+    settings.RWKV_PREFILL_CHUNK,
+)
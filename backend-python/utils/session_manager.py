@@ -3,6 +3,7 @@ import pickle
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 from config.settings import get_settings
+from utils.session_state import session_state
 
 
 class SessionManager:
@@ -219,6 +220,8 @@ class SessionManager:
     
     def clear_session_dialogues(self, user_id: str, session_id: str, is_teacher: bool = False) -> int:
         """清除指定会话的所有对话历史，返回删除的文件数量"""
+        # 历史清空后，缓存的会话状态也不再对应
+        session_state.drop(session_state.session_key(user_id, session_id, is_teacher))
         try:
             session_path = self._ensure_user_dialogue_dir(user_id, session_id, is_teacher)
             
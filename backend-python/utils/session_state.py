@@ -0,0 +1,247 @@
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Union
+
+from utils.packed_state import PackedState
+from config.settings import get_settings
+
+
+def tensor_nbytes(obj) -> int:
+    """统计状态/logits实际占用的字节数"""
+    if obj is None:
+        return 0
+    if isinstance(obj, (list, tuple)):
+        if len(obj) > 0 and isinstance(obj[0], (int, float)):  # WebGPU logits/state
+            return 8 * len(obj)
+        return sum(tensor_nbytes(x) for x in obj)
+    if hasattr(obj, "element_size") and hasattr(obj, "nelement"):  # torch
+        return obj.element_size() * obj.nelement()
+    if hasattr(obj, "nbytes"):  # numpy
+        return int(obj.nbytes)
+    return 8
+
+
+def snapshot_tensor(tensor):
+    """复制到CPU，返回(副本, 原设备)"""
+    if hasattr(tensor, "detach"):  # torch（numpy 2的数组也有device属性）
+        return tensor.detach().to("cpu", copy=True), tensor.device
+    if hasattr(tensor, "copy"):  # numpy
+        return tensor.copy(), None
+    return list(tensor), None  # WebGPU logits
+
+
+def restore_tensor(tensor, device):
+    """恢复到原设备，返回新的张量，缓存中的副本保持不变"""
+    if device is not None and str(device) != "cpu":
+        return tensor.to(device)
+    if hasattr(tensor, "clone"):
+        return tensor.clone()
+    if hasattr(tensor, "copy"):
+        return tensor.copy()
+    return list(tensor)
+
+
+class SessionStateStore:
+    """
+    会话级RNN状态缓存：保存每轮prompt中对话历史结束处的状态、token和logits，
+    下一轮对话的prompt以同样的历史开头，从该状态继续，只需预填充之后的消息。
+    内存按字节预算做LRU淘汰，配置了溢出目录时，被淘汰的状态写入磁盘，下次命中时再读回内存。
+    """
+
+    def __init__(
+        self,
+        budget_bytes: int,
+        spill_dir: str = "",
+        disk_budget_bytes: int = 0,
+    ):
+        self.budget_bytes = budget_bytes
+        self.spill_dir = spill_dir
+        self.disk_budget_bytes = disk_budget_bytes
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.spilled: "OrderedDict[str, int]" = OrderedDict()  # key -> 文件大小
+        self.nbytes = 0
+        self.disk_nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+    @staticmethod
+    def session_key(user_id: str, session_id: str, is_teacher: bool = False) -> str:
+        user_type = "teacher" if is_teacher else "student"
+        return f"{user_type}/{user_id}/{session_id}"
+
+    def put(
+        self,
+        key: str,
+        history: str,
+        tokens: List[int],
+        state,
+        logits,
+        model_path: str,
+        state_namespace: str,
+    ) -> bool:
+        """
+        history为状态对应的对话历史文本，tokens为从prompt开头到该位置的全部token。
+        不支持的状态类型（WebGPU状态保存在显存中）不缓存，返回False。
+        """
+        if type(state) == list and len(state) > 0 and hasattr(state[0], "device"):
+            # 在原设备上打包成连续缓冲区，再整块复制到CPU
+            packed = PackedState.pack(state)
+            devices = packed.devices
+            state = packed.to("cpu")
+        elif hasattr(state, "copy") and hasattr(state, "nbytes"):  # rwkv.cpp
+            state, devices = state.copy(), None
+        else:
+            return False
+        logits, logits_device = snapshot_tensor(logits)
+
+        entry = {
+            "history": history,
+            "tokens": list(tokens),
+            "state": state,
+            "devices": devices,
+            "logits": logits,
+            "logits_device": logits_device,
+            "model_path": model_path,
+            "state_namespace": state_namespace,
+        }
+        entry["nbytes"] = (
+            tensor_nbytes(state) + tensor_nbytes(logits) + 8 * len(entry["tokens"])
+        )
+        if entry["nbytes"] > self.budget_bytes:
+            return False
+
+        with self.lock:
+            self.__remove(key)
+            self.entries[key] = entry
+            self.nbytes += entry["nbytes"]
+            while self.nbytes > self.budget_bytes:
+                old_key, old_entry = self.entries.popitem(last=False)
+                self.nbytes -= old_entry["nbytes"]
+                self.__spill(old_key, old_entry)
+        return True
+
+    def get(
+        self, key: str, model_path: str, state_namespace: str
+    ) -> Union[Dict[str, Any], None]:
+        """
+        返回可直接使用的副本（状态已恢复到原设备），模型或state文件已切换时视为未命中。
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            elif key in self.spilled:
+                entry = self.__load(key)
+            if (
+                entry is None
+                or entry["model_path"] != model_path
+                or entry["state_namespace"] != state_namespace
+            ):
+                self.misses += 1
+                return None
+            self.hits += 1
+
+            if entry["devices"] is None:
+                state = entry["state"].copy()
+            else:
+                state = entry["state"].unpack(entry["devices"])
+            return {
+                "history": entry["history"],
+                "tokens": list(entry["tokens"]),
+                "state": state,
+                "logits": restore_tensor(entry["logits"], entry["logits_device"]),
+            }
+
+    def drop(self, key: str):
+        with self.lock:
+            self.__remove(key)
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.spilled.keys()):
+                self.__remove_file(key)
+            self.entries.clear()
+            self.spilled.clear()
+            self.nbytes = 0
+            self.disk_nbytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "sessions": len(self.entries),
+                "bytes": self.nbytes,
+                "budget_bytes": self.budget_bytes,
+                "spilled_sessions": len(self.spilled),
+                "spilled_bytes": self.disk_nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def __path(self, key: str) -> str:
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.spill_dir, f"{name}.pkl")
+
+    def __remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry["nbytes"]
+        if key in self.spilled:
+            self.__remove_file(key)
+            self.disk_nbytes -= self.spilled.pop(key)
+
+    def __remove_file(self, key: str):
+        try:
+            os.remove(self.__path(key))
+        except OSError:
+            pass
+
+    def __spill(self, key: str, entry: Dict[str, Any]):
+        if not self.spill_dir or entry["nbytes"] > self.disk_budget_bytes:
+            return
+        try:
+            with open(self.__path(key), "wb") as f:
+                pickle.dump(entry, f)
+        except Exception as e:
+            print(f"Error spilling session state {key}: {e}")
+            self.__remove_file(key)
+            return
+        self.spilled[key] = entry["nbytes"]
+        self.disk_nbytes += entry["nbytes"]
+        while self.disk_nbytes > self.disk_budget_bytes:
+            old_key, size = self.spilled.popitem(last=False)
+            self.__remove_file(old_key)
+            self.disk_nbytes -= size
+
+    def __load(self, key: str) -> Union[Dict[str, Any], None]:
+        self.disk_nbytes -= self.spilled.pop(key)
+        path = self.__path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except Exception as e:
+            print(f"Error loading session state {key}: {e}")
+            return None
+        finally:
+            self.__remove_file(key)
+        # 读回内存，可能把其他会话挤到磁盘上
+        self.entries[key] = entry
+        self.nbytes += entry["nbytes"]
+        while self.nbytes > self.budget_bytes and len(self.entries) > 1:
+            old_key, old_entry = self.entries.popitem(last=False)
+            self.nbytes -= old_entry["nbytes"]
+            self.__spill(old_key, old_entry)
+        return entry
+
+
+settings = get_settings()
+session_state = SessionStateStore(
+    settings.RWKV_SESSION_STATE_BUDGET_MB * 1024 * 1024,
+    settings.RWKV_SESSION_STATE_SPILL_DIR,
+    settings.RWKV_SESSION_STATE_DISK_BUDGET_MB * 1024 * 1024,
+)
@@ -0,0 +1,270 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+from typing import Any, Dict, List, Tuple, Union
+
+from utils.radix_tree import TokenRadixTree
+from config.settings import get_settings
+
+try:
+    import fcntl
+except ImportError:  # Windows, the shared cache stays disabled
+    fcntl = None
+
+
+class SharedStateArena:
+    """
+    Prefix states shared by all the worker processes of a node, in a memory-mapped file
+    (under /dev/shm by default). Records are appended to the arena, one writer at a time
+    (serialized by a file lock); readers never lock, they index the new records by themselves
+    and get views into the mapping, without copying.
+
+    Layout: header (magic, epoch, end of the committed records), then records
+    (total length, meta length, json meta with tokens and tensor specs, 64-byte aligned tensors).
+    When the arena is full, the writer starts over from the first record and bumps the epoch,
+    a reader holding views of the previous epoch must drop them (see valid).
+    """
+
+    MAGIC = b"ITAPSHM1"
+    HEADER = struct.Struct("<8sQQ")  # magic, epoch, end
+    RECORD = struct.Struct("<QI")  # total length, meta length
+    DATA_START = 4096
+    ALIGN = 64
+
+    def __init__(self, directory: str, size_bytes: int):
+        self.directory = directory
+        self.size_bytes = size_bytes
+        self.path: Union[str, None] = None
+        self.fd: Union[int, None] = None
+        self.lock_fd: Union[int, None] = None
+        self.mm: Union[mmap.mmap, None] = None
+        self.lock = threading.Lock()
+        self.__reset_index(0)
+        self.stats_counter = {"hits": 0, "misses": 0, "published": 0, "stale": 0}
+
+    def __reset_index(self, epoch: int):
+        self.epoch = epoch
+        self.scanned = self.DATA_START
+        self.trie = TokenRadixTree()
+        self.records: Dict[int, Dict[str, Any]] = {}  # trie id -> meta
+
+    @property
+    def attached(self) -> bool:
+        return self.mm is not None
+
+    def attach(self, key: Dict[str, str]) -> bool:
+        """
+        Maps the arena of a model configuration, created by the first process with this key.
+        """
+        self.detach()
+        if fcntl is None or self.size_bytes <= self.DATA_START:
+            return False
+
+        name = hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+        path = os.path.join(self.directory, f"itap_state_{name}")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            lock_fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size < self.DATA_START:
+                    os.ftruncate(fd, self.size_bytes)
+                    os.pwrite(fd, self.HEADER.pack(self.MAGIC, 0, self.DATA_START), 0)
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            # the first process decides the size, the others map what is there
+            mm = mmap.mmap(fd, os.fstat(fd).st_size, access=mmap.ACCESS_WRITE)
+            if mm[: len(self.MAGIC)] != self.MAGIC:
+                mm.close()
+                os.close(fd)
+                os.close(lock_fd)
+                print(f"bad shared state cache file: {path}")
+                return False
+        except OSError as e:
+            print(f"failed to attach shared state cache: {e}")
+            return False
+
+        with self.lock:
+            self.path = path
+            self.fd = fd
+            self.lock_fd = lock_fd
+            self.mm = mm
+            self.__reset_index(-1)
+        print(f"shared state cache attached: {path}")
+        return True
+
+    def detach(self):
+        with self.lock:
+            if self.mm is None:
+                return
+            # the views handed out keep the mapping alive until they are released
+            self.mm = None
+            os.close(self.fd)
+            os.close(self.lock_fd)
+            self.fd = None
+            self.lock_fd = None
+            self.path = None
+            self.__reset_index(0)
+
+    def __header(self) -> Tuple[int, int]:
+        # the writer stores epoch and end separately, read until both come from the same write
+        while True:
+            _, epoch, end = self.HEADER.unpack_from(self.mm, 0)
+            _, epoch_again, end_again = self.HEADER.unpack_from(self.mm, 0)
+            if epoch == epoch_again and end == end_again:
+                return epoch, end
+
+    def __sync(self):
+        """
+        Indexes the records committed since the last call.
+        """
+        epoch, end = self.__header()
+        if epoch != self.epoch:
+            self.__reset_index(epoch)
+        try:
+            while self.scanned < end:
+                total, meta_len = self.RECORD.unpack_from(self.mm, self.scanned)
+                start = self.scanned + self.RECORD.size
+                meta = json.loads(bytes(self.mm[start : start + meta_len]).decode("utf-8"))
+                id = self.trie.insert(meta["tokens"])
+                meta["tokens"] = len(meta["tokens"])  # the trie keeps the tokens
+                self.records[id] = meta
+                self.scanned += total
+        except (ValueError, struct.error):
+            self.__reset_index(-1)  # overwritten while scanning, start over next time
+            return
+        if self.__header()[0] != epoch:
+            self.__reset_index(-1)
+
+    def valid(self, epoch: int) -> bool:
+        """
+        False once the records of epoch may have been overwritten.
+        """
+        with self.lock:
+            if self.mm is not None and self.__header()[0] == epoch:
+                return True
+            self.stats_counter["stale"] += 1
+            return False
+
+    def longest_prefix(self, tokens: List[int], min_length: int = 1):
+        """
+        Returns (epoch, length, meta, state views, logits view) of the longest shared prefix
+        of at least min_length tokens, None if there is none.
+        The views point into the mapping, copy them before valid(epoch) turns False.
+        """
+        with self.lock:
+            if self.mm is None:
+                return None
+            self.__sync()
+            id, length = self.trie.longest_prefix(tokens)
+            if id == -1 or length < min_length:
+                self.stats_counter["misses"] += 1
+                return None
+            meta = self.records[id]
+            tensors = [self.__view(spec) for spec in meta["state"] + [meta["logits"]]]
+            self.stats_counter["hits"] += 1
+            state = tensors[:-1] if meta["state_list"] else tensors[0]
+            return self.epoch, length, meta, state, tensors[-1]
+
+    def __view(self, spec: Dict):
+        if spec["kind"] == "torch":
+            import torch
+
+            tensor = torch.frombuffer(
+                self.mm, dtype=torch.uint8, count=spec["nbytes"], offset=spec["offset"]
+            )
+            return tensor.view(getattr(torch, spec["dtype"])).view(spec["shape"])
+        import numpy as np
+
+        dtype = np.dtype(spec["dtype"])
+        array = np.frombuffer(
+            self.mm,
+            dtype=dtype,
+            count=spec["nbytes"] // dtype.itemsize,
+            offset=spec["offset"],
+        )
+        return array.reshape(spec["shape"])
+
+    def publish(self, tokens: List[int], meta: Dict[str, Any], buffers: List) -> bool:
+        """
+        Appends a record, buffers are (spec, raw bytes) with the state tensors first.
+        Returns False if the tokens are already shared or the record does not fit.
+        """
+        if self.mm is None:
+            return False
+
+        meta = dict(meta, tokens=list(tokens))
+        fixed = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+        # the offsets are absolute, they are only known once the record position is
+        specs = [dict(spec, offset=0, nbytes=len(buffer)) for spec, buffer in buffers]
+        # upper bound of the meta length with the real offsets
+        meta_room = len(fixed) + len(json.dumps(specs)) + 32 * len(specs) + 64
+        data_len = sum(self.__align(len(buffer)) for _, buffer in buffers)
+        total = self.__align(self.RECORD.size + meta_room) + data_len
+        if self.DATA_START + total > len(self.mm):
+            return False
+
+        with self.lock:
+            if self.mm is None:
+                return False
+            mm = self.mm
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+            try:
+                self.__sync()
+                id, length = self.trie.longest_prefix(tokens)
+                if id != -1 and length == len(tokens):
+                    return False
+                epoch, end = self.__header()
+                if end + total > len(mm):
+                    # wrap around: readers see the new epoch before anything is overwritten
+                    epoch += 1
+                    end = self.DATA_START
+                    self.HEADER.pack_into(mm, 0, self.MAGIC, epoch, end)
+
+                offset = self.__align(end + self.RECORD.size + meta_room)
+                for spec, (_, buffer) in zip(specs, buffers):
+                    spec["offset"] = offset
+                    mm[offset : offset + len(buffer)] = buffer
+                    offset += self.__align(len(buffer))
+                meta["state"] = specs[:-1]
+                meta["logits"] = specs[-1]
+                data = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+                data = data + b" " * (meta_room - len(data))
+                self.RECORD.pack_into(mm, end, total, meta_room)
+                mm[end + self.RECORD.size : end + self.RECORD.size + meta_room] = data
+                # commit
+                self.HEADER.pack_into(mm, 0, self.MAGIC, epoch, end + total)
+            finally:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+            self.stats_counter["published"] += 1
+        return True
+
+    def __align(self, n: int) -> int:
+        return (n + self.ALIGN - 1) // self.ALIGN * self.ALIGN
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            if self.mm is None:
+                return {"attached": False}
+            self.__sync()
+            return {
+                "attached": True,
+                "path": self.path,
+                "size_bytes": len(self.mm),
+                "used_bytes": self.scanned - self.DATA_START,
+                "epoch": self.epoch,
+                "entries": len(self.records),
+                **self.stats_counter,
+            }
+
+
+settings = get_settings()
+shared_state = SharedStateArena(
+    settings.RWKV_SHARED_STATE_CACHE_DIR
+    or ("/dev/shm" if os.path.isdir("/dev/shm") else str(settings.STATE_CACHE_DIR)),
+    settings.RWKV_SHARED_STATE_CACHE_MB * 1024 * 1024,
+)
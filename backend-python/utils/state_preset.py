@@ -0,0 +1,72 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Tuple
+
+from config.settings import get_settings
+
+
+class StatePresetRegistry:
+    """
+    常驻的state微调文件：每个文件只加载一次（打包成PackedState），按LRU保留max_presets个。
+    请求各自指定state文件时直接从这里取，不再重新读取文件，也不清空前缀状态缓存。
+    文件修改时间变化后重新加载，缓存命名空间随之改变，旧文件产生的前缀状态和会话状态不会再命中。
+    """
+
+    def __init__(self, max_presets: int):
+        self.max_presets = max(1, max_presets)
+        self.presets: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(
+        self, model_path: str, state_path: str, load: Callable[[str], Any]
+    ) -> Tuple[Any, str]:
+        """
+        返回(预设, 命名空间)，未加载或文件已更新时调用load(state_path)加载；
+        命名空间为"state_path@修改时间"，用作前缀状态缓存、会话状态和课时状态的键。
+        load抛出的异常原样传给调用方，不会缓存。
+        """
+        key = (model_path, state_path)
+        mtime = os.path.getmtime(state_path)
+        with self.lock:
+            entry = self.presets.get(key)
+            if entry is not None and entry["mtime"] == mtime:
+                self.presets.move_to_end(key)
+                self.hits += 1
+                return entry["state"], entry["namespace"]
+
+        state = load(state_path)
+        namespace = f"{state_path}@{mtime}"
+
+        with self.lock:
+            self.presets[key] = {"state": state, "mtime": mtime, "namespace": namespace}
+            self.presets.move_to_end(key)
+            self.loads += 1
+            while len(self.presets) > self.max_presets:
+                self.presets.popitem(last=False)
+                self.evictions += 1
+        return state, namespace
+
+    def clear(self):
+        with self.lock:
+            self.presets.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "presets": [state_path for _, state_path in self.presets.keys()],
+                "max_presets": self.max_presets,
+                "bytes": sum(
+                    entry["state"].nbytes for entry in self.presets.values()
+                ),
+                "loads": self.loads,
+                "hits": self.hits,
+                "evictions": self.evictions,
+            }
+
+
+settings = get_settings()
+state_presets = StatePresetRegistry(settings.RWKV_STATE_PRESET_MAX)